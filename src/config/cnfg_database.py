@@ -3,3 +3,11 @@ ASSEMBLY_SUMMARY_REFSEQ = "/data/mengxf/Database/NCBI/genomes/assembly_summary_r
 ASSEMBLY_SUMMARY_GENBANK = "/data/mengxf/Database/NCBI/genomes/assembly_summary_genbank.txt"
 CHECKV_DB = "/data/mengxf/Database/checkV/checkv-db-v1.5"
 BLAST_CORE_NT = "/data/mengxf/Database/NCBI/blast/db/core_nt/core_nt"
+# assembly summary 列式缓存目录, 按 taxid 索引, 源文件变化后自动重建
+ASSEMBLY_SUMMARY_CACHE_DIR = "/data/mengxf/Database/NCBI/genomes/assembly_summary_cache"
+# taxonomy 数组快照, nodes.dmp/names.dmp 变化后自动重建
+TAXONOMY_CACHE = "/data/mengxf/Database/NCBI/taxonomy_cache/taxonomy.pkl"
+# prokka 注释结果共享缓存, 按基因组内容 sha256 + prokka 版本和参数寻址, 可在多个项目间共享
+ANNOTATION_CACHE_DIR = "/data/mengxf/Database/annotation_cache"
+# 注释缓存总大小上限, 超过后按最近最少使用淘汰
+ANNOTATION_CACHE_MAX_BYTES = 200 * 1024 ** 3
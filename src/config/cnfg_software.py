@@ -1,9 +1,39 @@
-# mamba env 部分软件需要在环境内使用
-# - qpcr: checkm, checkv
-# - meta: prokka, roary
+# mamba env 部分软件需要在环境内使用, 通过 util_command.run_tool/tool_command 直接执行
 ACTIVATE = "/home/mengxf/miniforge3/bin/activate"
+# 软件 -> 所在 conda 环境
+TOOL_ENVS = {
+    "prokka": "meta",
+    "barrnap": "meta",
+    "aragorn": "meta",
+    "roary": "meta",
+    "cd-hit": "meta",
+    "checkm": "qpcr",
+    "checkv": "qpcr",
+}
+# conda 环境变量缓存目录, 每个环境只需 source activate 一次
+CONDA_ENV_CACHE_DIR = "/home/mengxf/.cache/kml_qpcr/conda_env"
 SEQKIT = "/home/mengxf/miniforge3/envs/basic/bin/seqkit"
 SEQTK = "/home/mengxf/miniforge3/envs/basic/bin/seqtk"
 TAXONKIT = "/home/mengxf/miniforge3/envs/basic/bin/taxonkit"
 CSVTK = "/home/mengxf/miniforge3/envs/basic/bin/csvtk"
 BLASTN = "/home/mengxf/miniforge3/envs/basic/bin/blastn"
+
+# prokka 单个基因组最多使用的核心数, 超过后加速不明显
+PROKKA_MAX_CPU = 8
+
+# checkM 分片运行的内存模型, 单个分片峰值内存 = 基础内存 + pplacer 线程数 * 每线程内存 (GB)
+# 实测峰值见 genome_assess/checkm_shard_stats.tsv, 据此校准
+CHECKM_MEMORY_BUDGET_GB = 128
+CHECKM_SHARD_BASE_MEMORY_GB = 2
+CHECKM_PPLACER_THREAD_MEMORY_GB = 40
+# 每个分片至少包含的基因组数, 分片太小时加载参考树的开销占比过高
+CHECKM_SHARD_MIN_GENOMES = 10
+# checkV 批次数, 病毒基因组合并成几个输入文件运行, 每个批次只加载一次数据库
+CHECKV_BATCHES = 4
+
+# 增量泛基因组: 新基因组蛋白按 k-mer 分配到已有簇, 未分配的蛋白用 cd-hit 聚类
+PANGENOME_KMER_SIZE = 5
+# 蛋白与簇代表序列共有 k-mer 占蛋白 k-mer 的最小比例
+PANGENOME_MIN_KMER_CONTAINMENT = 0.8
+# 蛋白与簇代表序列的最小长度比 (短 / 长)
+PANGENOME_MIN_LENGTH_RATIO = 0.8
@@ -0,0 +1,15 @@
+# 下载前根据 assembly summary 元数据过滤基因组, 避免下载和注释后才被 assess 过滤掉
+# 允许的组装级别
+TRIAGE_ASSEMBLY_LEVELS = ["Complete Genome", "Chromosome", "Scaffold", "Contig"]
+# 最大 contig 数和 scaffold 数, 碎片化严重的组装通常缺少 rRNA, 无法通过 assess 过滤
+TRIAGE_MAX_CONTIG_COUNT = 500
+TRIAGE_MAX_SCAFFOLD_COUNT = 500
+# 基因组大小相对物种中位数的最大偏离比例
+TRIAGE_GENOME_SIZE_DEVIATION = 0.2
+# 计算基因组大小中位数所需的最少基因组数, 少于该数目不做大小过滤
+TRIAGE_MIN_GENOMES_FOR_SIZE = 5
+# assess 运行 checkM 前根据组装统计标记离群基因组, 同时沿用上面的 contig 数和基因组大小阈值
+# GC 含量与物种中位数的最大偏差 (百分点)
+ASSESS_GC_DEVIATION = 2.0
+# N 碱基最大比例
+ASSESS_MAX_N_FRACTION = 0.05
@@ -0,0 +1,107 @@
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+
+class AnnotationCache():
+    def __init__(self, cache_dir: str, max_bytes: int, tool_key: str):
+        """
+        按内容寻址的注释结果缓存, 可在多个物种和项目之间共享.
+        键为 sha256(基因组内容) + 软件版本和参数, 每个条目一个目录, 保存注释结果文件和 meta.json.
+        条目目录的修改时间作为最近使用时间, 总大小超过上限时按最近最少使用淘汰.
+        :param cache_dir: 缓存根目录
+        :param max_bytes: 缓存总大小上限 (字节)
+        :param tool_key: 软件版本和参数, 如 "prokka 1.14.6 --kingdom Bacteria --addgenes"
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.tool_key = tool_key
+
+    def key(self, digest: str) -> str:
+        """基因组 sha256 和软件参数合并为缓存键"""
+        return hashlib.sha256(f"{digest}\t{self.tool_key}".encode()).hexdigest()
+
+    def entry_dir(self, digest: str) -> Path:
+        key = self.key(digest)
+        return self.cache_dir / key[:2] / key
+
+    def materialize(self, digest: str, out_dir: Path, gnm_id: str) -> bool:
+        """
+        缓存命中时把结果放到 out_dir, 同名基因组直接硬链接, 否则重命名文件并替换 locus tag
+        :param digest: 基因组内容 sha256
+        :param out_dir: 注释结果目录, 已存在会被删除
+        :param gnm_id: 基因组 id, 即 prokka 的 --prefix 和 --locustag
+        :return: 是否命中
+        """
+        entry = self.entry_dir(digest)
+        meta_file = entry / "meta.json"
+        if not meta_file.exists():
+            return False
+        with open(meta_file) as f:
+            meta = json.load(f)
+        old_id = meta["gnm_id"]
+        if out_dir.exists():
+            shutil.rmtree(out_dir)
+        out_dir.mkdir(parents=True)
+        pattern = re.compile(rf"(?<![\w.]){re.escape(old_id)}_(\d{{5}})(?!\d)".encode())
+        for name in meta["files"]:
+            src = entry / name
+            dest = out_dir / (gnm_id + name.removeprefix(old_id) if name.startswith(old_id) else name)
+            if old_id == gnm_id:
+                link_or_copy(src, dest)
+            else:
+                dest.write_bytes(pattern.sub(gnm_id.encode() + rb"_\1", src.read_bytes()))
+        # 更新最近使用时间
+        os.utime(entry)
+        return True
+
+    def store(self, digest: str, out_dir: Path, gnm_id: str) -> None:
+        """
+        把注释结果存入缓存, 先写临时目录再重命名, 多个项目同时写入同一条目时保留先完成的
+        :param digest: 基因组内容 sha256
+        :param out_dir: 注释结果目录
+        :param gnm_id: 基因组 id
+        """
+        entry = self.entry_dir(digest)
+        if entry.joinpath("meta.json").exists():
+            return
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f".{entry.name}.", dir=entry.parent))
+        files = sorted(path.name for path in out_dir.iterdir() if path.is_file())
+        for name in files:
+            link_or_copy(out_dir / name, tmp_dir / name)
+        size = sum(tmp_dir.joinpath(name).stat().st_size for name in files)
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump({"gnm_id": gnm_id, "tool": self.tool_key, "files": files, "bytes": size}, f, indent=2)
+        try:
+            tmp_dir.rename(entry)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
+    def evict(self) -> None:
+        """总大小超过上限时, 按最近使用时间从旧到新删除条目"""
+        entries = []
+        for meta_file in self.cache_dir.glob("*/*/meta.json"):
+            with open(meta_file) as f:
+                size = json.load(f)["bytes"]
+            entries.append((meta_file.parent.stat().st_mtime, size, meta_file.parent))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logging.info(f"注释缓存超过上限, 删除条目: {entry.name}")
+
+
+def link_or_copy(src: Path, dest: Path) -> None:
+    """优先硬链接, 跨文件系统时复制"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
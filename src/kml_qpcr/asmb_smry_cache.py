@@ -0,0 +1,81 @@
+from pathlib import Path
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from src.utils.util_file import file_fingerprint, replace_dir
+
+# 流程用到的 assembly summary 列
+ASMB_SMRY_USECOLS = [
+    "#assembly_accession", "refseq_category", "taxid", "species_taxid", "organism_name",
+    "assembly_level", "gbrs_paired_asm", "ftp_path", "genome_size", "scaffold_count", "contig_count"]
+
+
+class AssemblySummaryCache():
+    def __init__(self, summary_file: str, cache_dir: str):
+        """
+        assembly summary 列式缓存. 每列单独存为 .npy, 按 taxid 排序, 查询时内存映射读取.
+        字符串列存为 utf-8 字节块 + 偏移数组, 只解码命中的行.
+        :param summary_file: NCBI assembly_summary_*.txt 文件
+        :param cache_dir: 缓存根目录, 每个 summary 文件一个子目录
+        """
+        self.summary_file = Path(summary_file)
+        self.cache_dir = Path(cache_dir) / self.summary_file.stem
+        self.meta_file = self.cache_dir / "meta.json"
+
+    def is_stale(self) -> bool:
+        """源文件大小或修改时间变化, 或缓存不完整时需要重建"""
+        if not self.meta_file.exists():
+            return True
+        with open(self.meta_file) as f:
+            meta = json.load(f)
+        return (meta["source"] != file_fingerprint(self.summary_file)) or (meta["columns"] != ASMB_SMRY_USECOLS)
+
+    def build(self) -> None:
+        """解析 assembly summary 一次, 写入列式缓存"""
+        logging.info(f"构建 assembly summary 缓存: {self.summary_file} -> {self.cache_dir}")
+        fingerprint = file_fingerprint(self.summary_file)
+        df = pd.read_csv(self.summary_file, sep="\t", skiprows=1,
+                         na_values=["na", ""], dtype=object, usecols=ASMB_SMRY_USECOLS)
+        # 按 taxid 排序, 稳定排序保留原文件内的行顺序
+        taxids = df["taxid"].astype(np.int64).to_numpy()
+        order = np.argsort(taxids, kind="stable")
+        tmp_dir = self.cache_dir.with_name(self.cache_dir.name + ".tmp")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        np.save(tmp_dir / "taxid.npy", taxids[order])
+        np.save(tmp_dir / "row.npy", order.astype(np.int64))
+        for i, col in enumerate(ASMB_SMRY_USECOLS):
+            encoded = [("" if pd.isna(v) else v).encode("utf-8") for v in df[col].to_numpy()[order]]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(v) for v in encoded], out=offsets[1:])
+            np.save(tmp_dir / f"col{i}.offsets.npy", offsets)
+            np.save(tmp_dir / f"col{i}.blob.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        # meta 最后写入, 作为缓存完整的标志
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump({"source": fingerprint, "columns": ASMB_SMRY_USECOLS, "rows": len(df)}, f, indent=2)
+        replace_dir(tmp_dir, self.cache_dir)
+
+    def query_taxids(self, taxids: list) -> pd.DataFrame:
+        """
+        按 taxid 查询条目, 缓存失效时先重建
+        :param taxids: taxonomy id 列表
+        :return: 命中的 assembly summary dataframe, 列和 dtype 与 pd.read_csv(dtype=object) 一致
+        """
+        if self.is_stale():
+            self.build()
+        sorted_taxids = np.load(self.cache_dir / "taxid.npy", mmap_mode="r")
+        query = np.unique(np.asarray(taxids, dtype=np.int64))
+        starts = np.searchsorted(sorted_taxids, query, side="left")
+        ends = np.searchsorted(sorted_taxids, query, side="right")
+        idx = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)] + [np.empty(0, dtype=np.int64)])
+        # 恢复原文件中的行顺序
+        rows = np.load(self.cache_dir / "row.npy", mmap_mode="r")[idx]
+        idx = idx[np.argsort(rows, kind="stable")]
+        data = {}
+        for i, col in enumerate(ASMB_SMRY_USECOLS):
+            offsets = np.load(self.cache_dir / f"col{i}.offsets.npy", mmap_mode="r")
+            blob = np.load(self.cache_dir / f"col{i}.blob.npy", mmap_mode="r")
+            values = [blob[offsets[j]:offsets[j + 1]].tobytes().decode("utf-8") for j in idx]
+            data[col] = [v if v else np.nan for v in values]
+        return pd.DataFrame(data, columns=ASMB_SMRY_USECOLS, dtype=object)
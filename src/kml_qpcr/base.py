@@ -1,14 +1,23 @@
 from pathlib import Path
+import pandas as pd
+
+from src.kml_qpcr.gnm_catalog import GenomeCatalog
+
+# 变更集中需要重新处理的基因组状态
+CHANGESET_DELTA_STATUS = ["added", "changed"]
 
 
 class BaseQPCR():
-    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool):
+    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool, changeset: bool = False,
+                 representatives_only: bool = False):
         """
         qPCR 项目中公用的参数
         :sci_name: 目标微生物科学名
         :genome_set_dir: 基因组集合目录
         :threads: 线程数
         :force: 是否强制执行
+        :changeset: 是否只处理 refresh 生成的变更集 info/changeset.tsv
+        :representatives_only: 是否只处理 dedup 聚类得到的代表基因组 genome_dedup/representatives.txt
         """
         self.sci_name = sci_name
         self.genome_set_dir = genome_set_dir
@@ -16,3 +25,46 @@ class BaseQPCR():
         self.force = force
         # 当前微生物基因组目录
         self.gnm_dir = Path(genome_set_dir).joinpath(sci_name.replace(" ", "_"))
+        # 每个基因组每个步骤的完成标记目录
+        self.ledger_dir = self.gnm_dir / "ledger"
+        # 基因组目录, 各步骤从这里查询基因组, 不再遍历 all 目录
+        self.catalog = GenomeCatalog(self.gnm_dir)
+        # 变更集 genome_id -> 状态 (added/changed/withdrawn), 为 None 时处理全部基因组
+        self.changeset = self.load_changeset() if changeset else None
+        # 代表基因组, 为 None 时处理全部基因组
+        self.representatives = self.load_representatives() if representatives_only else None
+
+    def genome_fnas(self) -> list[Path]:
+        """当前有效基因组的 fna 文件, 只处理代表基因组时按代表基因组筛选"""
+        return self.catalog.genome_fnas(self.representatives)
+
+    def load_changeset(self) -> dict[str, str]:
+        """
+        读取 refresh 生成的变更集
+        :return: genome_id -> 状态
+        :raises FileNotFoundError: 变更集文件不存在
+        """
+        chgset_file = self.gnm_dir / "info/changeset.tsv"
+        if not chgset_file.exists():
+            raise FileNotFoundError(f"变更集文件不存在, 请先运行 refresh: {chgset_file}")
+        df = pd.read_csv(chgset_file, sep="\t", dtype=str)
+        return dict(zip(df["genome_id"], df["status"]))
+
+    def delta_genomes(self) -> set[str]:
+        """变更集中新增或变化的基因组"""
+        return {gid for gid, status in (self.changeset or {}).items() if status in CHANGESET_DELTA_STATUS}
+
+    def withdrawn_genomes(self) -> set[str]:
+        """变更集中被撤回的基因组"""
+        return {gid for gid, status in (self.changeset or {}).items() if status == "withdrawn"}
+
+    def load_representatives(self) -> set[str]:
+        """
+        读取 dedup 聚类得到的代表基因组
+        :raises FileNotFoundError: 代表基因组文件不存在
+        """
+        reps_file = self.gnm_dir / "genome_dedup/representatives.txt"
+        if not reps_file.exists():
+            raise FileNotFoundError(f"代表基因组文件不存在, 请先运行 dedup: {reps_file}")
+        with open(reps_file) as f:
+            return set(f.read().split())
@@ -1,9 +1,16 @@
 import click
 
 from src.kml_qpcr.gnm_download import download_genome_files
+from src.kml_qpcr.gnm_refresh import refresh_genome_files
+from src.kml_qpcr.gnm_batch import batch_download_genome_files
+from src.kml_qpcr.asmb_smry_cache import AssemblySummaryCache
+from src.config.cnfg_database import (ASSEMBLY_SUMMARY_REFSEQ, ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_CACHE_DIR,
+                                      ANNOTATION_CACHE_DIR)
+from src.config.cnfg_software import CHECKM_MEMORY_BUDGET_GB, CHECKV_BATCHES
 from src.kml_qpcr.gnm_quality_assess import GenomeQualityAssessor, GenomeQualityAssessorViruses
-from src.kml_qpcr.cstm_gnms_load import load_customer_genomes
-from src.kml_qpcr.gnm_annotate import GenomeAnnotator
+from src.kml_qpcr.cstm_gnms_load import load_customer_genomes, IMPORT_MODES
+from src.kml_qpcr.gnm_annotate import GenomeAnnotator, ANNOTATE_ENGINES
+from src.kml_qpcr.gnm_dedup import GenomeDeduplicator
 from src.kml_qpcr.csvd_gene_obtain import ConservedGenePredictor
 from src.kml_qpcr.spec_gene_obtain import SpeciticityGeneObtainer
 
@@ -26,58 +33,162 @@ def common_options(func):
     return func
 
 
+def changeset_option(func):
+    """变更集参数装饰器, 用于 refresh 之后只处理增量基因组"""
+    return click.option("--changeset", is_flag=True, help="只处理 refresh 生成的变更集 info/changeset.tsv 中的基因组.")(func)
+
+
+def representatives_option(func):
+    """代表基因组参数装饰器, 用于 dedup 之后只处理代表基因组"""
+    return click.option("--representatives-only", is_flag=True,
+                        help="只处理 dedup 聚类得到的代表基因组 genome_dedup/representatives.txt.")(func)
+
+
+@cli.command()
+@common_options
+@click.option("--max-connections", default=8, type=int, show_default=True, help="最大并发下载数.")
+@click.option("--mirror", default=None, help="NCBI 镜像根地址, 如 file:///data/ncbi_mirror 或 http://127.0.0.1:8000.")
+@click.option("--no-triage", is_flag=True, help="不在下载前根据组装级别, contig 数和基因组大小过滤基因组.")
+def download(sci_name, genome_set_dir, threads, force, max_connections, mirror, no_triage):
+    """下载参考数据库. 线程参数用于解压, 并发下载数用 --max-connections 设置."""
+    download_genome_files(sci_name, genome_set_dir, threads, max_connections, mirror, force, not no_triage)
+
+
+@cli.command("batch-download")
+@click.option("--species-list", required=True, help="物种学名列表文件, 每行一个, '#' 开头为注释.")
+@click.option("--genome-set-dir", default="kml_qpcr_genomes",
+              show_default=True, help="项目微生物总目录, 输出结果在该目录下.")
+@click.option("--threads", default=4, type=int, show_default=True, help="全局线程数.")
+@click.option("--force", is_flag=True, help="强制重新下载已存在的文件.")
+@click.option("--max-connections", default=8, type=int, show_default=True, help="最大并发下载数.")
+@click.option("--mirror", default=None, help="NCBI 镜像根地址, 如 file:///data/ncbi_mirror 或 http://127.0.0.1:8000.")
+@click.option("--no-triage", is_flag=True, help="不在下载前根据组装级别, contig 数和基因组大小过滤基因组.")
+@click.help_option(help="显示帮助信息.")
+def batch_download(species_list, genome_set_dir, threads, force, max_connections, mirror, no_triage):
+    """批量下载多个物种. 参考数据只加载一次, 所有物种共用一个下载队列."""
+    batch_download_genome_files(species_list, genome_set_dir, threads, max_connections, mirror, force, not no_triage)
+
+
+@cli.command()
+@common_options
+@click.option("--max-connections", default=8, type=int, show_default=True, help="最大并发下载数.")
+@click.option("--mirror", default=None, help="NCBI 镜像根地址, 如 file:///data/ncbi_mirror 或 http://127.0.0.1:8000.")
+@click.option("--no-triage", is_flag=True, help="不在下载前根据组装级别, contig 数和基因组大小过滤基因组.")
+def refresh(sci_name, genome_set_dir, threads, force, max_connections, mirror, no_triage):
+    """增量更新基因组集. 只下载新增和变化的基因组, 变更集写入 info/changeset.tsv."""
+    refresh_genome_files(sci_name, genome_set_dir, threads, max_connections, mirror, not no_triage, force)
+
+
+@cli.command("build-cache")
+@click.option("--force", is_flag=True, help="强制重建缓存 默认源文件未变化就跳过.")
+@click.help_option(help="显示帮助信息.")
+def build_cache(force):
+    """构建 RefSeq/GenBank assembly summary 的 taxid 索引缓存. 源文件更新后 download 也会自动重建."""
+    for smry in [ASSEMBLY_SUMMARY_REFSEQ, ASSEMBLY_SUMMARY_GENBANK]:
+        cache = AssemblySummaryCache(smry, ASSEMBLY_SUMMARY_CACHE_DIR)
+        if force or cache.is_stale():
+            cache.build()
+
+
 @cli.command()
 @common_options
-def download(sci_name, genome_set_dir, threads):
-    """下载参考数据库. 线程参数用于解压, 不适用于下载."""
-    download_genome_files(sci_name, genome_set_dir, threads)
+@click.option("--customer-genome-dir", required=True, help="输入客户基因组目录, 支持 .fna 和 .fna.gz.")
+@click.option("--import-mode", type=click.Choice(IMPORT_MODES), default="copy", show_default=True,
+              help="导入方式. hardlink/reflink/symlink 不额外占用存储, .fna.gz 总是解压导入.")
+def load(customer_genome_dir, sci_name, genome_set_dir, threads, force, import_mode):
+    """接入客户基因组集, 格式化成符合项目结构的目录结构. 内容相同的基因组只导入一次."""
+    load_customer_genomes(customer_genome_dir, sci_name, genome_set_dir, threads, import_mode)
 
 
 @cli.command()
 @common_options
-@click.option("--customer-genome-dir", required=True, help="输入客户基因组目录.")
-def load(customer_genome_dir, sci_name, genome_set_dir, threads):
-    """接入客户基因组集, 格式化成符合项目结构的目录结构."""
-    load_customer_genomes(customer_genome_dir, sci_name, genome_set_dir, threads)
+@click.option("--ani", type=float, default=99.9, show_default=True, help="聚类 ANI 阈值 (%).")
+@click.option("--kmer", type=click.IntRange(1, 32), default=21, show_default=True, help="MinHash k-mer 长度.")
+@click.option("--sketch-size", type=int, default=1000, show_default=True, help="每个基因组的 MinHash 草图大小.")
+def dedup(sci_name, genome_set_dir, threads, force, ani, kmer, sketch_size):
+    """MinHash 近似去重, 近乎相同的基因组聚为一簇, 每簇保留一个代表基因组."""
+    gd = GenomeDeduplicator(
+        sci_name=sci_name,
+        genome_set_dir=genome_set_dir,
+        threads=threads,
+        force=force,
+        ani=ani,
+        kmer=kmer,
+        sketch_size=sketch_size
+    )
+    gd.run()
 
 
 @cli.command()
 @common_options
-def annotate(sci_name, genome_set_dir, threads, force):
+@changeset_option
+@representatives_option
+@click.option("--cache-dir", default=ANNOTATION_CACHE_DIR, show_default=True, help="注释结果共享缓存目录.")
+@click.option("--no-cache", is_flag=True, help="不使用注释缓存.")
+@click.option("--engine", type=click.Choice(ANNOTATE_ENGINES), default="prokka", show_default=True,
+              help="注释引擎. fast 只用 pyrodigal/barrnap/aragorn 预测基因和 rRNA/tRNA, 基因没有名称.")
+@click.option("--pathogen-type", type=click.Choice(["Bacteria", "Viruses"]), default="Bacteria", show_default=True, help="输入病原类型.")
+def annotate(sci_name, genome_set_dir, threads, force, changeset, representatives_only, cache_dir, no_cache, engine,
+             pathogen_type):
     """注释基因组"""
     ga = GenomeAnnotator(
         sci_name=sci_name,
         genome_set_dir=genome_set_dir,
         threads=threads,
-        force=force
+        force=force,
+        changeset=changeset,
+        representatives_only=representatives_only,
+        cache_dir=None if no_cache else cache_dir,
+        engine=engine,
+        kingdom=pathogen_type
     )
     ga.run()
 
 
 @cli.command()
 @common_options
+@changeset_option
+@representatives_option
 @click.option("--pathogen-type", type=click.Choice(["Bacteria", "Viruses"]), default="Bacteria", show_default=True, help="输入病原类型.")
-def assess(sci_name, genome_set_dir, pathogen_type, threads, force):
+@click.option("--memory-gb", type=float, default=CHECKM_MEMORY_BUDGET_GB, show_default=True,
+              help="checkM 内存预算 (GB), 据此决定同时运行的分片数和 pplacer 线程数.")
+@click.option("--checkv-batches", type=click.IntRange(min=0), default=CHECKV_BATCHES, show_default=True,
+              help="病毒基因组合并为几批运行 checkV, 0 表示每个基因组单独运行.")
+@click.option("--skip-outliers", is_flag=True,
+              help="组装统计 (大小, GC, contig 数, N 比例) 离群的基因组不运行 checkM/checkV, 见 genome_assess/assembly_stats.csv.")
+def assess(sci_name, genome_set_dir, pathogen_type, threads, force, changeset, representatives_only, memory_gb,
+           checkv_batches, skip_outliers):
     """质控评估"""
-    assessor_class = (
-        GenomeQualityAssessor
-        if pathogen_type == "Bacteria"
-        else GenomeQualityAssessorViruses
-    )
-    gqa = assessor_class(
+    params = dict(
         sci_name=sci_name,
         genome_set_dir=genome_set_dir,
         threads=threads,
-        force=force
+        force=force,
+        changeset=changeset,
+        representatives_only=representatives_only,
+        memory_gb=memory_gb,
+        skip_outliers=skip_outliers
     )
+    if pathogen_type == "Bacteria":
+        gqa = GenomeQualityAssessor(**params)
+    else:
+        gqa = GenomeQualityAssessorViruses(**params, checkv_batches=checkv_batches)
     gqa.run()
 
 
 @cli.command()
 @common_options
+@changeset_option
 @click.option("--core-isolates-percent", type=int, default=100, show_default=True, help="核心基因覆盖分离株百分比阈值.")
 @click.option("--blastp-identity", type=int, default=100, show_default=True, help="BlastP 相似度阈值")
-def conserved(sci_name, genome_set_dir, threads, force, core_isolates_percent, blastp_identity):
+@click.option("--weight-by-cluster", is_flag=True, help="按 dedup 聚类的簇大小加权计算核心基因覆盖比例.")
+@click.option("--keep-unnamed", is_flag=True, help="保留没有基因名的 group_* 基因, annotate --engine fast 的结果需要开启.")
+@click.option("--sweep-percent", "sweep_percents", type=click.FloatRange(0, 100), multiple=True,
+              help="额外输出该覆盖比例阈值下的核心单拷贝基因, 可多次指定, 结果在 conserved_gene/core_genome_sweep.tsv.")
+@click.option("--incremental", is_flag=True,
+              help="在上一次 Roary 结果上增量更新泛基因组, 新基因组的蛋白分配到已有簇, 不重新运行 Roary.")
+def conserved(sci_name, genome_set_dir, threads, force, changeset, core_isolates_percent, blastp_identity,
+              weight_by_cluster, keep_unnamed, sweep_percents, incremental):
     """保守区域预测"""
     cgp = ConservedGenePredictor(
         sci_name=sci_name,
@@ -85,7 +196,12 @@ def conserved(sci_name, genome_set_dir, threads, force, core_isolates_percent, b
         threads=threads,
         core_islt_perc=core_isolates_percent,
         core_blastp_idnt=blastp_identity,
-        force=force
+        force=force,
+        changeset=changeset,
+        weight_by_cluster=weight_by_cluster,
+        keep_unnamed=keep_unnamed,
+        sweep_percents=list(sweep_percents),
+        incremental=incremental
     )
     cgp.run()
 
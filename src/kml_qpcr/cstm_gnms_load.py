@@ -1,30 +1,123 @@
+import errno
+import gzip
+import hashlib
 import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from subprocess import run
+from subprocess import run, CalledProcessError
 
-from src.utils.util_command import multi_run_command
+import pandas as pd
 
+from src.kml_qpcr.gnm_catalog import GenomeCatalog
 
-def load_customer_genomes(cstm_gnm_dir: str, sci_name: str, gnm_set_dir: str, threads: int) -> None:
+# 客户基因组导入方式
+IMPORT_MODES = ["copy", "hardlink", "reflink", "symlink"]
+
+
+def load_customer_genomes(cstm_gnm_dir: str, sci_name: str, gnm_set_dir: str, threads: int,
+                          import_mode: str = "copy") -> None:
     """
     导入客户基因组集, 格式化成符合项目结构的目录结构.
+    支持 .fna 和 .fna.gz, 按内容 sha256 去重, 内容相同的基因组只导入一次, 所有提交名称记录在别名表 info/customer_genome_aliases.tsv
 
     :param cstm_gnm_dir: 客户基因组目录
     :param sci_name: 物种学名
     :param gnm_set_dir: 项目基因组集目录
+    :param threads: 线程数, 用于并行计算 sha256
+    :param import_mode: 导入方式 copy/hardlink/reflink/symlink. .fna.gz 总是解压导入
+    """
+    logging.info(f"开始导入客户基因组集: {cstm_gnm_dir}, 物种学名: {sci_name}, 基因组集目录: {gnm_set_dir}, 导入方式: {import_mode}")
+    gnm_dir = Path(gnm_set_dir) / sci_name.replace(" ", "_")
+    all_dir = gnm_dir / "all"
+    alias_file = gnm_dir / "info/customer_genome_aliases.tsv"
+    alias_file.parent.mkdir(parents=True, exist_ok=True)
+    fnas = sorted(list(Path(cstm_gnm_dir).glob("*.fna")) + list(Path(cstm_gnm_dir).glob("*.fna.gz")))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        digests = list(pool.map(sha256sum_genome, fnas))
+    # 之前导入过的基因组, 内容相同的沿用原 genome_id
+    if alias_file.exists():
+        alias_df = pd.read_csv(alias_file, sep="\t", dtype=str)
+    else:
+        alias_df = pd.DataFrame(columns=["sha256", "genome_id", "submitted_name", "source_path"])
+    gnm_ids = dict(zip(alias_df["sha256"], alias_df["genome_id"]))
+    # 已占用的 genome_id, 名称相同但内容不同的基因组 (如 A.fna 和 A.fna.gz, 或重新提交的修改版 A.fna) 不能覆盖原基因组
+    used_ids = set(gnm_ids.values())
+    new_aliases, records = [], []
+    try:
+        for fna, digest in zip(fnas, digests):
+            # 获取基因组名称
+            gnm_name = fna.name.removesuffix(".gz").removesuffix(".fna")
+            if digest not in gnm_ids:
+                gnm_id = gnm_name
+                if gnm_id in used_ids or (all_dir / gnm_id / f"{gnm_id}.fna").exists():
+                    gnm_id = f"{gnm_name}_{digest[:8]}"
+                    logging.warning(f"{fna} 与已有基因组 {gnm_name} 同名但内容不同, 以 {gnm_id} 导入")
+                gnm_ids[digest] = gnm_id
+                used_ids.add(gnm_id)
+                # 目标目录
+                target_dir = all_dir / gnm_id
+                target_dir.mkdir(parents=True, exist_ok=True)
+                used_mode = import_genome_file(fna, target_dir / f"{gnm_id}.fna", import_mode)
+                if used_mode != import_mode:
+                    logging.warning(f"目标文件系统不支持 {import_mode} 导入, 改为 {used_mode}")
+                    import_mode = used_mode
+                records.append((gnm_id, target_dir / f"{gnm_id}.fna", "customer", digest))
+            else:
+                logging.info(f"{fna} 与已导入的基因组 {gnm_ids[digest]} 内容相同, 只记录别名")
+            new_aliases.append([digest, gnm_ids[digest], gnm_name, str(fna.resolve())])
+    finally:
+        # 中途失败时也登记已导入的基因组
+        GenomeCatalog(gnm_dir).register_many(records)
+        alias_df = pd.concat([alias_df, pd.DataFrame(new_aliases, columns=alias_df.columns)], ignore_index=True)
+        alias_df.drop_duplicates(subset=["sha256", "submitted_name"], keep="last").to_csv(
+            alias_file, sep="\t", index=False)
+    logging.info(f"导入 {len(set(digests))} 个不重复的基因组, 共 {len(fnas)} 个文件")
+
+
+def sha256sum_genome(fna: Path) -> str:
+    """计算基因组内容的 sha256, .fna.gz 按解压后的内容计算"""
+    sha256 = hashlib.sha256()
+    opener = gzip.open if fna.name.endswith(".gz") else open
+    with opener(fna, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def import_genome_file(src: Path, dest: Path, import_mode: str) -> str:
+    """
+    按导入方式将基因组文件放到项目目录, 已存在的目标文件会被覆盖.
+    hardlink 跨文件系统 (EXDEV) 或 reflink 在不支持的文件系统 (如 ext4, NFS) 上失败时改为复制
+    :param src: 客户基因组文件
+    :param dest: 项目中的 fna 文件
+    :param import_mode: 导入方式 copy/hardlink/reflink/symlink
+    :return: 实际使用的导入方式
     """
-    logging.info(f"开始导入客户基因组集: {cstm_gnm_dir}, 物种学名: {sci_name}, 基因组集目录: {gnm_set_dir}")
-    all_dir = Path(gnm_set_dir) / sci_name.replace(" ", "_") / "all"
-    cmds = []
-    for fna in Path(cstm_gnm_dir).glob("*.fna"):
-        # 获取基因组名称
-        gnm_name = fna.stem
-        # 目标目录
-        target_dir = all_dir / gnm_name
-        target_dir.mkdir(parents=True, exist_ok=True)
-        # 复制文件到目标目录
-        copy_cmd = f"cp --force {fna} {target_dir}/{gnm_name}.fna"
-        cmds.append(copy_cmd)
-        # 执行所有复制命令
-    if cmds:
-        multi_run_command(cmds, threads=threads)
+    if dest.exists() or dest.is_symlink():
+        dest.unlink()
+    # 压缩文件无法链接, 直接解压
+    if src.name.endswith(".gz"):
+        with gzip.open(src, "rb") as fin, open(dest, "wb") as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        return import_mode
+    if import_mode == "hardlink":
+        try:
+            os.link(src, dest)
+            return import_mode
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif import_mode == "reflink":
+        try:
+            run(["cp", "--reflink=always", str(src), str(dest)], check=True, capture_output=True)
+            return import_mode
+        except CalledProcessError:
+            if dest.exists():
+                dest.unlink()
+    elif import_mode == "symlink":
+        dest.symlink_to(src.resolve())
+        return import_mode
+    shutil.copyfile(src, dest)
+    return "copy"
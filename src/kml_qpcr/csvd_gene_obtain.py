@@ -1,15 +1,24 @@
 from pathlib import Path
 from subprocess import run
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from functools import cached_property
 import logging
+import numpy as np
 import pandas as pd
 
 from src.kml_qpcr.base import BaseQPCR
-from src.config.cnfg_software import ACTIVATE, SEQKIT, SEQTK
-from src.utils.util_command import multi_run_command
+from src.kml_qpcr.stage_ledger import StageLedger
+from src.kml_qpcr.gene_store import GeneStore, write_gene_fasta
+from src.kml_qpcr.pangenome_index import PangenomeIndex, PresenceMatrix
+from src.kml_qpcr.pangenome_update import update_pangenome
+from src.utils.util_command import run_tool
 
 
 class ConservedGenePredictor(BaseQPCR):
-    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, core_islt_perc: int, core_blastp_idnt: int, force: bool):
+    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, core_islt_perc: int, core_blastp_idnt: int, force: bool,
+                 changeset: bool = False, weight_by_cluster: bool = False, keep_unnamed: bool = False,
+                 sweep_percents: list[float] | None = None, incremental: bool = False):
         """
         初始化保守基因预测器
         :sci_name: 目标微生物科学名
@@ -18,8 +27,13 @@ class ConservedGenePredictor(BaseQPCR):
         :core_islt_perc: 核心基因覆盖分离株百分比
         :core_blastp_idnt: 核心基因在分离株间相似度
         :force: 是否强制执行
+        :changeset: 是否只处理 refresh 变更集. 变更集非空时重新运行 Roary, 只拆分新增和变化基因组的基因
+        :weight_by_cluster: 是否按 dedup 聚类的簇大小加权计算核心基因覆盖比例
+        :keep_unnamed: 是否保留没有基因名的 group_* 基因, annotate --engine fast 的基因都没有名称
+        :sweep_percents: 额外输出这些核心基因覆盖比例阈值下的核心单拷贝基因, 如 [90, 95, 99, 100]
+        :incremental: 是否在上一次 Roary 结果上增量更新泛基因组, 不重新运行 Roary
         """
-        super().__init__(sci_name, genome_set_dir, threads, force)
+        super().__init__(sci_name, genome_set_dir, threads, force, changeset)
         self.core_islt_perc = core_islt_perc
         self.core_blastp_idnt = core_blastp_idnt
         # 保守基因目录
@@ -27,6 +41,11 @@ class ConservedGenePredictor(BaseQPCR):
         self.csvd_dir.mkdir(exist_ok=True, parents=True)
         # 高质量分离株列表
         self.hq_gnms = self.get_high_quality_genomes()
+        # 分离株权重, 默认均为 1
+        self.islt_weights = self.get_isolate_weights() if weight_by_cluster else {}
+        self.keep_unnamed = keep_unnamed
+        self.sweep_percents = sweep_percents or []
+        self.incremental = incremental
 
     def run(self):
         """保守基因预测"""
@@ -37,23 +56,33 @@ class ConservedGenePredictor(BaseQPCR):
         self.run_roary()
         # 筛选核心单拷贝基因
         core_sglcp_genes = self.filter_core_single_copy_gene()
-        # 拆分所有高质量分离株的基因序列
-        self.seqkit_split_isolates_ffn()
+        # 索引所有高质量分离株的基因序列
+        self.index_isolates_ffn()
         # 输出所有保守基因序列合集
-        self.output_conserved_gene_set(core_sglcp_genes)
+        length_df = self.output_conserved_gene_set(core_sglcp_genes)
         # 统计保守基因长度
-        self.calc_gene_length(core_sglcp_genes)
+        self.calc_gene_length(length_df)
 
     def get_high_quality_genomes(self) -> list[str]:
         """获取高质量分离株列表"""
         with open(self.gnm_dir / "genome_assess/high_quality_genomes.txt") as f:
             return f.read().splitlines()
 
+    def get_isolate_weights(self) -> dict[str, int]:
+        """代表基因组所在簇的大小, 作为计算核心基因覆盖比例时的权重"""
+        df = pd.read_csv(self.gnm_dir / "genome_dedup/clusters.tsv", sep="\t")
+        reps_df = df[df["genome_id"] == df["representative"]]
+        return dict(zip(reps_df["genome_id"], reps_df["cluster_size"]))
+
     def prepare_roary_input(self) -> None:
         """准备 Roary 输入文件, 使用筛选后的分离株"""
         # 复制 Roary 需要的 .gff 文件到 Roary 输入目录
         roary_indir = self.csvd_dir / "roary_input"
         roary_indir.mkdir(exist_ok=True, parents=True)
+        # 删除已不在高质量列表中的分离株, 如变更集中撤回的基因组
+        for gff in roary_indir.glob("*.gff"):
+            if gff.stem not in self.hq_gnms:
+                gff.unlink()
         for gnm in self.hq_gnms:
             run(f"cp {self.gnm_dir}/genome_annotate/{gnm}/{gnm}.gff {roary_indir}/{gnm}.gff",
                 shell=True, check=True)
@@ -65,108 +94,184 @@ class ConservedGenePredictor(BaseQPCR):
         - gene_presence_absence.Rtab: 基因和基因组的对照表, 筛选出核心基因
         """
         roary_dir = self.csvd_dir / "roary"
-        # 如果已经存在或非强制, 跳过
+        # 增量模式下已有结果时, 在上一次结果上更新
+        if (self.incremental and (not self.force) and roary_dir.joinpath("gene_presence_absence.Rtab").exists()
+                and roary_dir.joinpath("clustered_proteins").exists()):
+            self.update_roary_incremental()
+            return
+        # 如果已经存在或非强制, 跳过. 变更集非空时分离株集合已变化, 需要重新运行
         if (roary_dir.joinpath("gene_presence_absence.Rtab").exists() and
             roary_dir.joinpath("clustered_proteins").exists() and
-                (not self.force)):
+                (not self.force) and (not self.changeset)):
             logging.warning(f"Roary 已经运行过 {roary_dir}, 跳过.")
             return
         # 如果存在 Roary 结果目录无论是否完整, Roary 都会认为是已经运行过. 结果会生成到其他文件夹, 需要删除
         if roary_dir.exists():
             run(f"rm -r {roary_dir}", shell=True, check=True)
         # * [250603 FJH] 核心基因样本比例调整至 100%; 相似度也调整至 100%
-        cmd = f"""
-        source {ACTIVATE} meta
-        roary -p {self.threads} -cd {self.core_islt_perc} -i {self.core_blastp_idnt} {self.csvd_dir}/roary_input/*.gff -f {roary_dir}
-        conda deactivate
+        gffs = sorted(self.csvd_dir.joinpath("roary_input").glob("*.gff"))
+        run_tool("roary", ["-p", self.threads, "-cd", self.core_islt_perc, "-i", self.core_blastp_idnt,
+                           *gffs, "-f", roary_dir])
+
+    @cached_property
+    def pan_index(self) -> PangenomeIndex:
+        """Roary clustered_proteins 索引, 各保守基因步骤共用"""
+        return PangenomeIndex.load(self.csvd_dir / "roary")
+
+    @cached_property
+    def gene_coverage(self) -> pd.DataFrame:
         """
-        logging.debug(cmd)
-        run(cmd, shell=True, check=True, executable="/bin/bash")
+        每个基因的覆盖比例和拷贝情况, 各阈值共用
+        :return: 以基因名为索引, 列为 rtab_cover (Rtab 覆盖比例 %), pan_cover (clustered_proteins 覆盖比例 %),
+            single_copy (是否单拷贝)
+        """
+        # 基因存在缺失位矩阵, 分离株权重未使用 --weight-by-cluster 时均为 1
+        presence = PresenceMatrix.load(self.csvd_dir / "roary/gene_presence_absence.Rtab")
+        rtab_df = pd.DataFrame({"rtab_cover": presence.coverage(self.islt_weights)}, index=presence.genes)
+        total_weight = sum(self.islt_weights.get(islt, 1) for islt in presence.isolates)
+        pan_index = self.pan_index
+        islt_weights = np.array([self.islt_weights.get(islt, 1) for islt in pan_index.isolates], dtype=float)
+        pan_df = pd.DataFrame({"pan_cover": pan_index.isolate_counts(islt_weights) / total_weight * 100,
+                               "single_copy": pan_index.single_copy()}, index=pan_index.genes)
+        return rtab_df.join(pan_df, how="inner")
 
-    def filter_core_single_copy_gene(self) -> list[str]:
+    def core_single_copy_genes(self, core_islt_perc: float) -> list[str]:
         """
-        过滤核心单拷贝基因. 1. 覆盖超过阈值的核心基因; 2. 单拷贝基因; 3. 有名称的基因 (删掉group_*)
-        :return: 核心单拷贝基因列表
+        核心单拷贝基因. 1. 覆盖超过阈值的核心基因; 2. 单拷贝基因; 3. 有名称的基因 (删掉group_*)
+        :param core_islt_perc: 核心基因覆盖分离株百分比阈值
         """
-        # 基因存在缺失矩阵
-        df = pd.read_table(self.csvd_dir / "roary/gene_presence_absence.Rtab",
-                           sep='\t', index_col=0)
-        # 1. 覆盖超过阈值的核心基因
-        core_genes = df[df.apply(lambda x: x.sum() / len(x) * 100, axis=1)
-                        >= self.core_islt_perc].index.tolist()
-        # 分离株总数
-        islt_count = df.shape[1]
-        # 2. 单拷贝基因
-        sglcp_genes = []
-        # 核心基因明细文件
-        with open(self.csvd_dir / "roary/clustered_proteins") as f:
-            for line in f:
-                gene, gene_cntt = line.strip().split(': ')
-                islts = ["_".join(gid.split("_")[:2]) for gid in gene_cntt.split("\t")]
-                # 基因数大于分离株总数 或 基因占比小于核心基因占比
-                if (len(islts) > islt_count) or (len(islts) / islt_count * 100 < self.core_islt_perc):
-                    continue
-                # 基因数等于分离株总数, 但不是单拷贝
-                if len(islts) != len(set(islts)):
-                    continue
-                sglcp_genes.append(gene)
-        # 1&2 核心单拷贝基因列表
-        core_sglcp_itsct = list(set(core_genes).intersection(set(sglcp_genes)))
-        # 3. 有名称的基因 (删掉group_*)
+        df = self.gene_coverage
+        # 1&2 覆盖比例达到阈值, 且在覆盖的分离株中均为单拷贝
+        core_sglcp_itsct = df.index[(df["rtab_cover"] >= core_islt_perc) & (df["pan_cover"] >= core_islt_perc)
+                                    & df["single_copy"]]
+        # 3. 有名称的基因 (删掉group_*, --keep-unnamed 时保留)
         # ! 基因名有路径分隔符号 '/', 引起报错. 例如 pgk/tpi.
         core_sglcp_genes = []
         for gene in core_sglcp_itsct:
-            if gene.startswith("group_") or ("/" in gene):
+            if (gene.startswith("group_") and not self.keep_unnamed) or ("/" in gene):
                 continue
             core_sglcp_genes.append(gene)
+        return core_sglcp_genes
+
+    def update_roary_incremental(self) -> None:
+        """
+        增量更新泛基因组: 与上一次 Roary 的分离株比较, 删除移除和变化的分离株,
+        新增和变化分离株的蛋白按 k-mer 分配到已有簇, 其余蛋白用 cd-hit 聚类为新簇
+        """
+        roary_dir = self.csvd_dir / "roary"
+        previous = set(PresenceMatrix.load(roary_dir / "gene_presence_absence.Rtab").isolates)
+        hq_gnms = set(self.hq_gnms)
+        changed = self.delta_genomes() & previous
+        removed = (previous - hq_gnms) | changed
+        added = sorted((hq_gnms - previous) | (changed & hq_gnms))
+        if not removed and not added:
+            logging.warning(f"分离株没有变化, 跳过泛基因组增量更新 {roary_dir}.")
+            return
+        annotate_dir = self.gnm_dir / "genome_annotate"
+        update_pangenome(
+            roary_dir, removed, added, sorted(hq_gnms),
+            faas={gnm: annotate_dir / gnm / f"{gnm}.faa" for gnm in previous | hq_gnms},
+            feat_files={gnm: annotate_dir / gnm / f"{gnm}.tsv" for gnm in added},
+            identity=self.core_blastp_idnt / 100, threads=self.threads)
+
+    def filter_core_single_copy_gene(self) -> list[str]:
+        """
+        按 --core-isolates-percent 过滤核心单拷贝基因, 指定 --sweep-percents 时同时输出各阈值的结果
+        :return: 核心单拷贝基因列表
+        """
+        core_sglcp_genes = self.core_single_copy_genes(self.core_islt_perc)
         with open(self.csvd_dir / "core_single_copy_genes.txt", "w") as f:
             f.write("\n".join(core_sglcp_genes))
+        if self.sweep_percents:
+            self.sweep_core_genome()
         return core_sglcp_genes
 
-    def seqkit_split_isolates_ffn(self):
-        """Seqkit 按照序列 ID 拆分所有高质量基因组注释基因文件 .ffn"""
-        all_genes_dir = self.csvd_dir / "all_genes"
-        all_genes_dir.mkdir(exist_ok=True, parents=True)
-        # 是否强制执行
-        if len(list(all_genes_dir.iterdir())) >= len(self.hq_gnms) and not self.force:
-            logging.warning(f"Seqkit 已拆分完所有分离株基因 {all_genes_dir}, 跳过.")
-            return
-        cmds = []
-        for gnm in self.hq_gnms:
-            cmd = f"{SEQKIT} split --force --by-id --by-id-prefix '' {self.gnm_dir}/genome_annotate/{gnm}/{gnm}.ffn -O {all_genes_dir}/{gnm}"
-            cmds.append(cmd)
-        multi_run_command(cmds, self.threads)
+    def sweep_core_genome(self) -> None:
+        """各覆盖比例阈值下的核心基因数和核心单拷贝基因, 结果写入 core_genome_sweep.tsv 和 core_sweep/ 目录"""
+        sweep_dir = self.csvd_dir / "core_sweep"
+        sweep_dir.mkdir(exist_ok=True, parents=True)
+        df = self.gene_coverage
+        rows = []
+        for perc in sorted(self.sweep_percents):
+            core_sglcp_genes = self.core_single_copy_genes(perc)
+            with open(sweep_dir / f"core_single_copy_genes_{perc:g}.txt", "w") as f:
+                f.write("\n".join(core_sglcp_genes))
+            rows.append([perc, int((df["rtab_cover"] >= perc).sum()), len(core_sglcp_genes)])
+        sweep_df = pd.DataFrame(rows, columns=["core_isolates_percent", "core_genes", "core_single_copy_genes"])
+        sweep_df.to_csv(self.csvd_dir / "core_genome_sweep.tsv", sep="\t", index=False)
+        logging.info(f"核心基因阈值曲线:\n{sweep_df.to_string(index=False)}")
+
+    def index_isolates_ffn(self):
+        """为所有高质量基因组注释基因文件 .ffn 建立字节偏移索引"""
+        store = GeneStore(self.csvd_dir / "gene_index")
+        ledger = StageLedger(self.ledger_dir, "gene_index")
+        gnms = self.hq_gnms
+        if self.changeset is not None:
+            # 删除撤回和变化基因组的旧索引, 变化的基因组随后重新索引
+            for gnm in self.withdrawn_genomes() | self.delta_genomes():
+                store.index_file(gnm).unlink(missing_ok=True)
+                ledger.invalidate(gnm)
+        # 是否强制执行, 否则只索引没有完成或 ffn 有变化的高质量基因组
+        if not self.force:
+            gnms = [gnm for gnm in gnms
+                    if not ledger.is_done(gnm, [self.annotated_ffn(gnm)], [store.index_file(gnm)])]
+            if not gnms:
+                logging.warning(f"已索引所有分离株基因 {store.index_dir}, 跳过.")
+                return
+
+        def _index(gnm: str) -> None:
+            ffn = self.annotated_ffn(gnm)
+            store.build(gnm, ffn)
+            ledger.mark_done(gnm, [ffn], [store.index_file(gnm)])
 
-    def output_conserved_gene_set(self, core_sglcp_genes: list[str]):
-        """输出保守基因序列合集"""
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(_index, gnms))
+
+    def annotated_ffn(self, gnm: str) -> Path:
+        """prokka 注释的基因序列文件"""
+        return self.gnm_dir / "genome_annotate" / gnm / f"{gnm}.ffn"
+
+    def output_conserved_gene_set(self, core_sglcp_genes: list[str]) -> pd.DataFrame:
+        """
+        按索引从各分离株 .ffn 读取序列, 进程池并行输出保守基因序列合集, 同时统计序列长度
+        :return: 序列长度长表, 列为 gene, isolate, length, 同时写入 gene_lengths.tsv
+        """
         # 保守基因序列合集目录
         csvd_gene_set_dir = self.csvd_dir / "csvd_gene_seq_set"
         csvd_gene_set_dir.mkdir(exist_ok=True, parents=True)
-        cat_cmds = []
-        with open(self.csvd_dir / "roary/clustered_proteins") as f:
-            for line in f:
-                gene, gene_cntt = line.strip().split(': ')
-                # 是否为单拷贝核心基因
-                if gene in core_sglcp_genes:
-                    cat_files = []
-                    for gnid in gene_cntt.split("\t"):
-                        isltid = "_".join(gnid.split("_")[:2])
-                        cat_files.append(f"{self.csvd_dir}/all_genes/{isltid}/{gnid}.ffn")
-                    cmd = f"cat {' '.join(cat_files)} > {csvd_gene_set_dir}/{gene}.ffn && " \
-                        f"{SEQTK} comp {csvd_gene_set_dir}/{gene}.ffn > {csvd_gene_set_dir}/{gene}.ffn.comp.tsv"
-                    cat_cmds.append(cmd)
-        multi_run_command(cat_cmds, self.threads)
-
-    def calc_gene_length(self, core_sglcp_genes: list[str]):
-        """统计保守基因长度. 中位数,极差,标准差,变异系数"""
-        gene_length_stats_mat = []
-        for gene in core_sglcp_genes:
-            comp_file = self.csvd_dir / "csvd_gene_seq_set" / f"{gene}.ffn.comp.tsv"
-            df = pd.read_table(comp_file, sep="\t", header=None, usecols=[1])
-            gl = df.iloc[:, 0]
-            gene_length_stats_mat.append(
-                # 基因名, 中位数, 极差, 标准差, 变异系数
-                [gene, gl.median(), gl.max() - gl.min(), gl.std(), gl.std() / gl.mean()])
-        odf = pd.DataFrame(gene_length_stats_mat, columns=["gene", "median", "range", "std", "cv"])
+        store = GeneStore(self.csvd_dir / "gene_index")
+        records = store.load(self.hq_gnms, {gnm: self.annotated_ffn(gnm) for gnm in self.hq_gnms})
+        pan_index = self.pan_index
+        jobs = [(csvd_gene_set_dir / f"{gene}.ffn", [records[locus] for locus in pan_index.gene_loci(gene)])
+                for gene in core_sglcp_genes]
+        with Pool(processes=self.threads) as pool:
+            seq_lengths = pool.starmap(write_gene_fasta, jobs, chunksize=max(1, len(jobs) // (self.threads * 4)))
+        # 长表: 基因编码, 分离株编码, 序列长度
+        gene_codes = np.array([pan_index.gene_codes[gene] for gene in core_sglcp_genes], dtype=np.int64)
+        counts = np.array([len(lengths) for lengths in seq_lengths], dtype=np.int64)
+        islt_codes = np.concatenate([pan_index.gene_isolates(gene) for gene in core_sglcp_genes] or [np.empty(0)])
+        length_df = pd.DataFrame({
+            "gene": pd.Categorical.from_codes(np.repeat(gene_codes, counts), categories=pan_index.genes),
+            "isolate": pd.Categorical.from_codes(islt_codes.astype(np.int64), categories=pan_index.isolates),
+            "length": np.concatenate(seq_lengths or [[]]).astype(np.int64),
+        })
+        length_df.to_csv(self.csvd_dir / "gene_lengths.tsv", sep="\t", index=False)
+        return length_df
+
+    def calc_gene_length(self, length_df: pd.DataFrame):
+        """
+        统计保守基因长度. 中位数,极差,标准差,变异系数
+        :param length_df: output_conserved_gene_set 输出的长表, 列为 gene, isolate, length
+        """
+        stats = length_df.groupby("gene", observed=True, sort=False)["length"].agg(
+            ["median", "min", "max", "std", "mean"])
+        # 基因名, 中位数, 极差, 标准差, 变异系数
+        odf = pd.DataFrame({
+            "gene": stats.index.astype(str),
+            "median": stats["median"].to_numpy(),
+            "range": (stats["max"] - stats["min"]).to_numpy(),
+            "std": stats["std"].to_numpy(),
+            "cv": (stats["std"] / stats["mean"]).to_numpy(),
+        })
         odf.to_csv(self.csvd_dir / "gene_length_stat.csv", index=False)
         odf.to_excel(self.csvd_dir / "gene_length_stat.xlsx", index=False)
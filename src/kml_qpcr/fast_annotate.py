@@ -0,0 +1,150 @@
+from pathlib import Path
+import re
+
+from src.utils.util_command import run_tool
+
+# barrnap --kingdom 参数
+BARRNAP_KINGDOMS = {"Bacteria": "bac"}
+# aragorn -w 输出的 tRNA 行, 例 "1   tRNA-Ala   c[1234,1309]   35   (tgc)"
+_ARAGORN_TRNA = re.compile(r"^\d+\s+tRNA-(\S+)\s+(c?)\[(-?\d+),(\d+)\]\s+\d+\s+\((\w+)\)")
+_COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+# gff 第二列, 与 prokka 一致标明预测软件
+_FEATURE_SOURCES = {"rRNA": "barrnap", "tRNA": "Aragorn"}
+
+
+def fast_annotate_genome(fna: Path, out_dir: Path, gnm_id: str, kingdom: str = "Bacteria") -> None:
+    """
+    快速注释单个基因组, 只生成下游需要的结果: pyrodigal 预测 CDS, barrnap 预测 rRNA, aragorn 预测 tRNA.
+    输出与 prokka 格式兼容的 .gff (含 ##FASTA), .ffn, .faa, .tsv 和 .txt, locus tag 为 {gnm_id}_00001.
+    CDS 不做功能注释, 产物均为 hypothetical protein, 没有基因名. 病毒只预测 CDS (metagenomic 模式).
+    :param fna: 基因组 fna 文件
+    :param out_dir: 输出目录
+    :param gnm_id: 基因组 id, 即文件前缀和 locus tag 前缀
+    :param kingdom: Bacteria/Viruses
+    :raises RuntimeError: 没有安装 pyrodigal
+    """
+    try:
+        import pyrodigal
+    except ImportError:
+        raise RuntimeError("--engine fast 需要安装 pyrodigal: pip install pyrodigal")
+    contigs = read_fasta(fna)
+    total = sum(len(seq) for seq in contigs.values())
+    # 序列太短训练不准确 (prodigal 建议至少 100 kb), 使用 metagenomic 模式
+    meta = kingdom == "Viruses" or total < 100000
+    finder = pyrodigal.GeneFinder(meta=meta)
+    if not meta:
+        finder.train(*(seq.encode() for seq in contigs.values()))
+    # 特征: (contig, start, end, strand, ftype, gene, product, 蛋白序列)
+    rnas = []
+    if kingdom in BARRNAP_KINGDOMS:
+        rnas = predict_rrna(fna, BARRNAP_KINGDOMS[kingdom]) + predict_trna(fna)
+    features = list(rnas)
+    for contig, seq in contigs.items():
+        for gene in finder.find_genes(seq.encode()):
+            # 与 prokka 一样去掉和 RNA 重叠的 CDS
+            if any(r[0] == contig and gene.begin <= r[2] and r[1] <= gene.end for r in rnas):
+                continue
+            features.append((contig, gene.begin, gene.end, "+" if gene.strand == 1 else "-", "CDS", "",
+                             "hypothetical protein", gene.translate(include_stop=False)))
+    order = {contig: i for i, contig in enumerate(contigs)}
+    features.sort(key=lambda feat: (order[feat[0]], feat[1]))
+    write_prokka_outputs(out_dir, gnm_id, contigs, features, "pyrodigal:" + pyrodigal.__version__)
+
+
+def read_fasta(fna: Path) -> dict[str, str]:
+    """读取 fasta, 返回序列 id -> 大写序列"""
+    contigs, name, lines = {}, None, []
+    with open(fna) as f:
+        for line in f:
+            if line.startswith(">"):
+                if name is not None:
+                    contigs[name] = "".join(lines).upper()
+                name, lines = line[1:].split()[0], []
+            else:
+                lines.append(line.strip())
+    if name is not None:
+        contigs[name] = "".join(lines).upper()
+    return contigs
+
+
+def predict_rrna(fna: Path, kingdom: str) -> list[tuple]:
+    """barrnap 预测 rRNA"""
+    res = run_tool("barrnap", ["--kingdom", kingdom, "--threads", 1, "--quiet", fna], capture_output=True, text=True)
+    rnas = []
+    for line in res.stdout.splitlines():
+        if line.startswith("#"):
+            continue
+        fields = line.split("\t")
+        attrs = dict(item.split("=", 1) for item in fields[8].split(";") if "=" in item)
+        rnas.append((fields[0], int(fields[3]), int(fields[4]), fields[6], "rRNA", "",
+                     attrs.get("product", attrs.get("Name", "")), ""))
+    return rnas
+
+
+def predict_trna(fna: Path) -> list[tuple]:
+    """aragorn 预测 tRNA, 跨越序列首尾的 tRNA 丢弃"""
+    res = run_tool("aragorn", ["-l", "-gc11", "-t", "-w", fna], capture_output=True, text=True)
+    rnas, contig = [], None
+    for line in res.stdout.splitlines():
+        if line.startswith(">"):
+            contig = line[1:].split()[0]
+            continue
+        match = _ARAGORN_TRNA.match(line.strip())
+        if match is None:
+            continue
+        aa, comp, start, end, anticodon = match.groups()
+        if int(start) < 1 or int(end) < int(start):
+            continue
+        rnas.append((contig, int(start), int(end), "-" if comp else "+", "tRNA", "",
+                     f"tRNA-{aa}({anticodon})", ""))
+    return rnas
+
+
+def write_prokka_outputs(out_dir: Path, gnm_id: str, contigs: dict[str, str], features: list[tuple],
+                         source: str) -> None:
+    """
+    写出 prokka 格式的结果文件
+    :param out_dir: 输出目录
+    :param gnm_id: 文件前缀和 locus tag 前缀
+    :param contigs: 序列 id -> 序列
+    :param features: 按位置排序的特征列表
+    :param source: CDS 预测软件, gff 第二列
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    prefix = out_dir / gnm_id
+    counts = {}
+    with open(f"{prefix}.gff", "w") as gff, open(f"{prefix}.ffn", "w") as ffn, \
+            open(f"{prefix}.faa", "w") as faa, open(f"{prefix}.tsv", "w") as tsv:
+        gff.write("##gff-version 3\n")
+        for contig, seq in contigs.items():
+            gff.write(f"##sequence-region {contig} 1 {len(seq)}\n")
+        tsv.write("locus_tag\tftype\tlength_bp\tgene\tEC_number\tCOG\tproduct\n")
+        for i, (contig, start, end, strand, ftype, gene, product, protein) in enumerate(features, 1):
+            locus_tag = f"{gnm_id}_{i:05d}"
+            counts[ftype] = counts.get(ftype, 0) + 1
+            phase = "0" if ftype == "CDS" else "."
+            feat_source = _FEATURE_SOURCES.get(ftype, source)
+            gff.write(f"{contig}\t{feat_source}\tgene\t{start}\t{end}\t.\t{strand}\t.\t"
+                      f"ID={locus_tag}_gene;locus_tag={locus_tag}\n")
+            gff.write(f"{contig}\t{feat_source}\t{ftype}\t{start}\t{end}\t.\t{strand}\t{phase}\t"
+                      f"ID={locus_tag};Parent={locus_tag}_gene;locus_tag={locus_tag};product={product}\n")
+            nucl = contigs[contig][start - 1:end]
+            if strand == "-":
+                nucl = nucl.translate(_COMPLEMENT)[::-1]
+            ffn.write(f">{locus_tag} {product}\n{wrap(nucl)}")
+            if protein:
+                faa.write(f">{locus_tag} {product}\n{wrap(protein)}")
+            tsv.write(f"{locus_tag}\t{ftype}\t{len(nucl)}\t{gene}\t\t\t{product}\n")
+        # Roary 需要 gff 末尾带序列
+        gff.write("##FASTA\n")
+        for contig, seq in contigs.items():
+            gff.write(f">{contig}\n{wrap(seq)}")
+    with open(f"{prefix}.txt", "w") as f:
+        f.write(f"contigs: {len(contigs)}\nbases: {sum(len(seq) for seq in contigs.values())}\n")
+        for ftype, count in sorted(counts.items()):
+            f.write(f"{ftype}: {count}\n")
+
+
+def wrap(seq: str, width: int = 60) -> str:
+    """按固定宽度换行"""
+    return "".join(seq[i:i + width] + "\n" for i in range(0, len(seq), width))
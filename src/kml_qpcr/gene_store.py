@@ -0,0 +1,88 @@
+from pathlib import Path
+import os
+
+# 索引文件的列: 序列 id, 记录 (含序列头) 在 fasta 中的字节偏移和字节长度
+GENE_INDEX_COLUMNS = ["id", "offset", "length"]
+
+
+class GeneStore():
+    def __init__(self, index_dir: Path):
+        """
+        基因序列库. 类似 samtools faidx, 为每个基因组的 .ffn 建一次字节偏移索引,
+        按索引直接从 .ffn 读取序列记录, 不再把每个基因拆成单独的文件
+        :param index_dir: 索引目录, 每个基因组一个 {gnm}.idx
+        """
+        self.index_dir = Path(index_dir)
+
+    def index_file(self, gnm: str) -> Path:
+        return self.index_dir / f"{gnm}.idx"
+
+    def build(self, gnm: str, ffn: Path) -> None:
+        """
+        扫描 .ffn 建立索引, 先写临时文件再原子替换
+        :param gnm: 基因组 id
+        :param ffn: 基因序列文件
+        """
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file(gnm).with_suffix(".idx.tmp")
+        with open(tmp_file, "w") as out:
+            out.write("\t".join(GENE_INDEX_COLUMNS) + "\n")
+            for seq_id, offset, length in scan_fasta_records(ffn):
+                out.write(f"{seq_id}\t{offset}\t{length}\n")
+        os.replace(tmp_file, self.index_file(gnm))
+
+    def load(self, gnms: list[str], ffns: dict[str, Path]) -> dict[str, tuple[str, int, int]]:
+        """
+        读取多个基因组的索引
+        :param gnms: 基因组 id 列表
+        :param ffns: 基因组 id -> .ffn 文件
+        :return: 序列 id (prokka locus tag, 各基因组唯一) -> (.ffn 路径, 偏移, 长度)
+        """
+        records = {}
+        for gnm in gnms:
+            ffn = str(ffns[gnm])
+            with open(self.index_file(gnm)) as f:
+                next(f)
+                for line in f:
+                    seq_id, offset, length = line.rstrip("\n").split("\t")
+                    records[seq_id] = (ffn, int(offset), int(length))
+        return records
+
+
+def scan_fasta_records(fasta: Path):
+    """
+    逐行扫描 fasta, 生成每条记录的 (序列 id, 字节偏移, 字节长度)
+    :param fasta: fasta 文件
+    """
+    seq_id, start, offset = None, 0, 0
+    with open(fasta, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if seq_id is not None:
+                    yield seq_id, start, offset - start
+                seq_id, start = line[1:].split(maxsplit=1)[0].decode(), offset
+            offset += len(line)
+    if seq_id is not None:
+        yield seq_id, start, offset - start
+
+
+def write_gene_fasta(out_file: Path, records: list[tuple[str, int, int]]) -> list[int]:
+    """
+    按索引从各 .ffn 读取记录, 写入一个基因的序列合集, 同时统计序列长度. 先写临时文件再原子替换
+    :param out_file: 输出 fasta
+    :param records: [(.ffn 路径, 偏移, 长度)], 按输出顺序
+    :return: 每条记录的序列长度, 顺序与 records 相同
+    """
+    tmp_file = out_file.with_name(f".{out_file.name}.tmp")
+    seq_lengths = []
+    with open(tmp_file, "wb") as out:
+        for ffn, offset, length in records:
+            with open(ffn, "rb") as f:
+                f.seek(offset)
+                record = f.read(length)
+            out.write(record if record.endswith(b"\n") else record + b"\n")
+            # 序列头之后除换行符外的字节数
+            seq = record[record.find(b"\n") + 1:] if b"\n" in record else b""
+            seq_lengths.append(len(seq) - seq.count(b"\n") - seq.count(b"\r"))
+    os.replace(tmp_file, out_file)
+    return seq_lengths
@@ -1,48 +1,206 @@
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import shutil
 
 from src.kml_qpcr.base import BaseQPCR
-from src.config.cnfg_software import ACTIVATE
-from src.utils.util_command import multi_run_command
+from src.kml_qpcr.anno_cache import AnnotationCache
+from src.kml_qpcr.stage_ledger import StageLedger
+from src.kml_qpcr.cstm_gnms_load import sha256sum_genome
+from src.config.cnfg_software import PROKKA_MAX_CPU
+from src.config.cnfg_database import ANNOTATION_CACHE_MAX_BYTES
+from src.kml_qpcr.fast_annotate import fast_annotate_genome
+from src.utils.util_command import schedule_run_commands, run_tool, tool_command
+
+# 注释引擎: prokka 完整注释; fast 只预测基因和 rRNA/tRNA, 生成下游需要的文件
+ANNOTATE_ENGINES = ["prokka", "fast"]
+# 下游步骤用到的 prokka 结果, 记录校验和
+PROKKA_OUTPUT_SUFFIXES = [".gff", ".ffn", ".faa", ".tsv"]
 
 
 class GenomeAnnotator(BaseQPCR):
-    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool):
+    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool, changeset: bool = False,
+                 representatives_only: bool = False, cache_dir: str | None = None, engine: str = "prokka",
+                 kingdom: str = "Bacteria"):
         """
         注释基因组.
         :param sci_name: 物种学名.
         :param genome_set_dir: 基因组集目录.
         :param threads: 全局线程数.
         :param force: 是否强制重新运行 prokka, 默认识别到结果文件就跳过.
+        :param changeset: 是否只注释 refresh 变更集中新增和变化的基因组.
+        :param representatives_only: 是否只注释 dedup 聚类得到的代表基因组.
+        :param cache_dir: 注释结果共享缓存目录, 为 None 时不使用缓存. 只用于 prokka 引擎.
+        :param engine: 注释引擎 prokka/fast.
+        :param kingdom: 病原类型 Bacteria/Viruses.
         """
-        super().__init__(sci_name, genome_set_dir, threads, force)
+        super().__init__(sci_name, genome_set_dir, threads, force, changeset, representatives_only)
+        self.cache_dir = cache_dir
+        self.engine = engine
+        self.kingdom = kingdom
+        # 影响 prokka 结果的参数, 同时作为注释缓存键的一部分
+        self.prokka_params = ["--kingdom", kingdom, "--addgenes"]
+        # 两种引擎的结果分别记录, 切换引擎后重新注释
+        self.ledger = StageLedger(self.ledger_dir, "prokka" if engine == "prokka" else "fast_annotate")
         # 存放注释结果的文件夹
         self.gnm_annt_dir = self.gnm_dir / "genome_annotate"
         self.gnm_annt_dir.mkdir(parents=True, exist_ok=True)
 
     def run(self) -> None:
-        logging.info(f"开始注释基因组: {self.gnm_dir}, 线程数: {self.threads}, 强制重新运行: {self.force}")
-        # 运行 prokka
-        self.run_prokka()
+        logging.info(f"开始注释基因组: {self.gnm_dir}, 引擎: {self.engine}, 线程数: {self.threads}, "
+                     f"强制重新运行: {self.force}")
+        if self.engine == "fast":
+            self.run_fast()
+        else:
+            self.run_prokka()
+        # 完成状态以账本为准, 同步到基因组目录
+        done = [fna.parent.name for fna in self.genome_fnas() if self.ledger.marker(fna.parent.name).exists()]
+        self.catalog.set_stage(done, "annotate", self.engine)
+
+    def select_genomes(self) -> list[Path]:
+        """需要注释的基因组, 按代表基因组和变更集筛选"""
+        fnas = self.genome_fnas()
+        if self.changeset is not None:
+            # 只注释变更集中新增和变化的基因组, 删除撤回基因组的注释结果
+            for gnm_id in self.withdrawn_genomes():
+                shutil.rmtree(self.gnm_annt_dir / gnm_id, ignore_errors=True)
+                self.ledger.invalidate(gnm_id)
+            fnas = [fna for fna in fnas if fna.parent.name in self.delta_genomes()]
+            logging.info(f"变更集中需要注释的基因组数: {len(fnas)}")
+        return fnas
+
+    def run_fast(self) -> None:
+        """快速注释, pyrodigal 在线程池中并行预测基因"""
+        fnas = self.select_genomes()
+        if not self.force:
+            fnas = [fna for fna in fnas if not self.ledger.is_done(
+                fna.parent.name, [fna], prokka_outputs(self.gnm_annt_dir, fna.parent.name))]
+            if not fnas:
+                logging.warning("快速注释已经运行完成, 跳过注释.")
+                return
+        logging.info(f"快速注释基因组数: {len(fnas)}")
+
+        def _annotate(fna: Path) -> None:
+            gnm_id = fna.parent.name
+            # 输出目录可能是缓存的硬链接, 先删除
+            shutil.rmtree(self.gnm_annt_dir / gnm_id, ignore_errors=True)
+            fast_annotate_genome(fna, self.gnm_annt_dir / gnm_id, gnm_id, self.kingdom)
+            self.ledger.mark_done(gnm_id, [fna], prokka_outputs(self.gnm_annt_dir, gnm_id))
+
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(_annotate, fnas))
 
     def run_prokka(self):
         """使用 Prokka 进行基因组注释."""
-        # 当前物种目录下 all 文件夹
-        all_dir = self.gnm_dir / "all"
-        # 如果不是强制重新运行, 并且 prokka 已经运行完成, 则跳过注释
-        gff_count = len(list(self.gnm_annt_dir.glob("*/*.gff")))
-        fna_count = len(list(all_dir.glob("*/*.fna")))
-        if (not self.force) and (gff_count >= fna_count):
-            logging.warning("Prokka 已经运行完成, 跳过注释.")
+        fnas = self.select_genomes()
+        # 如果不是强制重新运行, 只注释没有完成或输入输出有变化的基因组
+        if not self.force:
+            fnas = [fna for fna in fnas if not prokka_is_complete(self.gnm_annt_dir, fna)]
+            if not fnas:
+                logging.warning("Prokka 已经运行完成, 跳过注释.")
+                return
+            logging.info(f"需要注释的基因组数: {len(fnas)}")
+        if self.cache_dir is None:
+            self.schedule_prokka(fnas)
             return
-        # 批量运行 prokka
-        # 和后面统一不用 PARALELL 用 multiprocessing.Pool 替代
-        prk_cmds = []
-        for fna in all_dir.glob("*/*.fna"):
+        # 命中缓存的基因组直接取结果, 其余运行 prokka 后存入缓存
+        # prokka --version 输出到 stderr
+        res = run_tool("prokka", ["--version"], capture_output=True, text=True)
+        version = (res.stdout + res.stderr).strip()
+        cache = AnnotationCache(self.cache_dir, ANNOTATION_CACHE_MAX_BYTES, f"{version} {' '.join(self.prokka_params)}")
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            digests = list(pool.map(sha256sum_genome, fnas))
+        self.catalog.set_sha256({fna.parent.name: digest for fna, digest in zip(fnas, digests)})
+        misses = []
+        for fna, digest in zip(fnas, digests):
             gnm_id = fna.parent.name
-            # ! Roary 需要每个 GFF 文件 basename 不同. Error: GFF files must have unique basenames
-            prk_cmd = f"source {ACTIVATE} meta && prokka --cpu 1 --force --prefix {gnm_id} --outdir {self.gnm_annt_dir}/{gnm_id} --kingdom Bacteria --addgenes --quiet --locustag {gnm_id} {fna} && conda deactivate"
-            prk_cmds.append(prk_cmd)
-        multi_run_command(prk_cmds, self.threads)
+            if self.force or not cache.materialize(digest, self.gnm_annt_dir / gnm_id, gnm_id):
+                misses.append((fna, digest))
+            else:
+                self.ledger.mark_done(gnm_id, [fna], prokka_outputs(self.gnm_annt_dir, gnm_id))
+        logging.info(f"注释缓存命中 {len(fnas) - len(misses)} 个基因组, 需要运行 prokka {len(misses)} 个")
+        try:
+            self.schedule_prokka([fna for fna, _ in misses])
+        finally:
+            # 只缓存成功的结果
+            for fna, digest in misses:
+                gnm_id = fna.parent.name
+                if prokka_log_complete(self.gnm_annt_dir / gnm_id, gnm_id):
+                    cache.store(digest, self.gnm_annt_dir / gnm_id, gnm_id)
+            cache.evict()
+
+    def schedule_prokka(self, fnas: list[Path]) -> None:
+        """
+        批量运行 prokka, 按 fna 大小从大到小调度, 队列快结束时给剩下的大基因组分配更多核心
+        :param fnas: 需要注释的基因组
+        """
+        for fna in fnas:
+            # 输出目录可能是缓存的硬链接, prokka --force 覆盖写入会改坏缓存, 先删除
+            shutil.rmtree(self.gnm_annt_dir / fna.parent.name, ignore_errors=True)
+        jobs = [(fna.parent.name, fna.stat().st_size, partial(self.prokka_cmd, fna)) for fna in fnas]
+        try:
+            schedule_run_commands(jobs, self.threads, max_cpu=PROKKA_MAX_CPU,
+                                  report_file=self.gnm_annt_dir / "prokka_schedule.tsv")
+        finally:
+            # 有任务失败时其余任务照常记录, 重新运行只处理失败的基因组
+            for fna in fnas:
+                gnm_id = fna.parent.name
+                if prokka_log_complete(self.gnm_annt_dir / gnm_id, gnm_id):
+                    self.ledger.mark_done(gnm_id, [fna], prokka_outputs(self.gnm_annt_dir, gnm_id))
+
+    def prokka_cmd(self, fna: Path, cpu: int) -> tuple[list[str], dict[str, str]]:
+        """
+        单个基因组的 prokka 命令
+        :param fna: 基因组 fna 文件
+        :param cpu: 分配的核心数
+        """
+        gnm_id = fna.parent.name
+        # ! Roary 需要每个 GFF 文件 basename 不同. Error: GFF files must have unique basenames
+        return tool_command("prokka", ["--cpu", cpu, "--force", "--prefix", gnm_id, "--outdir", self.gnm_annt_dir / gnm_id,
+                                       *self.prokka_params, "--quiet", "--locustag", gnm_id, fna])
+
+
+def prokka_outputs(anno_dir: Path, gnm_id: str) -> list[Path]:
+    """下游步骤用到的 prokka 结果文件, 记录在完成标记中"""
+    return [anno_dir / gnm_id / f"{gnm_id}{suffix}" for suffix in PROKKA_OUTPUT_SUFFIXES]
+
+
+def prokka_log_complete(out_dir: Path, gnm_id: str) -> bool:
+    """prokka 日志最后一行为 Share and enjoy! 时表示运行完成"""
+    log_file = out_dir / f"{gnm_id}.log"
+    if not log_file.exists():
+        return False
+    with open(log_file, "rb") as f:
+        f.seek(max(0, log_file.stat().st_size - 200))
+        return b"Share and enjoy!" in f.read()
+
+
+def prokka_is_complete(anno_dir: Path, fna: Path) -> bool:
+    """
+    单个基因组的 prokka 结果是否完整有效. 没有完成标记但日志显示已完成 (旧版本流程的结果) 时补写标记
+    :param anno_dir: genome_annotate 目录
+    :param fna: 基因组 fna 文件
+    """
+    gnm_id = fna.parent.name
+    ledger = StageLedger(anno_dir.parent / "ledger", "prokka")
+    outputs = prokka_outputs(anno_dir, gnm_id)
+    if ledger.is_done(gnm_id, [fna], outputs):
+        return True
+    if not ledger.marker(gnm_id).exists() and prokka_log_complete(anno_dir / gnm_id, gnm_id) and \
+            all(path.exists() for path in outputs):
+        ledger.mark_done(gnm_id, [fna], outputs)
+        return True
+    return False
+
 
-# todo 病毒注释
+def prokka_is_complete_run(anno_dir: Path, gnm_ids: list[str] | None = None) -> bool:
+    """
+    所有基因组的 prokka 结果是否完整有效
+    :param anno_dir: genome_annotate 目录
+    :param gnm_ids: 需要检查的基因组, 默认为 all 目录下所有基因组
+    """
+    fnas = list(anno_dir.parent.joinpath("all").glob("*/*.fna"))
+    if gnm_ids is not None:
+        fnas = [fna for fna in fnas if fna.parent.name in gnm_ids]
+    return all(prokka_is_complete(anno_dir, fna) for fna in fnas)
@@ -0,0 +1,59 @@
+from pathlib import Path
+import logging
+import pandas as pd
+
+from src.config.cnfg_database import ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_REFSEQ, ASSEMBLY_SUMMARY_CACHE_DIR
+from src.kml_qpcr.asmb_smry_cache import AssemblySummaryCache
+from src.kml_qpcr.gnm_download import get_taxonomy_id_from_sciname, concat_refseq_genbank, download_genome_queue
+from src.kml_qpcr.gnm_triage import triage_assemblies
+
+
+def batch_download_genome_files(species_file: str, genome_set_dir: str, threads: int, max_connections: int = 8,
+                                mirror: str | None = None, force: bool = False, triage: bool = True) -> None:
+    """
+    批量下载多个物种的基因组. taxonomy 和 assembly summary 只加载一次, 所有物种共用一个下载队列
+    :species_file: 物种学名列表文件, 每行一个, '#' 开头为注释
+    :genome_set_dir: 基因组集目录
+    :threads: 线程数, 与其他步骤保持一致
+    :max_connections: 最大并发下载数
+    :mirror: NCBI 镜像根地址, 默认直接从 NCBI 下载
+    :force: 是否强制重新下载已存在的文件
+    :triage: 是否在下载前根据元数据过滤基因组
+    :return: None
+    :raises ValueError: 物种名称不存在或 rank 不在允许范围内, 下载前一次性报告所有错误
+    """
+    with open(species_file) as f:
+        sci_names = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    logging.info(f"开始批量下载 {len(sci_names)} 个物种的基因组文件, 线程数: {threads}")
+    # 1. 解析所有物种的 taxid, 先检查完所有物种名再下载
+    taxids, errors = {}, []
+    for sci_name in sci_names:
+        infodir = Path(genome_set_dir).joinpath(sci_name.replace(" ", "_"), "info")
+        infodir.mkdir(parents=True, exist_ok=True)
+        try:
+            taxids[sci_name] = get_taxonomy_id_from_sciname(sci_name, infodir)
+        except ValueError as e:
+            errors.append(str(e))
+    if errors:
+        raise ValueError("物种名称检查未通过:\n" + "\n".join(errors))
+    # 2. 所有物种的 taxid 合并后一次查询 refseq 和 genbank
+    all_taxids = sorted({taxid for ids in taxids.values() for taxid in ids})
+    rs_df = AssemblySummaryCache(ASSEMBLY_SUMMARY_REFSEQ, ASSEMBLY_SUMMARY_CACHE_DIR).query_taxids(all_taxids)
+    gb_df = AssemblySummaryCache(ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_CACHE_DIR).query_taxids(all_taxids)
+    # 3. 按物种拆分, 所有物种的基因组进入同一个下载队列
+    rsgb_dfs = {}
+    for sci_name, cur_taxids in taxids.items():
+        gnmdir = Path(genome_set_dir).joinpath(sci_name.replace(" ", "_"))
+        infodir = gnmdir.joinpath("info")
+        rsgb_df = concat_refseq_genbank(rs_df[rs_df["taxid"].isin(cur_taxids)],
+                                        gb_df[gb_df["taxid"].isin(cur_taxids)], infodir)
+        if triage:
+            rsgb_df = triage_assemblies(rsgb_df, infodir)
+        alldir = gnmdir.joinpath("all")
+        alldir.mkdir(parents=True, exist_ok=True)
+        rsgb_dfs[alldir] = rsgb_df
+        logging.info(f"{sci_name}: {rsgb_df.shape[0]} 个基因组")
+    download_genome_queue(rsgb_dfs, max_connections, mirror, force)
+    # 汇总每个物种的基因组数
+    pd.DataFrame({"sci_name": list(taxids), "genome_count": [df.shape[0] for df in rsgb_dfs.values()]}).to_csv(
+        Path(genome_set_dir) / "batch_download_summary.tsv", sep="\t", index=False)
@@ -0,0 +1,182 @@
+from pathlib import Path
+import logging
+import sqlite3
+import time
+import pandas as pd
+
+from src.utils.util_file import file_fingerprint
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS genomes (
+    genome_id TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    fna TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    status TEXT NOT NULL DEFAULT 'active',
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_genomes_status ON genomes (status);
+CREATE TABLE IF NOT EXISTS stages (
+    genome_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated TEXT,
+    PRIMARY KEY (genome_id, stage)
+);
+CREATE INDEX IF NOT EXISTS idx_stages_stage ON stages (stage, status);
+CREATE TABLE IF NOT EXISTS metrics (
+    genome_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (genome_id, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class GenomeCatalog():
+    def __init__(self, gnm_dir: Path):
+        """
+        物种基因组目录. 保存在 info/catalog.sqlite, 记录每个基因组的来源, fna 路径, 指纹, sha256, 各步骤状态和指标,
+        各步骤按索引查询. 打开时比较 all 目录的 mtime 与上次同步时记录的值, 不一致时 (首次创建, 旧版本流程下载的基因组集,
+        手动放入或删除基因组目录) 才从磁盘扫描同步, 只需一次 stat
+        :param gnm_dir: 物种基因组目录
+        """
+        self.gnm_dir = Path(gnm_dir)
+        db_file = self.gnm_dir / "info/catalog.sqlite"
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_file, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        if self._all_dir_mtime() != self._synced_mtime():
+            self.sync_from_disk()
+
+    def register(self, genome_id: str, fna: Path, source: str, sha256: str | None = None) -> None:
+        """
+        新增或更新基因组
+        :param genome_id: 基因组 id
+        :param fna: 基因组 fna 文件
+        :param source: 来源 ncbi/customer
+        :param sha256: 内容 sha256, 未知时为 None
+        """
+        self.register_many([(genome_id, fna, source, sha256)])
+
+    def register_many(self, records: list[tuple[str, Path, str, str | None]]) -> None:
+        """批量新增或更新基因组, 一个事务内完成"""
+        rows = []
+        for genome_id, fna, source, sha256 in records:
+            fingerprint = file_fingerprint(fna)
+            rows.append((genome_id, source, str(fna), fingerprint["size"], fingerprint["mtime_ns"], sha256, _now()))
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO genomes (genome_id, source, fna, size, mtime_ns, sha256, status, updated)
+                VALUES (?, ?, ?, ?, ?, ?, 'active', ?)
+                ON CONFLICT (genome_id) DO UPDATE SET
+                    source = excluded.source, fna = excluded.fna, status = 'active', updated = excluded.updated,
+                    sha256 = CASE WHEN excluded.size = genomes.size AND excluded.mtime_ns = genomes.mtime_ns
+                             THEN COALESCE(excluded.sha256, genomes.sha256) ELSE excluded.sha256 END,
+                    size = excluded.size, mtime_ns = excluded.mtime_ns
+            """, rows)
+
+    def withdraw(self, genome_ids: list[str]) -> None:
+        """标记基因组已撤回"""
+        with self.conn:
+            self.conn.executemany("UPDATE genomes SET status = 'withdrawn', updated = ? WHERE genome_id = ?",
+                                  [(_now(), gid) for gid in genome_ids])
+
+    def sync_from_disk(self, source: str = "ncbi") -> None:
+        """
+        扫描 all 目录同步目录: 新基因组按 source 登记, fna 不存在的基因组标记为撤回
+        :param source: 新基因组的来源
+        """
+        # 先取 mtime 再扫描, 扫描期间的改动会在下次打开时重新同步
+        mtime = self._all_dir_mtime()
+        fnas = {fna.parent.name: fna for fna in self.gnm_dir.glob("all/*/*.fna")}
+        known = dict(self.conn.execute("SELECT genome_id, source FROM genomes").fetchall())
+        self.register_many([(gid, fna, known.get(gid, source), None) for gid, fna in fnas.items()])
+        self.withdraw([gid for gid in known if gid not in fnas])
+        with self.conn:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('all_mtime_ns', ?) "
+                              "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (mtime,))
+        logging.info(f"基因组目录已同步: {len(fnas)} 个基因组")
+
+    def _all_dir_mtime(self) -> str:
+        all_dir = self.gnm_dir / "all"
+        return str(all_dir.stat().st_mtime_ns) if all_dir.exists() else ""
+
+    def _synced_mtime(self) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'all_mtime_ns'").fetchone()
+        return None if row is None else row[0]
+
+    def genome_fnas(self, genome_ids: set[str] | None = None) -> list[Path]:
+        """
+        当前有效基因组的 fna 文件, 按 genome_id 排序
+        :param genome_ids: 只返回这些基因组, 默认全部
+        """
+        rows = self.conn.execute(
+            "SELECT genome_id, fna FROM genomes WHERE status = 'active' ORDER BY genome_id").fetchall()
+        return [Path(fna) for gid, fna in rows if genome_ids is None or gid in genome_ids]
+
+    def bin_ids(self) -> dict[str, str]:
+        """checkM Bin Id (fna 文件名去掉 .fna) -> genome_id"""
+        return {Path(fna).stem: gid for gid, fna in self.conn.execute("SELECT genome_id, fna FROM genomes")}
+
+    def set_sha256(self, digests: dict[str, str]) -> None:
+        """记录基因组内容 sha256"""
+        with self.conn:
+            self.conn.executemany("UPDATE genomes SET sha256 = ? WHERE genome_id = ?",
+                                  [(digest, gid) for gid, digest in digests.items()])
+
+    def set_stage(self, genome_ids: list[str], stage: str, status: str) -> None:
+        """
+        记录基因组在某个步骤的状态
+        :param genome_ids: 基因组 id 列表
+        :param stage: 步骤名, 如 annotate, checkm, assess
+        :param status: 状态, 如 done, failed, high_quality, low_quality
+        """
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO stages (genome_id, stage, status, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT (genome_id, stage) DO UPDATE SET status = excluded.status, updated = excluded.updated
+            """, [(gid, stage, status, _now()) for gid in genome_ids])
+
+    def stage_genomes(self, stage: str, status: str) -> list[str]:
+        """某个步骤处于指定状态的有效基因组"""
+        rows = self.conn.execute("""
+            SELECT s.genome_id FROM stages s JOIN genomes g USING (genome_id)
+            WHERE s.stage = ? AND s.status = ? AND g.status = 'active' ORDER BY s.genome_id
+        """, (stage, status)).fetchall()
+        return [row[0] for row in rows]
+
+    def set_metrics(self, df: pd.DataFrame) -> None:
+        """
+        记录基因组指标
+        :param df: 一行一个基因组, 数值列和布尔列作为指标, 其余列忽略
+        """
+        values = df.set_index("genome_id").select_dtypes(include=["number", "bool"]).astype(float)
+        long_df = values.reset_index().melt(id_vars="genome_id", var_name="name", value_name="value")
+        rows = [(gid, name, None if pd.isna(value) else value)
+                for gid, name, value in long_df.itertuples(index=False)]
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO metrics (genome_id, name, value) VALUES (?, ?, ?)
+                ON CONFLICT (genome_id, name) DO UPDATE SET value = excluded.value
+            """, rows)
+
+    def metrics(self, names: list[str]) -> pd.DataFrame:
+        """有效基因组的指标宽表, 列为 genome_id 和 names"""
+        placeholders = ",".join("?" * len(names))
+        df = pd.read_sql_query(f"""
+            SELECT m.genome_id, m.name, m.value FROM metrics m JOIN genomes g USING (genome_id)
+            WHERE g.status = 'active' AND m.name IN ({placeholders})
+        """, self.conn, params=names)
+        return df.pivot(index="genome_id", columns="name", values="value").reindex(columns=names).reset_index()
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,191 @@
+from pathlib import Path
+from multiprocessing import Pool
+import logging
+import pickle
+import numpy as np
+import pandas as pd
+
+from src.kml_qpcr.base import BaseQPCR
+from src.utils.util_file import file_fingerprint
+
+# 碱基 2-bit 编码, 非 ACGT 为 4
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(b"ACGT"):
+    _BASE_CODES[_b] = _i
+    _BASE_CODES[ord(chr(_b).lower())] = _i
+
+
+class GenomeDeduplicator(BaseQPCR):
+    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool,
+                 ani: float = 99.9, kmer: int = 21, sketch_size: int = 1000):
+        """
+        MinHash 近似去重. 对 all 目录下所有基因组做 MinHash 草图, 按 ANI 阈值聚类, 每个簇保留一个代表基因组.
+        :param sci_name: 物种学名.
+        :param genome_set_dir: 基因组集目录.
+        :param threads: 线程数, 用于并行计算草图.
+        :param force: 是否强制重新计算草图, 默认复用文件未变化的基因组草图.
+        :param ani: 聚类 ANI 阈值 (%), 与代表基因组 ANI 不低于该值的基因组归入同一簇.
+        :param kmer: k-mer 长度, 不超过 32.
+        :param sketch_size: 每个基因组保留的最小哈希数.
+        """
+        super().__init__(sci_name, genome_set_dir, threads, force)
+        self.ani = ani
+        self.kmer = kmer
+        self.sketch_size = sketch_size
+        self.dedup_dir = self.gnm_dir / "genome_dedup"
+        self.dedup_dir.mkdir(parents=True, exist_ok=True)
+
+    def run(self) -> None:
+        logging.info(f"开始基因组去重: {self.gnm_dir}, ANI 阈值: {self.ani}, 线程数: {self.threads}")
+        sketches = self.sketch_genomes()
+        gnm_ids = sorted(sketches)
+        ani_mat = pairwise_ani([sketches[gid]["sketch"] for gid in gnm_ids], self.kmer, self.sketch_size)
+        pd.DataFrame(ani_mat, index=gnm_ids, columns=gnm_ids).round(4).to_csv(self.dedup_dir / "ani_matrix.csv")
+        self.cluster_genomes(gnm_ids, sketches, ani_mat)
+
+    def sketch_genomes(self) -> dict[str, dict]:
+        """
+        计算所有基因组的草图, 文件大小和修改时间未变化的基因组复用上次结果
+        :return: genome_id -> {"fingerprint", "sketch", "contigs", "length"}
+        """
+        cache_file = self.dedup_dir / "sketches.pkl"
+        params = {"kmer": self.kmer, "sketch_size": self.sketch_size}
+        cached = {}
+        if cache_file.exists() and not self.force:
+            with open(cache_file, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot["params"] == params:
+                cached = snapshot["sketches"]
+        sketches, todo = {}, []
+        for fna in self.genome_fnas():
+            gnm_id = fna.parent.name
+            fingerprint = file_fingerprint(fna)
+            if gnm_id in cached and cached[gnm_id]["fingerprint"] == fingerprint:
+                sketches[gnm_id] = cached[gnm_id]
+            else:
+                todo.append((gnm_id, fna, fingerprint))
+        logging.info(f"计算 {len(todo)} 个基因组的草图, 复用 {len(sketches)} 个")
+        with Pool(processes=self.threads) as pool:
+            results = pool.starmap(sketch_genome, [(fna, self.kmer, self.sketch_size) for _, fna, _ in todo])
+        for (gnm_id, _, fingerprint), (sketch, contigs, length) in zip(todo, results):
+            sketches[gnm_id] = {"fingerprint": fingerprint, "sketch": sketch, "contigs": contigs, "length": length}
+        with open(cache_file, "wb") as f:
+            pickle.dump({"params": params, "sketches": sketches}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return sketches
+
+    def cluster_genomes(self, gnm_ids: list[str], sketches: dict[str, dict], ani_mat: np.ndarray) -> None:
+        """
+        贪心聚类. 按 contig 数升序, 基因组长度降序依次处理, 与已有代表基因组 ANI 达到阈值则归入最相近的簇, 否则成为新的代表.
+        输出 clusters.tsv (genome_id, representative, ani, cluster_size) 和 representatives.txt
+        """
+        order = sorted(range(len(gnm_ids)),
+                       key=lambda i: (sketches[gnm_ids[i]]["contigs"], -sketches[gnm_ids[i]]["length"], gnm_ids[i]))
+        reps, assign = [], {}
+        for i in order:
+            if reps and ani_mat[i, reps].max() >= self.ani:
+                rep = reps[int(np.argmax(ani_mat[i, reps]))]
+            else:
+                rep = i
+                reps.append(i)
+            assign[i] = rep
+        df = pd.DataFrame({
+            "genome_id": [gnm_ids[i] for i in order],
+            "representative": [gnm_ids[assign[i]] for i in order],
+            "ani": [ani_mat[i, assign[i]] for i in order],
+        })
+        df["cluster_size"] = df.groupby("representative")["genome_id"].transform("size")
+        df.to_csv(self.dedup_dir / "clusters.tsv", sep="\t", index=False)
+        with open(self.dedup_dir / "representatives.txt", "w") as f:
+            f.write("\n".join(gnm_ids[i] for i in reps) + "\n")
+        logging.info(f"{len(gnm_ids)} 个基因组聚为 {len(reps)} 个簇")
+
+
+def sketch_genome(fna: Path, kmer: int, sketch_size: int) -> tuple[np.ndarray, int, int]:
+    """
+    计算单个基因组的 MinHash 草图 (bottom-s). 使用正反链中较小的 k-mer 编码, splitmix64 哈希
+    :param fna: 基因组 fasta 文件
+    :param kmer: k-mer 长度, 不超过 32
+    :param sketch_size: 保留的最小哈希数
+    :return: 升序哈希数组, contig 数, 基因组长度
+    """
+    contigs = []
+    with open(fna, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                contigs.append([])
+            elif contigs:
+                contigs[-1].append(line.strip())
+    # contig 之间用 N 隔开, 跨 contig 的 k-mer 会被过滤
+    seq = b"N".join(b"".join(lines) for lines in contigs)
+    codes = _BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    length = int(np.count_nonzero(codes < 4))
+    n = len(codes) - kmer + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64), len(contigs), length
+    # 窗口内没有非 ACGT 碱基的 k-mer 有效
+    invalid = np.concatenate([[0], np.cumsum(codes >= 4)])
+    valid = (invalid[kmer:] - invalid[:-kmer]) == 0
+    bases = (codes & 3).astype(np.uint64)
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    for j in range(kmer):
+        fwd = (fwd << np.uint64(2)) | bases[j:j + n]
+        rev |= (np.uint64(3) - bases[j:j + n]) << np.uint64(2 * j)
+    hashes = np.unique(_splitmix64(np.minimum(fwd, rev)[valid]))
+    return hashes[:sketch_size], len(contigs), length
+
+
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 哈希, uint64 乘法自然溢出"""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def pairwise_ani(sketches: list[np.ndarray], kmer: int, sketch_size: int) -> np.ndarray:
+    """
+    两两计算 ANI (%), 与 Mash 的估计方法一致: 取两个草图并集中最小的 sketch_size 个哈希, 统计其中两者共有的哈希数,
+    Jaccard = 共有数 / min(sketch_size, 并集大小), Mash 距离 D = -ln(2J/(1+J))/k, ANI = 100 * (1 - D).
+    共有哈希按升序第 m 个 (从 0 开始) 在 A, B 中的位置为 a, b 时, 并集中比它小的哈希有 a + b - m 个,
+    小于 sketch_size 时在并集的最小 sketch_size 个哈希内. 逐行计算第 i 个草图与其后所有草图的位置矩阵
+    :param sketches: 每个基因组的草图, 升序
+    :param kmer: k-mer 长度
+    :param sketch_size: 草图大小
+    :return: n x n ANI 矩阵
+    """
+    n = len(sketches)
+    sizes = np.array([len(s) for s in sketches], dtype=np.int64)
+    all_hashes = np.concatenate(sketches + [np.empty(0, dtype=np.uint64)])
+    owners = np.repeat(np.arange(n), sizes)
+    ranks = np.arange(len(all_hashes)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    uniq, cols = np.unique(all_hashes, return_inverse=True)
+    # 按哈希分组的 (草图, 位置), 第 u 个哈希为 col_owners[col_ptr[u]:col_ptr[u + 1]]
+    order = np.argsort(cols, kind="stable")
+    col_owners, col_ranks = owners[order], ranks[order]
+    col_ptr = np.searchsorted(cols[order], np.arange(len(uniq) + 1))
+    col_start = np.cumsum(sizes) - sizes
+    shared = np.zeros((n, n), dtype=np.int64)
+    common = np.zeros((n, n), dtype=np.int64)
+    for i in range(n - 1):
+        i_cols = cols[col_start[i]:col_start[i] + sizes[i]]
+        starts, counts = col_ptr[i_cols], col_ptr[i_cols + 1] - col_ptr[i_cols]
+        entries = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pos = np.repeat(np.arange(len(i_cols)), counts)
+        keep = col_owners[entries] > i
+        # rank_mat[j - i - 1, a]: 草图 i 第 a 个哈希在草图 j 中的位置, 不存在时为 -1
+        rank_mat = np.full((n - i - 1, len(i_cols)), -1, dtype=np.int64)
+        rank_mat[col_owners[entries][keep] - i - 1, pos[keep]] = col_ranks[entries][keep]
+        present = rank_mat >= 0
+        seen = np.cumsum(present, axis=1) - 1
+        in_bottom = present & (np.arange(len(i_cols)) + rank_mat - seen < sketch_size)
+        shared[i, i + 1:] = in_bottom.sum(axis=1)
+        common[i, i + 1:] = present.sum(axis=1)
+    shared, common = shared + shared.T, common + common.T
+    denom = np.minimum(sketch_size, sizes[:, None] + sizes[None, :] - common).astype(np.float64)
+    jaccard = np.divide(shared, denom, out=np.zeros(denom.shape), where=denom > 0)
+    np.fill_diagonal(jaccard, 1)
+    with np.errstate(divide="ignore"):
+        dist = -np.log(2 * jaccard / (1 + jaccard)) / kmer
+    return np.clip(100 * (1 - dist), 0, 100)
@@ -1,25 +1,31 @@
 from pathlib import Path
 from urllib.parse import urlparse
 from pathlib import PurePosixPath
-from subprocess import run
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import pandas as pd
-from bs4 import BeautifulSoup
 
-from src.config.cnfg_database import TAXONKIT_DB, ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_REFSEQ
-from src.config.cnfg_software import TAXONKIT
+from src.config.cnfg_database import ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_REFSEQ, ASSEMBLY_SUMMARY_CACHE_DIR
 from src.config.cnfg_taxonomy import BELOW_FAMILY_RANKS
-from src.utils.util_command import execute_cmd_and_get_stdout
+from src.kml_qpcr.asmb_smry_cache import AssemblySummaryCache
+from src.kml_qpcr.tax_tree import load_taxonomy_tree
+from src.kml_qpcr.gnm_triage import triage_assemblies
+from src.kml_qpcr.gnm_catalog import GenomeCatalog
 from src.utils.util_file import list2txt
-from src.utils.util_command import multi_run_command
+from src.utils.util_download import Downloader, DownloadManifest, Md5GunzipSink, mirror_url
 
 
-def download_genome_files(sci_name: str, genome_set_dir: str, threads: int) -> None:
+def download_genome_files(sci_name: str, genome_set_dir: str, threads: int, max_connections: int = 8,
+                          mirror: str | None = None, force: bool = False, triage: bool = True) -> None:
     """
     下载 genome 目录下面的指定文件, fna
     :sci_name: 物种学名, 如 "Bandavirus dabieense"
     :genome_set_dir: 基因组集目录, 如 "kml_qpcr_genomes"
-    :threads: 线程数, 用于解压下载的 fna 文件
+    :threads: 线程数, 与其他步骤保持一致. 下载时已流式解压, 不再单独解压
+    :max_connections: 最大并发下载数
+    :mirror: NCBI 镜像根地址, 默认直接从 NCBI 下载
+    :force: 是否强制重新下载已存在的文件
+    :triage: 是否在下载前根据元数据过滤基因组
     :return: None
     """
     logging.info(f"开始下载 {sci_name} 的基因组文件, 线程数: {threads}")
@@ -29,44 +35,36 @@ def download_genome_files(sci_name: str, genome_set_dir: str, threads: int) -> N
     infodir.mkdir(parents=True, exist_ok=True)
     taxids = get_taxonomy_id_from_sciname(sci_name, infodir)
     rsgb_df = get_assembly_summary_by_taxids(taxids, infodir)
+    if triage:
+        rsgb_df = triage_assemblies(rsgb_df, infodir)
     # 存放基因组下载文件的目录 all
     alldir = gnmdir.joinpath("all")
     alldir.mkdir(parents=True, exist_ok=True)
-    # 下载基因组文件并进行 md5 校验
-    download_and_md5sum(rsgb_df, alldir)
-    # 解压下载的 fna 文件
-    extract_fna_files(alldir, threads)
+    # 下载基因组文件, 下载时同步进行 md5 校验和解压
+    download_and_md5sum(rsgb_df, alldir, max_connections, mirror, force)
 
 
 def get_taxonomy_id_from_sciname(sciname: str, infodir: Path) -> list:
     """
-    使用 taxonkit 将 scientific name 转为 taxonomy id. 仅允许输入科以下的分类级别.
+    将 scientific name 转为 taxonomy id. 仅允许输入科以下的分类级别.
     :param sciname: scientific name
     :param infodir: 输出目录, 用于存储结果文件
     :return: scientific name 在当前分类级别下的 taxonomy id 列表
-    :raises ValueError: 如果 scientific name 的 rank 不在允许范围内
-    :raises RuntimeError: 如果 scientific name 的 taxid 列表为空
+    :raises ValueError: 如果 scientific name 不存在, 或 rank 不在允许范围内
     """
     logging.info(f"获取 {sciname} 的 taxonomy id 列表")
     # 获取 scientific name 的 taxonomy id 和 rank
-    cmd_name2taxid = (
-        f"echo '{sciname}' | {TAXONKIT} name2taxid --data-dir {TAXONKIT_DB} --show-rank --sci-name")
-    output = execute_cmd_and_get_stdout(cmd_name2taxid)
+    tree = load_taxonomy_tree()
     try:
-        _, txid, rank = output.split("\t")
-    except ValueError:
-        raise ValueError(f"输出格式错误或为别名, 请确认物种名称: {cmd_name2taxid}\n输出: {output}")
+        txid = tree.name2taxid(sciname)
+    except KeyError:
+        raise ValueError(f"未找到科学名或为别名, 请确认物种名称: {sciname}")
+    rank = tree.rank(txid)
     # 检查 rank 是否在允许范围内, 科及一下级别
     if rank not in BELOW_FAMILY_RANKS:
         raise ValueError(f"当前 scientific name 的 rank 不在允许范围内(科及以下级别): {rank}")
-    # 获取当前分类级别下的 taxonomy id 列表
-    cmd_list_taxids = (
-        f"{TAXONKIT} list --data-dir {TAXONKIT_DB} --indent '' --ids {txid}")
-    taxid_output = execute_cmd_and_get_stdout(cmd_list_taxids)
-    taxids = taxid_output.split("\n")
-    if not taxids or taxids == [""]:
-        raise RuntimeError(
-            f"当前 scientific name 的 taxid 列表为空: {cmd_list_taxids}\n输出: {taxid_output}")
+    # 获取当前分类级别下的 taxonomy id 列表, 包括自身
+    taxids = [str(taxid) for taxid in tree.descendants(txid)]
     # 结果写入到文件
     list2txt(taxids, infodir.joinpath("taxids.txt"))
     return taxids
@@ -80,18 +78,25 @@ def get_assembly_summary_by_taxids(taxids: list, infodir: Path) -> pd.DataFrame:
     :return: 当前 taxids 的 assembly summary dataframe
     """
     logging.info(f"获取 {taxids} 的 refseq&genbank assembly summary")
-    # 读入 RefSeq 的 assembly_summary_refseq.txt 文件
-    usecols = ["#assembly_accession", "refseq_category", "taxid", "species_taxid", "organism_name",
-               "assembly_level", "gbrs_paired_asm", "ftp_path", "genome_size", "scaffold_count", "contig_count"]
-    rf_df = pd.read_csv(ASSEMBLY_SUMMARY_REFSEQ, sep="\t", skiprows=1,
-                        na_values=["na", ""], dtype=object, usecols=usecols)
-    gb_df = pd.read_csv(ASSEMBLY_SUMMARY_GENBANK, sep="\t", skiprows=1,
-                        na_values=["na", ""], dtype=object, usecols=usecols)
-    rs_cur_tax_df = rf_df.loc[rf_df["taxid"].isin(taxids), :]
+    # 从按 taxid 索引的列式缓存中查询, 避免每次重新解析整个 assembly summary
+    rs_cur_tax_df = AssemblySummaryCache(
+        ASSEMBLY_SUMMARY_REFSEQ, ASSEMBLY_SUMMARY_CACHE_DIR).query_taxids(taxids)
+    gb_cur_tax_df = AssemblySummaryCache(
+        ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_CACHE_DIR).query_taxids(taxids)
+    return concat_refseq_genbank(rs_cur_tax_df, gb_cur_tax_df, infodir)
+
+
+def concat_refseq_genbank(rs_cur_tax_df: pd.DataFrame, gb_cur_tax_df: pd.DataFrame, infodir: Path) -> pd.DataFrame:
+    """
+    合并当前物种的 refseq 和 genbank 条目, 写入 info 目录
+    :param rs_cur_tax_df: 当前物种的 refseq assembly summary
+    :param gb_cur_tax_df: 当前物种的 genbank assembly summary
+    :param infodir: 输出目录
+    :return: 合并后的 assembly summary dataframe
+    """
     # refseq 中包含的条目不要重复下载
     gbrs_paired_asms = rs_cur_tax_df["gbrs_paired_asm"].dropna().unique()
-    gb_cur_tax_df = gb_df[
-        (gb_df["taxid"].isin(taxids)) & (~gb_df["#assembly_accession"].isin(gbrs_paired_asms))]
+    gb_cur_tax_df = gb_cur_tax_df[~gb_cur_tax_df["#assembly_accession"].isin(gbrs_paired_asms)]
     rsgb_cnct_df = pd.concat([rs_cur_tax_df, gb_cur_tax_df], axis=0, ignore_index=True)
     # 输出到文件
     rsgb_cnct_df.to_csv(Path(infodir).joinpath(
@@ -99,61 +104,106 @@ def get_assembly_summary_by_taxids(taxids: list, infodir: Path) -> pd.DataFrame:
     return rsgb_cnct_df
 
 
-def download_and_md5sum(rsgb_df: pd.DataFrame, alldir: Path) -> None:
+def download_and_md5sum(rsgb_df: pd.DataFrame, alldir: Path, max_connections: int = 8,
+                        mirror: str | None = None, force: bool = False) -> list[str]:
     """
-    根据目标微生物的 assembly summary 下载对应的 fna 文件, 并进行 md5 校验
+    根据目标微生物的 assembly summary 并发下载对应的 fna 文件, 下载时同步 md5 校验并解压
     :param rsgb_df: assembly summary dataframe
     :param alldir: 存放下载的基因组文件的目录
-    :return: None
+    :param max_connections: 最大并发下载数
+    :param mirror: NCBI 镜像根地址, 如 file:///data/ncbi_mirror, 默认直接从 NCBI 下载
+    :param force: 是否强制重新下载已存在的文件
+    :return: 下载失败的 accession
+    """
+    return download_genome_queue({alldir: rsgb_df}, max_connections, mirror, force)
+
+
+def download_genome_queue(rsgb_dfs: dict[Path, pd.DataFrame], max_connections: int = 8,
+                          mirror: str | None = None, force: bool = False) -> list[str]:
+    """
+    多个物种的基因组共用一个下载队列和连接池
+    :param rsgb_dfs: 存放下载的基因组文件的目录 -> 该物种的 assembly summary dataframe
+    :param max_connections: 最大并发下载数
+    :param mirror: NCBI 镜像根地址, 如 file:///data/ncbi_mirror, 默认直接从 NCBI 下载
+    :param force: 是否强制重新下载已存在的文件
+    :return: 下载失败的 accession
     """
-    logging.info(f"下载 {rsgb_df.shape[0]} 个基因组的文件")
-    # 迭代每行, 每行为一个基因组
-    for row in rsgb_df.iterrows():
-        asmb_acc = row[1]["#assembly_accession"]
-        ftp_path = row[1]["ftp_path"]
-        prfx = PurePosixPath(urlparse(ftp_path).path).name
-        # 创建当前基因组的目录
-        dir_cur_gnm = alldir.joinpath(asmb_acc)
-        dir_cur_gnm.mkdir(parents=True, exist_ok=True)
-        # 获取当前基因组的 ftp 目录页面, 要把 '/' 加上
-        res = run(f"curl -l {ftp_path}/", shell=True, capture_output=True, text=True, check=True)
-        html_content = res.stdout.strip()
-        # 查看 fna, gtf, gff, faa 哪些文件可以下载 homotypic synonym
-        # ! 目前流程只有用到 fna, 很多基因组没有做注释. 这里先注释掉可以下载多文件的方法
-        # target_files = [prfx + kw for kw in ["_genomic.fna.gz", "_genomic.gff.gz", "_genomic.gtf.gz", "_protein.faa.gz", "_genomic.gbff.gz"]]
-        target_files = [prfx + kw for kw in ["_genomic.fna.gz"]]
-        existed_links = []
-        soup = BeautifulSoup(html_content, "html.parser")
-        for a_tag in soup.find_all("a", href=True):
-            href = a_tag["href"]  # type: ignore
-            if href in target_files:
-                existed_links.append(href)
-        # 开始下载, 写入到文件, 方便后续没成功的文件继续下载
-        with open(f"{dir_cur_gnm}/dwnld.sh", "w") as f:
-            f.write(f"wget -c {ftp_path}/md5checksums.txt -O {dir_cur_gnm}/md5checksums.txt\n")
-            for link in existed_links:
-                f.write(
-                    f"wget -c {ftp_path}/{link} -O {dir_cur_gnm}/{PurePosixPath(urlparse(link).path).name}\n")
-        run(f"bash {dir_cur_gnm}/dwnld.sh", shell=True, check=True, timeout=600)
-        # MD5 校验
-        res = run(f"cd {dir_cur_gnm} && md5sum -c md5checksums.txt | grep -c OK",
-                  shell=True, check=True, capture_output=True, text=True)
-        if int(res.stdout.strip()) == len(existed_links):
-            run(f"touch {dir_cur_gnm}/md5checksums.OK", shell=True, check=True)
-        else:
-            run(f"touch {dir_cur_gnm}/md5checksums.FAILED", shell=True, check=True)
+    downloader = Downloader()
+    # 每个文件的下载进度和 md5 校验结果记录在各自 all 目录的清单中, 中断后重新运行会从断点继续
+    manifests = {alldir: DownloadManifest(alldir / "download_manifest.tsv") for alldir in rsgb_dfs}
+    verified = set()
+    for manifest in manifests.values():
+        verified |= {file for file, rec in manifest.load().items() if rec["status"] == "verified"}
+    jobs = []
+    for alldir, rsgb_df in rsgb_dfs.items():
+        rows = rsgb_df.dropna(subset=["ftp_path"])
+        if rows.shape[0] < rsgb_df.shape[0]:
+            logging.warning(f"{rsgb_df.shape[0] - rows.shape[0]} 个基因组没有 ftp_path, 跳过下载: {alldir}")
+        jobs += [(row["#assembly_accession"], mirror_url(row["ftp_path"], mirror), alldir) for _, row in rows.iterrows()]
+    logging.info(f"下载 {len(jobs)} 个基因组的文件, 并发数: {max_connections}")
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_connections) as pool:
+        futures = {
+            pool.submit(download_genome, acc, ftp_path, alldir, downloader, manifests[alldir],
+                        set() if force else verified, force): acc
+            for acc, ftp_path, alldir in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except RuntimeError as e:
+                logging.error(f"{futures[future]} 下载失败: {e}")
+                failed.append(futures[future])
+    if failed:
+        logging.warning(f"{len(failed)} 个基因组下载失败, 重新运行 download 会从断点继续: {failed}")
+    # 下载成功的基因组登记到各物种的基因组目录
+    for alldir in rsgb_dfs:
+        records = [(acc, fna, "ncbi", None) for acc, _, job_dir in jobs if job_dir == alldir and acc not in failed
+                   for fna in alldir.joinpath(acc).glob("*.fna")]
+        GenomeCatalog(alldir.parent).register_many(records)
+    return failed
 
 
-def extract_fna_files(alldir: Path,  threads: int) -> None:
+def download_genome(asmb_acc: str, ftp_path: str, alldir: Path, downloader: Downloader,
+                    manifest: DownloadManifest, verified: set[str], force: bool = False) -> None:
     """
-    解压下载的 fna 文件
+    下载单个基因组. fna.gz 边下载边计算 md5 并解压, 校验通过后才生成 fna 文件
+    :param asmb_acc: assembly accession
+    :param ftp_path: 基因组目录地址 (已替换为镜像地址)
     :param alldir: 存放下载的基因组文件的目录
-    :param threads: 线程数, 用于并行解压
+    :param downloader: 共享的下载器
+    :param manifest: 共享的下载清单
+    :param verified: 清单中已校验通过的文件, 跳过下载
+    :param force: 是否强制重新下载, 忽略旧版本流程的 md5checksums.OK 标记
     :return: None
+    :raises RuntimeError: 下载失败或 md5 校验失败
     """
-    logging.info(f"解压 {alldir} 目录下的 fna 文件")
-    cmds = []
-    for fagz in alldir.glob("*/*.fna.gz"):
-        cmds.append(f"gunzip {fagz}")
-    # 并行运行
-    multi_run_command(cmds, threads)
+    prfx = PurePosixPath(urlparse(ftp_path).path).name
+    # 创建当前基因组的目录
+    dir_cur_gnm = alldir.joinpath(asmb_acc)
+    dir_cur_gnm.mkdir(parents=True, exist_ok=True)
+    # ! 目前流程只有用到 fna, 很多基因组没有做注释. 这里先注释掉可以下载多文件的方法
+    # target_files = [prfx + kw for kw in ["_genomic.fna.gz", "_genomic.gff.gz", "_genomic.gtf.gz", "_protein.faa.gz", "_genomic.gbff.gz"]]
+    target_files = [prfx + kw for kw in ["_genomic.fna.gz"]]
+    # 已校验通过的基因组跳过. md5checksums.OK 为旧版本流程的校验标记
+    fnas = [dir_cur_gnm / link.removesuffix(".gz") for link in target_files]
+    if all(fna.exists() for fna in fnas) and (all(str(fna) in verified for fna in fnas) or (
+            (not force) and dir_cur_gnm.joinpath("md5checksums.OK").exists())):
+        return
+    # md5checksums.txt 列出了目录下所有文件, 用它代替目录页面判断 fna, gtf, gff, faa 哪些文件可以下载
+    md5_file = dir_cur_gnm / "md5checksums.txt"
+    md5_file.unlink(missing_ok=True)
+    downloader.fetch(f"{ftp_path}/md5checksums.txt", md5_file, manifest)
+    with open(md5_file) as f:
+        md5s = {PurePosixPath(line.split()[1]).name: line.split()[0] for line in f if line.strip()}
+    for link in [link for link in target_files if link in md5s]:
+        # 压缩文件只作为断点续传的缓冲, 校验解压完成后删除
+        spool = dir_cur_gnm / link
+        fna = dir_cur_gnm / link.removesuffix(".gz")
+        sink = Md5GunzipSink(fna, md5s[link])
+        downloader.fetch(f"{ftp_path}/{link}", spool, manifest, sink)
+        passed = sink.finish()
+        spool.unlink()
+        manifest.record(file=fna, url=f"{ftp_path}/{link}", bytes=fna.stat().st_size if passed else 0,
+                        status="verified" if passed else "md5_failed", md5=sink.md5.hexdigest())
+        if not passed:
+            raise RuntimeError(f"md5 校验失败: {ftp_path}/{link}")
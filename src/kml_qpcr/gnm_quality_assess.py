@@ -1,86 +1,195 @@
 from pathlib import Path
 from subprocess import run
 import logging
+import shutil
+import time
 from functools import reduce
 import pandas as pd
 
 from src.kml_qpcr.base import BaseQPCR
-from src.config.cnfg_software import CSVTK, ACTIVATE
+from src.kml_qpcr.stage_ledger import StageLedger
+from src.kml_qpcr.gnm_stats import collect_assembly_stats, flag_assembly_outliers, collect_rna_counts
+from src.config.cnfg_software import (CSVTK, CHECKM_MEMORY_BUDGET_GB, CHECKM_SHARD_BASE_MEMORY_GB,
+                                      CHECKM_PPLACER_THREAD_MEMORY_GB, CHECKM_SHARD_MIN_GENOMES, CHECKV_BATCHES)
 from src.config.cnfg_database import CHECKV_DB
-from src.utils.util_command import multi_run_command
+from src.utils.util_command import multi_run_command, tool_command, run_commands_with_rusage
+
+# checkM lineage_wf --tab_table 结果的列
+CHECKM_RESULT_COLUMNS = ["Bin Id", "Marker lineage", "# genomes", "# markers", "# marker sets", "0", "1", "2", "3",
+                         "4", "5+", "Completeness", "Contamination", "Strain heterogeneity"]
 
 
 class GenomeQualityAssessor(BaseQPCR):
-    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool = False):
+    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool = False,
+                 changeset: bool = False, representatives_only: bool = False,
+                 memory_gb: float = CHECKM_MEMORY_BUDGET_GB, skip_outliers: bool = False):
         """
         初始化基因组质量评估器
         :sci_name: 物种名称, 例 Ehrlichia_chaffeensis
         :gnm_dgenome_set_dirir: 基因组目录, 例 KML250416_chinacdc_pcr/genomes/Ehrlichia_chaffeensis
         :threads: 线程数
         :force: 是否强制重新运行 checkM/checkV, 默认识别到结果文件就跳过
+        :changeset: 是否只对 refresh 变更集中新增和变化的基因组运行 checkM/checkV, 结果合并到已有结果.
+            checkM 按基因组缓存结果, 变更集中的基因组删除缓存后重新评估
+        :representatives_only: 是否只评估 dedup 聚类得到的代表基因组
+        :memory_gb: checkM 内存预算 (GB), 决定分片数和 pplacer 线程数
+        :skip_outliers: 组装统计离群的基因组是否不运行 checkM/checkV, 不运行的基因组不会进入高质量基因组列表
         """
-        super().__init__(sci_name, genome_set_dir, threads, force)
+        super().__init__(sci_name, genome_set_dir, threads, force, changeset, representatives_only)
+        self.memory_gb = memory_gb
+        self.skip_outliers = skip_outliers
+        # 组装统计离群的基因组, run_assembly_stats 之后才有值
+        self.outliers = set()
         # 分离株基因组评估目录
         self.assess_dir = self.gnm_dir / "genome_assess"
 
     def run(self):
         """基因组质量评估流程"""
         logging.info(f"开始基因组质量评估: {self.gnm_dir}, 线程数: {self.threads}, 强制重新运行: {self.force}")
+        self.run_assembly_stats()
         self.run_checkm()
         self.get_genome_anno_quality()
         self.merge_checkm_rna_stats()
         self.filter_by_merge_df_bacteria()
 
+    def assess_fnas(self) -> list[Path]:
+        """需要评估的基因组, 按代表基因组筛选, --skip-outliers 时去掉组装统计离群的基因组"""
+        fnas = self.genome_fnas()
+        if self.skip_outliers:
+            fnas = [fna for fna in fnas if fna.parent.name not in self.outliers]
+        return fnas
+
+    def run_assembly_stats(self) -> None:
+        """进程内统计所有基因组的组装指标, 标记离群基因组, 结果写入 assembly_stats.csv"""
+        self.assess_dir.mkdir(parents=True, exist_ok=True)
+        stats_file = self.assess_dir / "assembly_stats.csv"
+        df = flag_assembly_outliers(collect_assembly_stats(self.genome_fnas(), self.threads))
+        df.to_csv(stats_file, index=False)
+        self.catalog.set_metrics(df)
+        self.outliers = set(df.loc[df["outlier"], "genome_id"])
+        if self.skip_outliers and self.outliers:
+            logging.warning(f"跳过 {len(self.outliers)} 个组装统计离群的基因组, 原因见 {stats_file}")
+
     def run_checkm(self) -> None:
-        """运行 checkM. checkM 评估 bins 多个基因组"""
-        # 创建 checkM 输入 bins 目录，复制并解压所有基因组
-        all_dir = self.gnm_dir.joinpath("all")
-        bins_dir = self.gnm_dir.joinpath("genome_assess/checkm_input")
-        bins_dir.mkdir(parents=True, exist_ok=True)
-        run(f"cp {all_dir}/*/*.fna {bins_dir}", shell=True, check=True)
-        # 运行 checkM
-        checkm_dir = self.gnm_dir.joinpath("genome_assess/checkm")
+        """
+        运行 checkM. 每个基因组的结果单独缓存在 checkm_cache/<genome_id>.tsv, 只对没有缓存或 fna 有变化的基因组
+        运行 checkM (输入目录用软链接), 再把所有基因组的缓存合并为 checkm/result.tsv
+        """
+        fnas = self.assess_fnas()
+        cache_dir = self.assess_dir / "checkm_cache"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        ledger = StageLedger(self.ledger_dir, "checkm")
+        checkm_dir = self.assess_dir / "checkm"
         checkm_dir.mkdir(parents=True, exist_ok=True)
-        result_file = checkm_dir.joinpath("result.tsv")
-        # * 如果结果文件已存在且不强制运行，则跳过
-        if result_file.exists() and not self.force:
-            logging.warning(f"checkM 结果文件 {result_file} 已存在, 跳过运行.")
-            return
-        # 并行太多 mamba run 会报文件锁的错误
-        checkm_cmd = f"""
-        source {ACTIVATE} qpcr
-        checkm lineage_wf \
-            -x fna --tab_table -t {self.threads} --pplacer_threads {self.threads} \
-            -f {result_file} \
-            {bins_dir} \
-            {checkm_dir}
-        conda deactivate
-        """
-        logging.debug(f"运行 checkM: {checkm_cmd}")
-        run(checkm_cmd, shell=True, check=True, executable="/bin/bash")
+        result_file = checkm_dir / "result.tsv"
+        # 变更集中撤回和变化的基因组删除缓存
+        for gnm_id in self.withdrawn_genomes() | self.delta_genomes():
+            cache_dir.joinpath(f"{gnm_id}.tsv").unlink(missing_ok=True)
+            ledger.invalidate(gnm_id)
+        if not self.force:
+            self.seed_checkm_cache(fnas, result_file, cache_dir, ledger)
+            pending = [fna for fna in fnas if not ledger.is_done(
+                fna.parent.name, [fna], [cache_dir / f"{fna.parent.name}.tsv"])]
+        else:
+            pending = fnas
+        logging.info(f"checkM 需要评估 {len(pending)} 个基因组, 复用缓存 {len(fnas) - len(pending)} 个")
+        if pending:
+            self.run_checkm_shards(pending, cache_dir, ledger)
+        # 合并当前基因组集的所有结果
+        cache_files = [cache_dir / f"{fna.parent.name}.tsv" for fna in sorted(fnas)]
+        dfs = [pd.read_csv(cache_file, sep="\t", dtype=str) for cache_file in cache_files if cache_file.exists()]
+        if dfs:
+            result_df = pd.concat(dfs, ignore_index=True)
+        else:
+            logging.warning("没有可合并的 checkM 结果, 输出空表")
+            result_df = pd.DataFrame(columns=CHECKM_RESULT_COLUMNS)
+        result_df.to_csv(result_file, sep="\t", index=False)
         run(f"{CSVTK} -t csv2xlsx {result_file}", shell=True, check=True)
 
+    def run_checkm_shards(self, pending: list[Path], cache_dir: Path, ledger: StageLedger) -> None:
+        """
+        按内存预算把基因组分成多个分片同时运行 checkM, 每个分片的结果拆分写入基因组缓存.
+        每个分片的峰值内存追加到 checkm_shard_stats.tsv, 用于校准内存模型
+        :param pending: 需要评估的基因组
+        :param cache_dir: 每个基因组的结果缓存目录
+        :param ledger: checkM 完成标记
+        :raises RuntimeError: 有分片运行失败, 成功分片的结果仍会写入缓存
+        """
+        n_shards, shard_threads, pplacer_threads = plan_checkm_shards(len(pending), self.threads, self.memory_gb)
+        logging.info(f"checkM 分为 {n_shards} 个分片, 每个分片线程数 {shard_threads}, pplacer 线程数 {pplacer_threads}")
+        run_dir = self.assess_dir / "checkm_run"
+        if run_dir.exists():
+            shutil.rmtree(run_dir)
+        # 按大小降序轮流分配, 各分片的基因组总大小接近
+        shards = [[] for _ in range(n_shards)]
+        for i, fna in enumerate(sorted(pending, key=lambda fna: fna.stat().st_size, reverse=True)):
+            shards[i % n_shards].append(fna)
+        jobs = []
+        for i, shard in enumerate(shards):
+            shard_dir = run_dir / f"shard_{i}"
+            bins_dir = shard_dir / "checkm_input"
+            bins_dir.mkdir(parents=True)
+            for fna in shard:
+                bins_dir.joinpath(fna.name).symlink_to(fna.resolve())
+            jobs.append((f"shard_{i}", checkm_lineage_wf_cmd(
+                bins_dir, shard_dir / "checkm", shard_dir / "result.tsv", shard_threads, pplacer_threads)))
+        records = run_commands_with_rusage(jobs)
+        stats_file = self.assess_dir / "checkm_shard_stats.tsv"
+        with open(stats_file, "a") as f:
+            if stats_file.stat().st_size == 0:
+                f.write("time\tshard\tgenomes\tfna_bytes\tthreads\tpplacer_threads\twall_seconds\tmax_rss_mb\treturncode\n")
+            for shard, record in zip(shards, records):
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{record['name']}\t{len(shard)}\t"
+                        f"{sum(fna.stat().st_size for fna in shard)}\t{shard_threads}\t{pplacer_threads}\t"
+                        f"{record['wall_seconds']}\t{record['max_rss_mb']}\t{record['returncode']}\n")
+        for i, (shard, record) in enumerate(zip(shards, records)):
+            if record["returncode"] != 0:
+                continue
+            run_df = pd.read_csv(run_dir / f"shard_{i}" / "result.tsv", sep="\t", dtype=str)
+            # checkM 的 Bin Id 为输入文件名去掉 .fna
+            bin2fna = {fna.stem: fna for fna in shard}
+            for bin_id, df in run_df.groupby("Bin Id"):
+                fna = bin2fna[bin_id]
+                cache_file = cache_dir / f"{fna.parent.name}.tsv"
+                df.to_csv(cache_file, sep="\t", index=False)
+                ledger.mark_done(fna.parent.name, [fna], [cache_file])
+        failed = [record["name"] for record in records if record["returncode"] != 0]
+        if failed:
+            raise RuntimeError(f"checkM 分片运行失败: {', '.join(failed)}, 见 {run_dir}")
+
+    def seed_checkm_cache(self, fnas: list[Path], result_file: Path, cache_dir: Path, ledger: StageLedger) -> None:
+        """
+        用旧版本流程的 result.tsv 补写没有缓存的基因组, 避免升级后全部重新运行 checkM
+        :param fnas: 当前基因组集
+        :param result_file: 已有的 checkM 结果文件
+        :param cache_dir: 每个基因组的结果缓存目录
+        :param ledger: checkM 完成标记
+        """
+        if not result_file.exists():
+            return
+        # 变更集中的基因组旧结果已失效
+        missing = {fna.stem: fna for fna in fnas
+                   if not ledger.marker(fna.parent.name).exists() and fna.parent.name not in self.delta_genomes()}
+        if not missing:
+            return
+        old_df = pd.read_csv(result_file, sep="\t", dtype=str)
+        for bin_id, df in old_df[old_df["Bin Id"].isin(missing)].groupby("Bin Id"):
+            fna = missing[bin_id]
+            cache_file = cache_dir / f"{fna.parent.name}.tsv"
+            df.to_csv(cache_file, sep="\t", index=False)
+            ledger.mark_done(fna.parent.name, [fna], [cache_file])
+
     def get_genome_anno_quality(self) -> None:
         """获取基因组注释质量"""
         # 输入 Prokka 注释结果的目录
         prk_dir = self.gnm_dir / "genome_annotate"
         # 获取去所有 GCF.tsv 特征文件中 rRNA, tRNA 数量
-        rna_mtrx = []
-        for feat_file in prk_dir.glob("*/*.tsv"):
-            # genomes/Coxiella_Burnetii/genome_annotate/GCA_000300315.1/GCA_000300315.1.tsv
-            gnm_num = feat_file.parent.name
-            df = pd.read_csv(feat_file, sep="\t")
-            # tRNA 数量
-            trna_count = df[df["ftype"] == "tRNA"].shape[0]
-            # rRNA 数量, 分为 16S, 23S, 5S
-            rrna_df = df[df["ftype"] == "rRNA"]
-            rrna_16s_count = rrna_df[rrna_df["product"].str.contains("16S")].shape[0]
-            rrna_23s_count = rrna_df[rrna_df["product"].str.contains("23S")].shape[0]
-            rrna_5s_count = rrna_df[rrna_df["product"].str.contains("5S")].shape[0]
-            rna_mtrx.append([gnm_num, rrna_23s_count, rrna_16s_count, rrna_5s_count, trna_count])
-        # 转换为 DataFrame
-        rna_df = pd.DataFrame(
-            rna_mtrx, columns=["genome_id", "23SrRNA", "16SrRNA", "5SrRNA", "tRNA"])
+        # genomes/Coxiella_Burnetii/genome_annotate/GCA_000300315.1/GCA_000300315.1.tsv
+        feat_files = {fna.parent.name: prk_dir / fna.parent.name / f"{fna.parent.name}.tsv"
+                      for fna in self.genome_fnas()}
+        feat_files = {gnm_id: feat_file for gnm_id, feat_file in feat_files.items() if feat_file.exists()}
+        self.assess_dir.mkdir(parents=True, exist_ok=True)
+        rna_df = collect_rna_counts(feat_files, self.threads, self.assess_dir / "rna_counts_cache.tsv")
         # 保存为 CSV
         rna_df.to_csv(self.assess_dir / "rna_quality.csv", index=False)
 
@@ -92,8 +201,8 @@ class GenomeQualityAssessor(BaseQPCR):
         # checkm 结果, 仅保留必须三列
         checkm_df = pd.read_csv(f"{self.assess_dir}/checkm/result.tsv", sep="\t",
                                 usecols=["Bin Id", "Completeness", "Contamination"])
-        checkm_df["genome_id"] = checkm_df.apply(
-            lambda row: "_".join(row["Bin Id"].split("_")[:2]), axis=1)
+        # Bin Id 为 fna 文件名去掉 .fna, 从基因组目录查 genome_id
+        checkm_df["genome_id"] = checkm_df["Bin Id"].map(self.catalog.bin_ids())
         # 重排列表顺序
         checkm_df = checkm_df[["genome_id", "Completeness", "Contamination"]]
         # 重新读一下 RNA 统计表
@@ -102,6 +211,7 @@ class GenomeQualityAssessor(BaseQPCR):
         merge_df = pd.merge(checkm_df, rna_df, on="genome_id")
         merge_df.to_excel(self.assess_dir / "checkm_rna_statistics.xlsx", index=False)
         merge_df.to_csv(self.assess_dir / "checkm_rna_statistics.csv", index=False)
+        self.catalog.set_metrics(merge_df)
 
     def filter_by_merge_df_bacteria(self):
         """
@@ -123,15 +233,58 @@ class GenomeQualityAssessor(BaseQPCR):
         )
         fltr_df["genome_id"].to_csv(
             self.assess_dir / "high_quality_genomes.txt", index=False, header=False)
+        self.record_quality(df["genome_id"], fltr_df["genome_id"])
+
+    def record_quality(self, assessed, high_quality) -> None:
+        """评估结果写入基因组目录, assess 步骤状态为 high_quality 或 low_quality"""
+        hq = set(high_quality)
+        self.catalog.set_stage(sorted(hq), "assess", "high_quality")
+        self.catalog.set_stage(sorted(set(assessed) - hq), "assess", "low_quality")
+
+
+def plan_checkm_shards(n_genomes: int, threads: int, memory_gb: float) -> tuple[int, int, int]:
+    """
+    按内存预算确定 checkM 分片方案. pplacer 内存随线程数线性增长, 优先用 1 个 pplacer 线程开更多分片,
+    只有 1 个分片时才把剩余预算给 pplacer 线程
+    :param n_genomes: 基因组数
+    :param threads: 总线程数
+    :param memory_gb: 内存预算 (GB)
+    :return: 分片数, 每个分片线程数, 每个分片 pplacer 线程数
+    """
+    per_shard = CHECKM_SHARD_BASE_MEMORY_GB + CHECKM_PPLACER_THREAD_MEMORY_GB
+    n_shards = max(1, min(int(memory_gb // per_shard), threads, -(-n_genomes // CHECKM_SHARD_MIN_GENOMES)))
+    shard_threads = max(1, threads // n_shards)
+    pplacer_threads = 1
+    if n_shards == 1:
+        pplacer_threads = max(1, min(shard_threads,
+                                     int((memory_gb - CHECKM_SHARD_BASE_MEMORY_GB) // CHECKM_PPLACER_THREAD_MEMORY_GB)))
+    return n_shards, shard_threads, pplacer_threads
+
+
+def checkm_lineage_wf_cmd(bins_dir: Path, checkm_dir: Path, result_file: Path, threads: int,
+                          pplacer_threads: int) -> tuple[list[str], dict[str, str]]:
+    """checkM lineage_wf 命令, 直接用缓存的 qpcr 环境变量执行, 不经过 mamba run, 避免并行时的文件锁错误"""
+    return tool_command("checkm", ["lineage_wf", "-x", "fna", "--tab_table", "-t", threads,
+                                   "--pplacer_threads", pplacer_threads, "-f", result_file, bins_dir, checkm_dir])
 
 
 class GenomeQualityAssessorViruses(GenomeQualityAssessor):
-    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool = False):
-        super().__init__(sci_name, genome_set_dir, threads, force)
+    def __init__(self, sci_name: str, genome_set_dir: str, threads: int, force: bool = False,
+                 changeset: bool = False, representatives_only: bool = False,
+                 memory_gb: float = CHECKM_MEMORY_BUDGET_GB, skip_outliers: bool = False,
+                 checkv_batches: int = CHECKV_BATCHES):
+        """
+        初始化病毒基因组质量评估器, 参数同 GenomeQualityAssessor
+        :checkv_batches: checkV 批次数, 基因组合并后分批运行; 0 表示每个基因组单独运行
+        """
+        super().__init__(sci_name, genome_set_dir, threads, force, changeset, representatives_only, memory_gb,
+                         skip_outliers)
+        self.checkv_batches = checkv_batches
 
     def run(self):
         """病毒基因组评估流程"""
         logging.info(f"开始病毒基因组质量评估: {self.gnm_dir}, 线程数: {self.threads}, 强制重新运行: {self.force}")
+        self.run_assembly_stats()
         self.run_checkv()
         self.filter_by_checkv()
 
@@ -144,15 +297,25 @@ class GenomeQualityAssessorViruses(GenomeQualityAssessor):
         checkv_bins_dir.mkdir(parents=True, exist_ok=True)
         # * 如果结果文件已存在且不强制运行，则跳过
         result_file = checkv_dir.joinpath("checkv_summary.tsv")
-        if result_file.exists() and not self.force:
+        fnas = self.assess_fnas()
+        if self.changeset is not None:
+            # 只评估变更集中新增和变化的基因组, 删除撤回和变化基因组的旧结果
+            for gnm_id in self.withdrawn_genomes() | self.delta_genomes():
+                shutil.rmtree(checkv_bins_dir / gnm_id, ignore_errors=True)
+            fnas = [fna for fna in fnas if fna.parent.name in self.delta_genomes()]
+        elif result_file.exists() and not self.force:
             logging.warning(f"checkV 结果文件 {result_file} 已存在, 跳过运行.")
             return
-        # 搜索所有的 fna 文件, 写入批量运行脚本
-        checkv_cmds = []
-        for fna in all_dir.glob("*/*.fna"):
-            checkv_cmd = f"source {ACTIVATE} qpcr && checkv end_to_end -t 1 -d {CHECKV_DB} {fna} {checkv_bins_dir}/{fna.parent.name} && conda deactivate"
-            checkv_cmds.append(checkv_cmd)
-        multi_run_command(checkv_cmds, self.threads)
+        if self.checkv_batches > 0:
+            self.run_checkv_batched(fnas, checkv_dir, checkv_bins_dir)
+        else:
+            # 搜索所有的 fna 文件, 写入批量运行脚本
+            checkv_cmds = []
+            for fna in fnas:
+                checkv_cmd = tool_command("checkv", ["end_to_end", "-t", 1, "-d", CHECKV_DB, fna,
+                                                     checkv_bins_dir / fna.parent.name])
+                checkv_cmds.append(checkv_cmd)
+            multi_run_command(checkv_cmds, self.threads)
         # 合并结果
         qlt_smrys = list(checkv_bins_dir.glob("*/quality_summary.tsv"))
         dfs = []
@@ -164,6 +327,58 @@ class GenomeQualityAssessorViruses(GenomeQualityAssessor):
         dfmrg.to_excel(checkv_dir / "checkv_summary.xlsx", index=False)
         dfmrg.to_csv(result_file, sep="\t", index=False)
 
+    def run_checkv_batched(self, fnas: list[Path], checkv_dir: Path, checkv_bins_dir: Path) -> None:
+        """
+        批量运行 checkV. 基因组合并为少数几个输入文件, contig 重命名为批次内编号 c{n},
+        编号到 (基因组 id, 原 contig id) 的对应关系在写入时记录, 不依赖解析 id 字符串.
+        每批一个多线程 checkV 进程, 数据库只加载一次. quality_summary.tsv 按基因组拆分回 bins/<genome_id>/,
+        与逐个基因组运行的结果一致
+        :param fnas: 需要评估的基因组
+        :param checkv_dir: checkV 结果目录
+        :param checkv_bins_dir: 每个基因组的结果目录
+        """
+        batch_dir = checkv_dir / "batches"
+        if batch_dir.exists():
+            shutil.rmtree(batch_dir)
+        batch_dir.mkdir(parents=True)
+        n_batches = min(self.checkv_batches, len(fnas))
+        if n_batches == 0:
+            return
+        # 按大小降序轮流分配, 各批次的序列总长度接近
+        batches = [[] for _ in range(n_batches)]
+        for i, fna in enumerate(sorted(fnas, key=lambda fna: fna.stat().st_size, reverse=True)):
+            batches[i % n_batches].append(fna)
+        checkv_cmds, contig_maps = [], []
+        for i, batch in enumerate(batches):
+            batch_fna = batch_dir / f"batch_{i}.fna"
+            # 批次内 contig 编号 -> (基因组 id, 原 contig id)
+            contig_map = {}
+            with open(batch_fna, "w") as fout:
+                for fna in batch:
+                    with open(fna) as fin:
+                        for line in fin:
+                            if line.startswith(">"):
+                                contig = f"c{len(contig_map)}"
+                                contig_map[contig] = (fna.parent.name, line[1:].split()[0])
+                                line = f">{contig}\n"
+                            fout.write(line)
+            contig_maps.append(contig_map)
+            pd.DataFrame([[contig, *ids] for contig, ids in contig_map.items()],
+                         columns=["batch_contig_id", "genome_id", "contig_id"]).to_csv(
+                batch_dir / f"batch_{i}.contigs.tsv", sep="\t", index=False)
+            checkv_cmds.append(tool_command("checkv", ["end_to_end", "-t", max(1, self.threads // n_batches),
+                                                       "-d", CHECKV_DB, batch_fna, batch_dir / f"batch_{i}"]))
+        multi_run_command(checkv_cmds, n_batches)
+        # 按基因组拆分, 还原 contig id
+        for i, contig_map in enumerate(contig_maps):
+            df = pd.read_csv(batch_dir / f"batch_{i}" / "quality_summary.tsv", sep="\t", dtype=str)
+            gnm_ids = df["contig_id"].map(lambda contig: contig_map[contig][0])
+            df["contig_id"] = df["contig_id"].map(lambda contig: contig_map[contig][1])
+            for gnm_id, gnm_df in df.groupby(gnm_ids, sort=False):
+                out_dir = checkv_bins_dir / gnm_id
+                out_dir.mkdir(parents=True, exist_ok=True)
+                gnm_df.to_csv(out_dir / "quality_summary.tsv", sep="\t", index=False)
+
     def filter_by_checkv(self):
         """根据 checkV 结果过滤基因组, 生成 high_quality_genomes.txt 文件"""
         checkv_dir = self.assess_dir / "checkv"
@@ -172,6 +387,7 @@ class GenomeQualityAssessorViruses(GenomeQualityAssessor):
         # 病毒 checkv
         df = pd.read_csv(restab, sep="\t", usecols=[
             "genome_id", "checkv_quality", "warnings", "completeness", "contamination"])
+        assessed = df["genome_id"].unique()
         # ! [250603 FJH] 过滤条件
         # 1.基因组质量(Checkv_Quality) 为高/中/低质量
         # 2.无warnings
@@ -184,5 +400,6 @@ class GenomeQualityAssessorViruses(GenomeQualityAssessor):
         df = df[df['warnings'].isna()][["genome_id", "completeness"]]
         # 基因组完整度
         df = df.groupby('genome_id').sum()
-        df[df['completeness'] > 90].index.to_series().to_csv(
-            out_gnm_file, index=False, header=False)
+        high_quality = df[df['completeness'] > 90].index.to_series()
+        high_quality.to_csv(out_gnm_file, index=False, header=False)
+        self.record_quality(assessed, high_quality)
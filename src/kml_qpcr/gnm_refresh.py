@@ -0,0 +1,118 @@
+from pathlib import Path
+import logging
+import shutil
+import pandas as pd
+
+from src.kml_qpcr.asmb_smry_cache import ASMB_SMRY_USECOLS
+from src.kml_qpcr.base import CHANGESET_DELTA_STATUS
+from src.kml_qpcr.gnm_catalog import GenomeCatalog
+from src.kml_qpcr.gnm_triage import triage_assemblies
+from src.kml_qpcr.gnm_download import get_taxonomy_id_from_sciname, get_assembly_summary_by_taxids, download_and_md5sum
+
+
+def refresh_genome_files(sci_name: str, genome_set_dir: str, threads: int, max_connections: int = 8,
+                         mirror: str | None = None, triage: bool = True, force: bool = False) -> None:
+    """
+    增量更新物种基因组集. 对比当前 assembly summary 和上次保存的结果, 只下载新增和变化的基因组,
+    撤回的基因组移动到 withdrawn 目录. 变更集写入 info/changeset.tsv, 供 annotate/assess/conserved 的 --changeset 使用.
+    下载失败的基因组在变更集中标记为 failed, 保存的 assembly summary 中保留其上次的记录 (新增的则不保存),
+    下次 refresh 会重新识别为新增或变化并重试
+    :sci_name: 物种学名
+    :genome_set_dir: 基因组集目录
+    :threads: 线程数, 与其他步骤保持一致
+    :max_connections: 最大并发下载数
+    :mirror: NCBI 镜像根地址, 默认直接从 NCBI 下载
+    :triage: 是否在下载前根据元数据过滤基因组, 被过滤的新增和变化基因组在变更集中标记为 excluded
+    :force: 是否强制重新下载新增的基因组, 变化的基因组总是重新下载
+    :return: None
+    """
+    logging.info(f"开始增量更新 {sci_name} 的基因组文件, 线程数: {threads}")
+    gnmdir = Path(genome_set_dir).joinpath(sci_name.replace(" ", "_"))
+    infodir = gnmdir.joinpath("info")
+    infodir.mkdir(parents=True, exist_ok=True)
+    alldir = gnmdir.joinpath("all")
+    alldir.mkdir(parents=True, exist_ok=True)
+    # 上次保存的 assembly summary, 先读入再用当前结果覆盖
+    smry_file = infodir / "assembly_summary_concat_refseq_genbank.tsv"
+    if smry_file.exists():
+        old_df = pd.read_csv(smry_file, sep="\t", dtype=object)
+    else:
+        logging.warning(f"未找到上次的 assembly summary {smry_file}, 所有基因组视为新增")
+        old_df = pd.DataFrame(columns=ASMB_SMRY_USECOLS, dtype=object)
+    taxids = get_taxonomy_id_from_sciname(sci_name, infodir)
+    new_df = get_assembly_summary_by_taxids(taxids, infodir)
+    chgset_df = diff_assembly_summaries(old_df, new_df)
+    if triage:
+        kept = triage_assemblies(new_df, infodir)["#assembly_accession"]
+        excluded = chgset_df["status"].isin(CHANGESET_DELTA_STATUS) & ~chgset_df["genome_id"].isin(kept)
+        chgset_df.loc[excluded, "status"] = "excluded"
+    logging.info(f"变更集: {chgset_df['status'].value_counts().to_dict()}")
+    # 只下载新增和变化的基因组, 变化的基因组强制重新下载
+    status = chgset_df.set_index("genome_id")["status"]
+    accs = new_df["#assembly_accession"]
+    failed = download_and_md5sum(new_df[accs.isin(status[status == "added"].index)], alldir, max_connections,
+                                 mirror, force)
+    failed += download_and_md5sum(new_df[accs.isin(status[status == "changed"].index)], alldir, max_connections,
+                                  mirror, force=True)
+    # 下载失败的新版本 accession, 其旧版本不撤回
+    failed_mask = chgset_df["genome_id"].isin(failed)
+    kept_old = set(chgset_df.loc[failed_mask, "replaces"]) - {""}
+    chgset_df.loc[failed_mask, "status"] = "failed"
+    chgset_df = chgset_df[~(chgset_df["genome_id"].isin(kept_old) & (chgset_df["status"] == "withdrawn"))]
+    status = chgset_df.set_index("genome_id")["status"]
+    withdraw_genomes(status[status == "withdrawn"].index.tolist(), gnmdir)
+    chgset_df.to_csv(infodir / "changeset.tsv", sep="\t", index=False)
+    if failed:
+        # 失败的基因组恢复上次的记录, 下次 refresh 与当前 summary 对比时仍为新增或变化
+        logging.warning(f"{len(failed)} 个基因组下载失败, 已在变更集中标记为 failed, 下次 refresh 会重试: {failed}")
+        old_accs = old_df["#assembly_accession"]
+        saved_df = pd.concat([new_df[~accs.isin(failed)], old_df[old_accs.isin(set(failed) | kept_old)]],
+                             ignore_index=True)
+        saved_df.to_csv(smry_file, sep="\t", index=False)
+
+
+def diff_assembly_summaries(old_df: pd.DataFrame, new_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    对比新旧 assembly summary
+    - added: 新增的 accession
+    - changed: 元数据变化的 accession, 或旧版本 accession 的新版本 (replaces 列为旧版本)
+    - withdrawn: 当前 summary 中不存在的 accession
+    :param old_df: 上次保存的 assembly summary
+    :param new_df: 当前 assembly summary
+    :return: 变更集 dataframe, 列为 genome_id, status, replaces
+    """
+    key = "#assembly_accession"
+    old = old_df.set_index(key).fillna("")
+    new = new_df.set_index(key).fillna("")
+    cols = [col for col in new.columns if col in old.columns]
+    added = new.index.difference(old.index)
+    withdrawn = old.index.difference(new.index)
+    common = new.index.intersection(old.index)
+    changed = common[(new.loc[common, cols] != old.loc[common, cols]).any(axis=1).to_numpy()]
+    # accession 版本号更新, 如 GCA_000001.1 -> GCA_000001.2
+    withdrawn_base = {acc.rsplit(".", 1)[0]: acc for acc in withdrawn}
+    rows = [[acc, "changed", ""] for acc in changed]
+    for acc in added:
+        replaces = withdrawn_base.get(acc.rsplit(".", 1)[0], "")
+        rows.append([acc, "changed" if replaces else "added", replaces])
+    rows += [[acc, "withdrawn", ""] for acc in withdrawn]
+    return pd.DataFrame(rows, columns=["genome_id", "status", "replaces"])
+
+
+def withdraw_genomes(genome_ids: list[str], gnmdir: Path) -> None:
+    """
+    将撤回的基因组从 all 目录移到 withdrawn 目录, 后续步骤不再处理
+    :param genome_ids: 撤回的基因组列表
+    :param gnmdir: 物种基因组目录
+    """
+    withdrawn_dir = gnmdir / "withdrawn"
+    for gid in genome_ids:
+        src = gnmdir / "all" / gid
+        if not src.exists():
+            continue
+        withdrawn_dir.mkdir(exist_ok=True)
+        if withdrawn_dir.joinpath(gid).exists():
+            shutil.rmtree(withdrawn_dir / gid)
+        shutil.move(src, withdrawn_dir / gid)
+        logging.info(f"基因组已撤回: {gid}")
+    GenomeCatalog(gnmdir).withdraw(genome_ids)
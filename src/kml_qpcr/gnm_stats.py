@@ -0,0 +1,161 @@
+from pathlib import Path
+from multiprocessing import Pool
+import logging
+import mmap
+import numpy as np
+import pandas as pd
+
+from src.utils.util_file import file_fingerprint
+from src.config.cnfg_triage import (
+    TRIAGE_MAX_CONTIG_COUNT, TRIAGE_GENOME_SIZE_DEVIATION, TRIAGE_MIN_GENOMES_FOR_SIZE,
+    ASSESS_GC_DEVIATION, ASSESS_MAX_N_FRACTION)
+
+# RNA 统计表的列
+RNA_COUNT_COLUMNS = ["23SrRNA", "16SrRNA", "5SrRNA", "tRNA"]
+# 组装统计表的列
+ASSEMBLY_STATS_COLUMNS = ["genome_id", "length", "contigs", "n50", "l50", "gc_percent", "n_fraction", "longest_contig"]
+_NEWLINE, _CR, _GT = ord("\n"), ord("\r"), ord(">")
+
+
+def fasta_stats(fna: Path) -> dict:
+    """
+    内存映射读取 fasta, 用 numpy 按字节统计. 各 contig 的长度和碱基数由累加数组在序列区间首尾相减得到
+    :param fna: 基因组 fna 文件
+    :return: 组装统计, 键见 ASSEMBLY_STATS_COLUMNS
+    """
+    stats = dict.fromkeys(ASSEMBLY_STATS_COLUMNS, 0)
+    stats["genome_id"] = fna.parent.name
+    if fna.stat().st_size == 0:
+        return stats
+    with open(fna, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = np.frombuffer(mm, dtype=np.uint8)
+        # 末尾补一个虚拟换行, 最后一行没有换行符时也能定位行尾
+        newlines = np.append(np.flatnonzero(data == _NEWLINE), len(data))
+        # 行首的 '>' 为序列头
+        heads = np.flatnonzero(data == _GT)
+        heads = heads[(heads == 0) | (data[heads - 1] == _NEWLINE)]
+        if len(heads) == 0:
+            # 关闭 mmap 前需要释放对它的引用
+            del data
+            return stats
+        # 序列区间: 头所在行的下一行开始, 到下一个头为止
+        starts = np.minimum(newlines[np.searchsorted(newlines, heads)] + 1, len(data))
+        ends = np.append(heads[1:], len(data))
+        lower = data | 0x20
+        counts = {}
+        for key, mask in [("bases", (data != _NEWLINE) & (data != _CR)),
+                          ("gc", (lower == ord("g")) | (lower == ord("c"))),
+                          ("at", (lower == ord("a")) | (lower == ord("t"))),
+                          ("n", lower == ord("n"))]:
+            cum = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+            counts[key] = cum[ends] - cum[starts]
+        del data, lower
+    lengths = counts["bases"]
+    total = int(lengths.sum())
+    sorted_lengths = np.sort(lengths)[::-1]
+    l50 = int(np.searchsorted(np.cumsum(sorted_lengths), total / 2)) + 1
+    acgt = int(counts["gc"].sum() + counts["at"].sum())
+    stats.update({
+        "length": total,
+        "contigs": len(lengths),
+        "n50": int(sorted_lengths[l50 - 1]),
+        "l50": l50,
+        "gc_percent": round(float(counts["gc"].sum()) / acgt * 100, 4) if acgt else 0,
+        "n_fraction": round(float(counts["n"].sum()) / total, 6) if total else 0,
+        "longest_contig": int(sorted_lengths[0]),
+    })
+    return stats
+
+
+def collect_assembly_stats(fnas: list[Path], threads: int) -> pd.DataFrame:
+    """
+    进程池并行统计所有基因组
+    :param fnas: 基因组 fna 文件
+    :param threads: 进程数
+    :return: 组装统计 dataframe
+    """
+    with Pool(processes=threads) as pool:
+        rows = pool.map(fasta_stats, fnas)
+    return pd.DataFrame(rows, columns=ASSEMBLY_STATS_COLUMNS).sort_values("genome_id", ignore_index=True)
+
+
+def flag_assembly_outliers(stats_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    根据组装统计标记离群基因组. 基因组大小和 GC 含量与物种中位数比较, 阈值见 cnfg_triage.py
+    :param stats_df: collect_assembly_stats 的结果
+    :return: 增加 outlier (bool) 和 reason 列的 dataframe
+    """
+    rules = pd.DataFrame({
+        "contigs": stats_df["contigs"] > TRIAGE_MAX_CONTIG_COUNT,
+        "n_fraction": stats_df["n_fraction"] > ASSESS_MAX_N_FRACTION,
+        "empty": stats_df["length"] == 0,
+    }, index=stats_df.index)
+    if stats_df.shape[0] >= TRIAGE_MIN_GENOMES_FOR_SIZE:
+        median = stats_df["length"].median()
+        rules["length"] = (stats_df["length"] - median).abs() / median > TRIAGE_GENOME_SIZE_DEVIATION
+        rules["gc_percent"] = (stats_df["gc_percent"] - stats_df["gc_percent"].median()).abs() > ASSESS_GC_DEVIATION
+    outlier = rules.any(axis=1)
+    reasons = rules.astype(int).dot(rules.columns + ";").str.rstrip(";")
+    logging.info(f"组装统计离群基因组 {outlier.sum()}/{stats_df.shape[0]}: {rules.sum().to_dict()}")
+    return stats_df.assign(outlier=outlier, reason=reasons.where(outlier, ""))
+
+
+def count_rna_features(feat_file: Path) -> list[int]:
+    """
+    逐行读取 prokka 特征表, 只解析 ftype 和 product 两列, 一次统计 rRNA (23S, 16S, 5S) 和 tRNA 数量
+    :param feat_file: prokka .tsv 特征表
+    :return: 数量, 顺序见 RNA_COUNT_COLUMNS
+    """
+    counts = dict.fromkeys(RNA_COUNT_COLUMNS, 0)
+    with open(feat_file) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        ftype_col, product_col = header.index("ftype"), header.index("product")
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            ftype = fields[ftype_col]
+            if ftype == "tRNA":
+                counts["tRNA"] += 1
+            elif ftype == "rRNA":
+                product = fields[product_col] if len(fields) > product_col else ""
+                for rrna in ["23S", "16S", "5S"]:
+                    if rrna in product:
+                        counts[f"{rrna}rRNA"] += 1
+    return [counts[col] for col in RNA_COUNT_COLUMNS]
+
+
+def _count_rna_job(job: tuple[str, Path]) -> list:
+    gnm_id, feat_file = job
+    fingerprint = file_fingerprint(feat_file)
+    return [gnm_id, fingerprint["size"], fingerprint["mtime_ns"]] + count_rna_features(feat_file)
+
+
+def collect_rna_counts(feat_files: dict[str, Path], threads: int, cache_file: Path) -> pd.DataFrame:
+    """
+    进程池并行统计所有基因组的 RNA 数量. 结果按特征表指纹缓存在 cache_file, 重新运行时只读取新增或变化的特征表
+    :param feat_files: 基因组 id -> prokka .tsv 特征表
+    :param threads: 进程数
+    :param cache_file: 缓存 tsv
+    :return: genome_id 和 RNA_COUNT_COLUMNS 列的 dataframe
+    """
+    cache_columns = ["genome_id", "size", "mtime_ns"] + RNA_COUNT_COLUMNS
+    cache = pd.DataFrame(columns=cache_columns)
+    if cache_file.exists():
+        cache = pd.read_csv(cache_file, sep="\t", dtype={"genome_id": str})
+    cached = {row[0]: list(row) for row in cache[cache_columns].itertuples(index=False)}
+    rows, jobs = [], []
+    for gnm_id, feat_file in feat_files.items():
+        fingerprint = file_fingerprint(feat_file)
+        row = cached.get(gnm_id)
+        if row is not None and row[1:3] == [fingerprint["size"], fingerprint["mtime_ns"]]:
+            rows.append(row)
+        else:
+            jobs.append((gnm_id, feat_file))
+    logging.info(f"统计 RNA 数量: {len(jobs)} 个特征表需要读取, {len(rows)} 个使用缓存")
+    if jobs:
+        with Pool(processes=threads) as pool:
+            rows += pool.map(_count_rna_job, jobs, chunksize=max(1, len(jobs) // (threads * 4)))
+    df = pd.DataFrame(rows, columns=cache_columns).sort_values("genome_id", ignore_index=True)
+    tmp_file = cache_file.with_suffix(".tmp")
+    df.to_csv(tmp_file, sep="\t", index=False)
+    tmp_file.replace(cache_file)
+    return df[["genome_id"] + RNA_COUNT_COLUMNS]
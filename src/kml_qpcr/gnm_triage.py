@@ -0,0 +1,37 @@
+from pathlib import Path
+import logging
+import pandas as pd
+
+from src.config.cnfg_triage import (
+    TRIAGE_ASSEMBLY_LEVELS, TRIAGE_MAX_CONTIG_COUNT, TRIAGE_MAX_SCAFFOLD_COUNT,
+    TRIAGE_GENOME_SIZE_DEVIATION, TRIAGE_MIN_GENOMES_FOR_SIZE)
+
+
+def triage_assemblies(rsgb_df: pd.DataFrame, infodir: Path) -> pd.DataFrame:
+    """
+    下载前根据 assembly summary 元数据过滤基因组. 规则见 cnfg_triage.py, 缺失值不过滤.
+    被过滤的基因组及原因写入 info/triage_excluded.tsv
+    :param rsgb_df: assembly summary dataframe
+    :param infodir: 输出目录
+    :return: 通过过滤的 assembly summary dataframe
+    """
+    sizes = pd.to_numeric(rsgb_df["genome_size"], errors="coerce")
+    contigs = pd.to_numeric(rsgb_df["contig_count"], errors="coerce")
+    scaffolds = pd.to_numeric(rsgb_df["scaffold_count"], errors="coerce")
+    # 每条规则一列, True 表示不通过
+    rules = pd.DataFrame({
+        "assembly_level": ~rsgb_df["assembly_level"].isin(TRIAGE_ASSEMBLY_LEVELS),
+        "contig_count": contigs > TRIAGE_MAX_CONTIG_COUNT,
+        "scaffold_count": scaffolds > TRIAGE_MAX_SCAFFOLD_COUNT,
+    }, index=rsgb_df.index)
+    if sizes.notna().sum() >= TRIAGE_MIN_GENOMES_FOR_SIZE:
+        median = sizes.median()
+        rules["genome_size"] = (sizes - median).abs() / median > TRIAGE_GENOME_SIZE_DEVIATION
+    excluded = rules.any(axis=1)
+    # 不通过的规则名用 ';' 连接作为原因
+    reasons = rules.astype(int).dot(rules.columns + ";").str.rstrip(";")
+    report = rsgb_df.loc[excluded, ["#assembly_accession", "assembly_level", "contig_count",
+                                    "scaffold_count", "genome_size"]].assign(reason=reasons[excluded])
+    report.to_csv(Path(infodir) / "triage_excluded.tsv", sep="\t", index=False)
+    logging.info(f"下载前过滤 {excluded.sum()}/{rsgb_df.shape[0]} 个基因组: {rules.sum().to_dict()}")
+    return rsgb_df[~excluded]
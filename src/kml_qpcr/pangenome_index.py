@@ -0,0 +1,171 @@
+from pathlib import Path
+import logging
+import os
+import numpy as np
+
+from src.utils.util_file import file_fingerprint
+
+
+class PangenomeIndex():
+    def __init__(self, genes: np.ndarray, gene_ptr: np.ndarray, loci: np.ndarray, locus_isolates: np.ndarray,
+                 isolates: np.ndarray):
+        """
+        Roary clustered_proteins 的解析结果, 以 CSR 形式保存:
+        基因 i 的 locus tag 为 loci[gene_ptr[i]:gene_ptr[i + 1]], 对应分离株编码为 locus_isolates 的同一区间
+        :param genes: 基因名
+        :param gene_ptr: 每个基因在 loci 中的起止位置, 长度为基因数 + 1
+        :param loci: 所有 locus tag
+        :param locus_isolates: 每个 locus tag 所属分离株在 isolates 中的编码
+        :param isolates: 分离株 id
+        """
+        self.genes = genes
+        self.gene_ptr = gene_ptr
+        self.loci = loci
+        self.locus_isolates = locus_isolates
+        self.isolates = isolates
+        self.gene_codes = {gene: i for i, gene in enumerate(genes)}
+
+    @classmethod
+    def load(cls, roary_dir: Path) -> "PangenomeIndex":
+        """
+        读取 roary_dir/clustered_proteins 的索引. 缓存为同目录下的 clustered_proteins.npz,
+        clustered_proteins 指纹变化 (如重新运行 Roary) 时重新解析
+        :param roary_dir: Roary 结果目录
+        """
+        src_file = Path(roary_dir) / "clustered_proteins"
+        cache_file = Path(roary_dir) / "clustered_proteins.npz"
+        fingerprint = file_fingerprint(src_file)
+        fingerprint = np.array([fingerprint["size"], fingerprint["mtime_ns"]], dtype=np.int64)
+        if cache_file.exists():
+            with np.load(cache_file) as npz:
+                if np.array_equal(npz["fingerprint"], fingerprint):
+                    return cls(npz["genes"], npz["gene_ptr"], npz["loci"], npz["locus_isolates"], npz["isolates"])
+        index = cls.parse(src_file)
+        tmp_file = cache_file.with_name(".clustered_proteins.tmp.npz")
+        np.savez(tmp_file, fingerprint=fingerprint, genes=index.genes, gene_ptr=index.gene_ptr, loci=index.loci,
+                 locus_isolates=index.locus_isolates, isolates=index.isolates)
+        os.replace(tmp_file, cache_file)
+        return index
+
+    @classmethod
+    def parse(cls, clustered_proteins: Path) -> "PangenomeIndex":
+        """
+        解析 clustered_proteins, 每行 "基因: locus1\tlocus2...". locus tag 为 prokka 的 {分离株 id}_{五位编号}
+        :param clustered_proteins: Roary clustered_proteins 文件
+        """
+        genes, gene_ptr, loci = [], [0], []
+        with open(clustered_proteins) as f:
+            for line in f:
+                gene, gene_cntt = line.strip().split(': ')
+                genes.append(gene)
+                loci += gene_cntt.split("\t")
+                gene_ptr.append(len(loci))
+        isolates, locus_isolates = np.unique([locus.rsplit("_", 1)[0] for locus in loci], return_inverse=True)
+        logging.info(f"解析 clustered_proteins: {len(genes)} 个基因, {len(loci)} 个 locus, {len(isolates)} 个分离株")
+        return cls(np.array(genes, dtype=str), np.array(gene_ptr, dtype=np.int64), np.array(loci, dtype=str),
+                   locus_isolates.astype(np.int32), isolates)
+
+    def gene_of_loci(self) -> np.ndarray:
+        """每个 locus 所属基因的编码"""
+        return np.repeat(np.arange(len(self.genes)), np.diff(self.gene_ptr))
+
+    def copy_numbers(self) -> np.ndarray:
+        """每个基因的 locus 数"""
+        return np.diff(self.gene_ptr)
+
+    def isolate_presence(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        基因和分离株的去重对应关系
+        :return: (基因编码, 分离株编码), 每个 (基因, 分离株) 只出现一次
+        """
+        pairs = np.unique(self.gene_of_loci().astype(np.int64) * len(self.isolates) + self.locus_isolates)
+        return pairs // len(self.isolates), pairs % len(self.isolates)
+
+    def isolate_counts(self, weights: np.ndarray | None = None) -> np.ndarray:
+        """
+        每个基因覆盖的分离株数
+        :param weights: 与 isolates 对齐的分离株权重, 默认均为 1
+        """
+        gene_codes, isolate_codes = self.isolate_presence()
+        return np.bincount(gene_codes, weights=None if weights is None else weights[isolate_codes],
+                           minlength=len(self.genes))
+
+    def single_copy(self) -> np.ndarray:
+        """每个基因在覆盖的分离株中是否均为单拷贝"""
+        return self.copy_numbers() == self.isolate_counts()
+
+    def gene_loci(self, gene: str) -> np.ndarray:
+        """基因的所有 locus tag"""
+        i = self.gene_codes[gene]
+        return self.loci[self.gene_ptr[i]:self.gene_ptr[i + 1]]
+
+    def gene_isolates(self, gene: str) -> np.ndarray:
+        """基因的所有 locus 所属分离株的编码, 顺序与 gene_loci 相同"""
+        i = self.gene_codes[gene]
+        return self.locus_isolates[self.gene_ptr[i]:self.gene_ptr[i + 1]]
+
+
+# 每个字节值中 1 的个数
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class PresenceMatrix():
+    def __init__(self, genes: np.ndarray, isolates: np.ndarray, bits: np.ndarray):
+        """
+        Roary gene_presence_absence.Rtab 的位矩阵, 每行一个基因, 每个分离株占一位 (np.packbits 按行打包)
+        :param genes: 基因名
+        :param isolates: 分离株 id, 与位的顺序一致
+        :param bits: 打包后的存在缺失矩阵, 形状为 (基因数, ceil(分离株数 / 8))
+        """
+        self.genes = genes
+        self.isolates = isolates
+        self.bits = bits
+
+    @classmethod
+    def load(cls, rtab: Path) -> "PresenceMatrix":
+        """
+        读取 Rtab 并打包为位矩阵, 缓存为同目录下的 {rtab}.npz, Rtab 指纹变化时重新读取
+        :param rtab: gene_presence_absence.Rtab
+        """
+        rtab = Path(rtab)
+        cache_file = rtab.with_name(rtab.name + ".npz")
+        fingerprint = file_fingerprint(rtab)
+        fingerprint = np.array([fingerprint["size"], fingerprint["mtime_ns"]], dtype=np.int64)
+        if cache_file.exists():
+            with np.load(cache_file) as npz:
+                if np.array_equal(npz["fingerprint"], fingerprint):
+                    return cls(npz["genes"], npz["isolates"], npz["bits"])
+        with open(rtab) as f:
+            isolates = f.readline().rstrip("\n").split("\t")[1:]
+            genes, rows = [], []
+            for line in f:
+                gene, values = line.rstrip("\n").split("\t", 1)
+                genes.append(gene)
+                rows.append(np.frombuffer(values.encode(), dtype=np.uint8)[::2] == ord("1"))
+        bits = np.packbits(np.array(rows, dtype=bool).reshape(len(genes), len(isolates)), axis=1)
+        matrix = cls(np.array(genes, dtype=str), np.array(isolates, dtype=str), bits)
+        tmp_file = cache_file.with_name(f".{rtab.name}.tmp.npz")
+        np.savez(tmp_file, fingerprint=fingerprint, genes=matrix.genes, isolates=matrix.isolates, bits=bits)
+        os.replace(tmp_file, cache_file)
+        return matrix
+
+    def row_counts(self, mask: np.ndarray | None = None) -> np.ndarray:
+        """
+        每个基因存在的分离株数, 按字节查表求和
+        :param mask: 打包后的分离株掩码, 只统计掩码内的分离株, 默认全部
+        """
+        bits = self.bits if mask is None else self.bits & mask
+        return _POPCOUNT[bits].sum(axis=1, dtype=np.int64)
+
+    def coverage(self, weights: dict[str, int] | None = None) -> np.ndarray:
+        """
+        每个基因覆盖的分离株比例 (%). 加权时按权重取值分组, 每组用掩码求和后乘以权重
+        :param weights: 分离株权重, 未列出的为 1, 默认均为 1
+        """
+        if not weights:
+            return self.row_counts() / len(self.isolates) * 100
+        islt_weights = np.array([weights.get(islt, 1) for islt in self.isolates])
+        total = np.zeros(len(self.genes))
+        for weight in np.unique(islt_weights):
+            total += weight * self.row_counts(np.packbits(islt_weights == weight))
+        return total / islt_weights.sum() * 100
@@ -0,0 +1,247 @@
+from pathlib import Path
+import logging
+import os
+import re
+import tempfile
+import numpy as np
+import pandas as pd
+
+from src.kml_qpcr.fast_annotate import read_fasta, wrap
+from src.config.cnfg_software import PANGENOME_KMER_SIZE, PANGENOME_MIN_KMER_CONTAINMENT, PANGENOME_MIN_LENGTH_RATIO
+from src.utils.util_command import run_tool
+
+# 氨基酸字母 -> 5 位编码, A-Z 为 0-25, 其他字符 (如 '*') 为 26
+_AA_CODES = np.full(256, 26, dtype=np.int64)
+_AA_CODES[np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", dtype=np.uint8)] = np.arange(26)
+# .clstr 中的成员行, 例 "0	312aa, >GCF_000000000.1_00001... *"
+_CLSTR_MEMBER = re.compile(r">(\S+?)\.\.\.")
+
+
+def kmer_codes(seq: str, k: int = PANGENOME_KMER_SIZE) -> np.ndarray:
+    """蛋白序列去重后的 k-mer 编码, 每个氨基酸 5 位"""
+    aa = _AA_CODES[np.frombuffer(seq.upper().encode(), dtype=np.uint8)]
+    n = len(aa) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    codes = np.zeros(n, dtype=np.int64)
+    for i in range(k):
+        codes = (codes << 5) | aa[i:i + n]
+    return np.unique(codes)
+
+
+class ClusterKmerIndex():
+    def __init__(self, representatives: dict[str, str], k: int = PANGENOME_KMER_SIZE):
+        """
+        簇代表蛋白序列的 k-mer 倒排索引, 在进程内把新蛋白分配到已有簇
+        :param representatives: 簇名 -> 代表蛋白序列
+        :param k: k-mer 长度
+        """
+        self.k = k
+        self.names = list(representatives)
+        self.rep_lengths = np.array([len(seq) for seq in representatives.values()])
+        per_cluster = [kmer_codes(seq, k) for seq in representatives.values()]
+        kmers = np.concatenate(per_cluster) if per_cluster else np.empty(0, dtype=np.int64)
+        clusters = np.repeat(np.arange(len(per_cluster)), [len(codes) for codes in per_cluster])
+        order = np.argsort(kmers, kind="stable")
+        # 倒排表: 第 i 个 k-mer 出现在 self.clusters[self.ptr[i]:self.ptr[i + 1]]
+        self.kmers, first = np.unique(kmers[order], return_index=True)
+        self.ptr = np.append(first, len(kmers))
+        self.clusters = clusters[order]
+
+    def assign(self, seq: str) -> str | None:
+        """
+        把蛋白分配到共有 k-mer 最多的簇, 共有比例或长度比低于阈值 (见 cnfg_software.py) 时不分配
+        :param seq: 蛋白序列
+        :return: 簇名, 未分配时为 None
+        """
+        codes = kmer_codes(seq, self.k)
+        if len(codes) == 0 or len(self.kmers) == 0:
+            return None
+        idx = np.minimum(np.searchsorted(self.kmers, codes), len(self.kmers) - 1)
+        idx = idx[self.kmers[idx] == codes]
+        if len(idx) == 0:
+            return None
+        starts, counts = self.ptr[idx], self.ptr[idx + 1] - self.ptr[idx]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        shared = np.bincount(self.clusters[np.repeat(starts, counts) + offsets])
+        # 共有 k-mer 从多到少检查前几个候选簇的长度比
+        for cluster in np.argsort(shared)[::-1][:3]:
+            if shared[cluster] / len(codes) < PANGENOME_MIN_KMER_CONTAINMENT:
+                break
+            lengths = sorted([len(seq), self.rep_lengths[cluster]])
+            if lengths[0] / lengths[1] >= PANGENOME_MIN_LENGTH_RATIO:
+                return self.names[cluster]
+        return None
+
+
+def read_clustered_proteins(clustered_proteins: Path) -> dict[str, list[str]]:
+    """读取 Roary clustered_proteins, 返回基因 -> locus tag 列表, 保持文件顺序"""
+    clusters = {}
+    with open(clustered_proteins) as f:
+        for line in f:
+            gene, gene_cntt = line.strip().split(': ')
+            clusters[gene] = gene_cntt.split("\t")
+    return clusters
+
+
+def locus_isolate(locus: str) -> str:
+    """prokka locus tag {分离株 id}_{五位编号} 所属的分离株"""
+    return locus.rsplit("_", 1)[0]
+
+
+def build_representatives(clusters: dict[str, list[str]], faas: dict[str, Path]) -> dict[str, str]:
+    """
+    从各分离株 .faa 为每个簇取第一个可用 locus 的蛋白序列作为代表序列
+    :param clusters: 基因 -> locus tag 列表
+    :param faas: 分离株 -> .faa, 只使用这些分离株的序列
+    :return: 基因 -> 代表蛋白序列, 没有可用 locus 的簇不包含在内
+    """
+    wanted = {}
+    for gene, loci in clusters.items():
+        locus = next((locus for locus in loci if locus_isolate(locus) in faas), None)
+        if locus is not None:
+            wanted.setdefault(locus_isolate(locus), {})[locus] = gene
+    reps = {}
+    for islt, loci in wanted.items():
+        proteins = read_fasta(faas[islt])
+        reps.update({gene: proteins[locus] for locus, gene in loci.items() if locus in proteins})
+    return {gene: reps[gene] for gene in clusters if gene in reps}
+
+
+def cdhit_clusters(proteins: dict[str, str], identity: float, threads: int) -> list[list[str]]:
+    """
+    cd-hit 聚类未分配的蛋白
+    :param proteins: locus tag -> 蛋白序列
+    :param identity: 序列相似度阈值 (0.4-1.0)
+    :param threads: 线程数
+    :return: 每个簇的 locus tag 列表, 代表序列在首位
+    """
+    identity = min(max(identity, 0.4), 1.0)
+    # cd-hit 要求的 word size 与相似度阈值对应
+    word_size = 5 if identity >= 0.7 else 4 if identity >= 0.6 else 3 if identity >= 0.5 else 2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_faa = Path(tmp_dir) / "unassigned.faa"
+        with open(in_faa, "w") as f:
+            for locus, seq in proteins.items():
+                f.write(f">{locus}\n{wrap(seq)}")
+        out_faa = Path(tmp_dir) / "clusters.faa"
+        run_tool("cd-hit", ["-i", in_faa, "-o", out_faa, "-c", identity, "-n", word_size,
+                            "-s", PANGENOME_MIN_LENGTH_RATIO, "-d", 0, "-M", 0, "-T", threads],
+                 capture_output=True)
+        groups = []
+        with open(f"{out_faa}.clstr") as f:
+            for line in f:
+                if line.startswith(">"):
+                    groups.append([])
+                    continue
+                locus = _CLSTR_MEMBER.search(line).group(1)
+                if line.rstrip().endswith("*"):
+                    groups[-1].insert(0, locus)
+                else:
+                    groups[-1].append(locus)
+    return groups
+
+
+def new_cluster_names(groups: list[list[str]], gene_names: dict[str, str], existing: set[str]) -> list[str]:
+    """
+    新簇命名: 与 Roary 一致, 代表序列有基因名且未被占用时用基因名, 否则为 group_N, N 接着已有编号
+    :param groups: 新簇的 locus tag 列表, 代表序列在首位
+    :param gene_names: locus tag -> prokka 基因名
+    :param existing: 已有簇名
+    """
+    used = set(existing)
+    next_group = max([int(name[6:]) for name in used if re.fullmatch(r"group_\d+", name)], default=0) + 1
+    names = []
+    for group in groups:
+        name = gene_names.get(group[0], "")
+        if not name or name in used:
+            name, next_group = f"group_{next_group}", next_group + 1
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def write_pangenome(roary_dir: Path, clusters: dict[str, list[str]], isolates: list[str]) -> None:
+    """
+    写出与 Roary 格式相同的 clustered_proteins 和 gene_presence_absence.Rtab, 先写临时文件再原子替换
+    :param roary_dir: Roary 结果目录
+    :param clusters: 基因 -> locus tag 列表
+    :param isolates: 分离株, Rtab 的列
+    """
+    tmp_file = roary_dir / ".clustered_proteins.tmp"
+    with open(tmp_file, "w") as f:
+        for gene, loci in clusters.items():
+            f.write(f"{gene}: " + "\t".join(loci) + "\n")
+    os.replace(tmp_file, roary_dir / "clustered_proteins")
+    columns = {islt: i for i, islt in enumerate(isolates)}
+    matrix = np.zeros((len(clusters), len(isolates)), dtype=np.uint8)
+    for row, loci in enumerate(clusters.values()):
+        matrix[row, [columns[locus_isolate(locus)] for locus in loci if locus_isolate(locus) in columns]] = 1
+    tmp_file = roary_dir / ".gene_presence_absence.Rtab.tmp"
+    with open(tmp_file, "w") as f:
+        f.write("Gene\t" + "\t".join(isolates) + "\n")
+        for gene, row in zip(clusters, matrix):
+            f.write(gene + "\t" + "\t".join(row.astype(str)) + "\n")
+    os.replace(tmp_file, roary_dir / "gene_presence_absence.Rtab")
+
+
+def write_representatives(reps_file: Path, reps: dict[str, str]) -> None:
+    """保存簇代表序列, 下一次增量更新直接使用"""
+    tmp_file = reps_file.with_name(f".{reps_file.name}.tmp")
+    with open(tmp_file, "w") as f:
+        for gene, seq in reps.items():
+            f.write(f">{gene}\n{wrap(seq)}")
+    os.replace(tmp_file, reps_file)
+
+
+def update_pangenome(roary_dir: Path, removed: set[str], added: list[str], isolates: list[str],
+                     faas: dict[str, Path], feat_files: dict[str, Path], identity: float, threads: int) -> None:
+    """
+    增量更新泛基因组, 不重新运行 Roary:
+    1. 删除移除分离株的 locus, 没有 locus 的簇一并删除;
+    2. 新分离株的蛋白按 k-mer 索引分配到已有簇 (与簇代表序列比较);
+    3. 未分配的蛋白用 cd-hit 聚类为新簇;
+    4. 写出 clustered_proteins, gene_presence_absence.Rtab 和簇代表序列 cluster_representatives.faa
+    :param roary_dir: 上一次的 Roary 结果目录
+    :param removed: 需要移除的分离株, 包括撤回的和内容变化 (按新分离株重新加入) 的
+    :param added: 新加入的分离株
+    :param isolates: 更新后的全部分离株
+    :param faas: 分离株 -> prokka .faa, 需要包含 added 和保留的分离株
+    :param feat_files: 分离株 -> prokka .tsv 特征表, 用于新簇命名
+    :param identity: cd-hit 序列相似度阈值
+    :param threads: 线程数
+    """
+    clusters = read_clustered_proteins(roary_dir / "clustered_proteins")
+    reps_file = roary_dir / "cluster_representatives.faa"
+    if reps_file.exists():
+        reps = read_fasta(reps_file)
+    else:
+        # 早期版本没有保存代表序列, 从保留分离株的 .faa 中提取
+        reps = build_representatives(clusters, {islt: faa for islt, faa in faas.items() if islt not in removed})
+    clusters = {gene: [locus for locus in loci if locus_isolate(locus) not in removed] for gene, loci in clusters.items()}
+    clusters = {gene: loci for gene, loci in clusters.items() if loci}
+    reps = {gene: reps[gene] for gene in clusters if gene in reps}
+    index = ClusterKmerIndex(reps)
+    unassigned, total = {}, 0
+    for islt in added:
+        proteins = read_fasta(faas[islt])
+        total += len(proteins)
+        for locus, seq in proteins.items():
+            gene = index.assign(seq)
+            if gene is None:
+                unassigned[locus] = seq
+            else:
+                clusters[gene].append(locus)
+    logging.info(f"增量泛基因组: 移除 {len(removed)} 个分离株, 新增 {len(added)} 个分离株, "
+                 f"{total - len(unassigned)} 个蛋白分配到已有簇, {len(unassigned)} 个蛋白重新聚类")
+    if unassigned:
+        groups = cdhit_clusters(unassigned, identity, threads)
+        gene_names = {}
+        for islt in added:
+            df = pd.read_csv(feat_files[islt], sep="\t", usecols=["locus_tag", "gene"], dtype=str)
+            gene_names.update(dict(zip(df["locus_tag"], df["gene"].fillna(""))))
+        for name, group in zip(new_cluster_names(groups, gene_names, set(clusters)), groups):
+            clusters[name] = group
+            reps[name] = unassigned[group[0]]
+    write_pangenome(roary_dir, clusters, isolates)
+    write_representatives(reps_file, reps)
@@ -0,0 +1,90 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+
+from src.utils.util_file import file_fingerprint
+
+
+class StageLedger():
+    def __init__(self, ledger_dir: Path, stage: str):
+        """
+        按基因组记录每个步骤的完成状态. 每个基因组一个 json 标记, 先写临时文件再原子替换,
+        记录输入文件指纹 (大小, 修改时间) 和输出文件校验和. 输入变化, 输出缺失或被改动时视为未完成.
+        :param ledger_dir: 账本根目录, 一般为物种目录下的 ledger
+        :param stage: 步骤名, 如 prokka, gene_index
+        """
+        self.stage_dir = Path(ledger_dir) / stage
+        self.stage = stage
+
+    def marker(self, gnm_id: str) -> Path:
+        return self.stage_dir / f"{gnm_id}.json"
+
+    def mark_done(self, gnm_id: str, inputs: list[Path], outputs: list[Path]) -> None:
+        """
+        记录基因组已完成
+        :param gnm_id: 基因组 id
+        :param inputs: 输入文件
+        :param outputs: 输出文件或目录
+        """
+        self.stage_dir.mkdir(parents=True, exist_ok=True)
+        record = {
+            "stage": self.stage,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "inputs": {str(path): file_fingerprint(path) for path in inputs},
+            "outputs": {str(path): {"fingerprint": path_fingerprint(path), "sha256": path_sha256(path)}
+                        for path in outputs},
+        }
+        tmp_file = self.marker(gnm_id).with_suffix(".json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp_file, self.marker(gnm_id))
+
+    def is_done(self, gnm_id: str, inputs: list[Path], outputs: list[Path]) -> bool:
+        """
+        基因组是否已完成且结果仍然有效. 输出指纹未变时不重新计算校验和
+        :param gnm_id: 基因组 id
+        :param inputs: 输入文件
+        :param outputs: 输出文件或目录
+        """
+        marker = self.marker(gnm_id)
+        if not marker.exists():
+            return False
+        with open(marker) as f:
+            record = json.load(f)
+        if record["inputs"] != {str(path): file_fingerprint(path) for path in inputs if path.exists()}:
+            return False
+        if set(record["outputs"]) != {str(path) for path in outputs}:
+            return False
+        for path in outputs:
+            if not path.exists():
+                return False
+            expected = record["outputs"][str(path)]
+            if path_fingerprint(path) != expected["fingerprint"] and path_sha256(path) != expected["sha256"]:
+                return False
+        return True
+
+    def invalidate(self, gnm_id: str) -> None:
+        """删除基因组的完成标记"""
+        self.marker(gnm_id).unlink(missing_ok=True)
+
+
+def path_fingerprint(path: Path) -> dict:
+    """文件指纹; 目录为所有文件的相对路径和指纹"""
+    if path.is_dir():
+        return {str(f.relative_to(path)): file_fingerprint(f) for f in sorted(path.rglob("*")) if f.is_file()}
+    return file_fingerprint(path)
+
+
+def path_sha256(path: Path) -> str:
+    """文件内容 sha256; 目录依次计算每个文件的相对路径和内容"""
+    sha256 = hashlib.sha256()
+    files = [f for f in sorted(path.rglob("*")) if f.is_file()] if path.is_dir() else [path]
+    for file in files:
+        if path.is_dir():
+            sha256.update(str(file.relative_to(path)).encode() + b"\0")
+        with open(file, "rb") as f:
+            while chunk := f.read(1 << 20):
+                sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,171 @@
+from pathlib import Path
+from functools import cache
+import logging
+import pickle
+import numpy as np
+
+from src.config.cnfg_database import TAXONKIT_DB, TAXONOMY_CACHE
+from src.utils.util_file import file_fingerprint
+
+
+class TaxonomyTree():
+    def __init__(self, parents: np.ndarray, rank_codes: np.ndarray, ranks: list[str],
+                 sci_names: dict[str, int], ambiguous: dict[str, list[int]], merged: dict[int, int]):
+        """
+        NCBI taxonomy 数组树. 以 taxid 为下标保存父节点和分类级别, 子节点用 CSR 数组保存.
+        一般通过 load_taxonomy_tree() 获取进程内共享的实例.
+        :param parents: 父节点数组, parents[taxid] 为父节点 taxid, 0 表示不存在
+        :param rank_codes: 分类级别编码数组, ranks[rank_codes[taxid]] 为分类级别
+        :param ranks: 分类级别名称表
+        :param sci_names: 小写科学名 -> taxid
+        :param ambiguous: 重名的小写科学名 -> taxid 列表
+        :param merged: 已合并的旧 taxid -> 新 taxid
+        """
+        self.parents = parents
+        self.rank_codes = rank_codes
+        self.ranks = ranks
+        self.sci_names = sci_names
+        self.ambiguous = ambiguous
+        self.merged = merged
+        # 子节点 CSR: children[child_offsets[t]:child_offsets[t + 1]] 为 t 的子节点, 根节点 1 不算作自己的子节点
+        valid = np.flatnonzero(parents)
+        valid = valid[valid != parents[valid]]
+        order = np.argsort(parents[valid], kind="stable")
+        self.children = valid[order].astype(np.int32)
+        counts = np.bincount(parents[valid], minlength=len(parents))
+        self.child_offsets = np.zeros(len(parents) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.child_offsets[1:])
+
+    @classmethod
+    def from_dump(cls, taxdump_dir: str) -> "TaxonomyTree":
+        """
+        解析 taxdump 目录的 nodes.dmp, names.dmp 和 merged.dmp
+        :param taxdump_dir: taxdump 目录, 即 TAXONKIT_DB
+        """
+        taxdump_dir = Path(taxdump_dir)
+        logging.info(f"解析 taxonomy 数据库: {taxdump_dir}")
+        taxids, parent_ids, rank_names = [], [], []
+        with open(taxdump_dir / "nodes.dmp") as f:
+            for line in f:
+                fields = line.split("\t|\t", 3)
+                taxids.append(int(fields[0]))
+                parent_ids.append(int(fields[1]))
+                rank_names.append(fields[2])
+        ranks = sorted(set(rank_names))
+        rank_index = {rank: i for i, rank in enumerate(ranks)}
+        size = max(taxids) + 1
+        parents = np.zeros(size, dtype=np.int32)
+        parents[taxids] = parent_ids
+        rank_codes = np.zeros(size, dtype=np.uint8)
+        rank_codes[taxids] = [rank_index[rank] for rank in rank_names]
+        sci_names, ambiguous = {}, {}
+        with open(taxdump_dir / "names.dmp") as f:
+            for line in f:
+                if not line.endswith("scientific name\t|\n"):
+                    continue
+                taxid, name = line.split("\t|\t", 2)[:2]
+                name = name.lower()
+                if name in sci_names:
+                    ambiguous.setdefault(name, [sci_names[name]]).append(int(taxid))
+                else:
+                    sci_names[name] = int(taxid)
+        merged = {}
+        if taxdump_dir.joinpath("merged.dmp").exists():
+            with open(taxdump_dir / "merged.dmp") as f:
+                for line in f:
+                    old, new = line.rstrip("\t|\n").split("\t|\t")
+                    merged[int(old)] = int(new)
+        return cls(parents, rank_codes, ranks, sci_names, ambiguous, merged)
+
+    @classmethod
+    def load(cls, taxdump_dir: str, cache_file: str) -> "TaxonomyTree":
+        """
+        读取 pickle 快照, 快照不存在或 taxdump 文件变化时重新解析并写入快照
+        :param taxdump_dir: taxdump 目录
+        :param cache_file: 快照文件
+        """
+        cache_file = Path(cache_file)
+        fingerprint = {name: file_fingerprint(Path(taxdump_dir) / name)
+                       for name in ["nodes.dmp", "names.dmp"]}
+        if cache_file.exists():
+            with open(cache_file, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot["fingerprint"] == fingerprint:
+                return snapshot["tree"]
+        tree = cls.from_dump(taxdump_dir)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump({"fingerprint": fingerprint, "tree": tree}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_file.replace(cache_file)
+        return tree
+
+    def resolve(self, taxid: int) -> int:
+        """
+        将已合并的旧 taxid 转为新 taxid
+        :raises KeyError: taxid 不存在
+        """
+        taxid = self.merged.get(int(taxid), int(taxid))
+        if not (0 < taxid < len(self.parents)) or self.parents[taxid] == 0:
+            raise KeyError(f"taxid 不存在: {taxid}")
+        return taxid
+
+    def name2taxid(self, name: str) -> int:
+        """
+        科学名转 taxid, 不区分大小写
+        :raises KeyError: 科学名不存在 (或为别名)
+        :raises ValueError: 科学名对应多个 taxid
+        """
+        name = name.strip().lower()
+        if name in self.ambiguous:
+            raise ValueError(f"科学名对应多个 taxid: {name} {self.ambiguous[name]}")
+        return self.sci_names[name]
+
+    def rank(self, taxid: int) -> str:
+        """分类级别"""
+        return self.ranks[self.rank_codes[self.resolve(taxid)]]
+
+    def descendants(self, taxid: int) -> list[int]:
+        """包括自身在内的所有子孙节点, 先序遍历, 同 taxonkit list"""
+        taxid = self.resolve(taxid)
+        result, stack = [], [taxid]
+        while stack:
+            node = stack.pop()
+            result.append(node)
+            stack.extend(self.children[self.child_offsets[node]:self.child_offsets[node + 1]][::-1].tolist())
+        return result
+
+    def lineage(self, taxid: int) -> list[int]:
+        """从根节点到 taxid 的路径"""
+        node = self.resolve(taxid)
+        path = [node]
+        while self.parents[node] != node:
+            node = int(self.parents[node])
+            path.append(node)
+        return path[::-1]
+
+    def is_descendant(self, taxid: int, ancestor: int) -> bool:
+        """taxid 是否为 ancestor 或其子孙节点"""
+        ancestor = self.resolve(ancestor)
+        node = self.resolve(taxid)
+        while node != ancestor:
+            if self.parents[node] == node:
+                return False
+            node = int(self.parents[node])
+        return True
+
+    def lca(self, taxids: list[int]) -> int:
+        """多个 taxid 的最近公共祖先"""
+        lineages = [self.lineage(taxid) for taxid in taxids]
+        common = lineages[0][0]
+        for nodes in zip(*lineages):
+            if len(set(nodes)) != 1:
+                break
+            common = nodes[0]
+        return common
+
+
+@cache
+def load_taxonomy_tree() -> TaxonomyTree:
+    """进程内共享的 taxonomy 树, 下载和特异性评估等步骤只加载一次"""
+    return TaxonomyTree.load(TAXONKIT_DB, TAXONOMY_CACHE)
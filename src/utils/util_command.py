@@ -1,7 +1,23 @@
-from subprocess import run
+from subprocess import run, CalledProcessError, Popen, CompletedProcess
 from multiprocessing import Pool
-from functools import partial
-from subprocess import run, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from pathlib import Path
+from typing import Callable
+import json
+import logging
+import math
+import os
+import shutil
+import time
+
+from src.config.cnfg_software import ACTIVATE, TOOL_ENVS, CONDA_ENV_CACHE_DIR
+from src.utils.util_file import file_fingerprint
+
+# 命令: shell 命令字符串, 或 tool_command() 返回的 (argv, env)
+Command = str | tuple[list[str], dict[str, str]]
+# 激活环境后与具体 shell 相关, 不需要传给子进程的变量
+_SHELL_ENV_VARS = {"_", "SHLVL", "PWD", "OLDPWD"}
 
 
 def execute_cmd_and_get_stdout(cmd: str) -> str:
@@ -19,13 +35,170 @@ def execute_cmd_and_get_stdout(cmd: str) -> str:
         raise RuntimeError(f"命令执行失败: {cmd}\n错误信息: {e.stderr}")
 
 
-def multi_run_command(cmds: list[str], threads: int) -> None:
+def multi_run_command(cmds: list[Command], threads: int) -> None:
     """
-    使用多线程执行一组 shell 命令.
+    使用多线程执行一组命令.
 
-    :param cmds: 要执行的命令列表.
+    :param cmds: 要执行的命令列表, shell 命令或 tool_command() 返回的 (argv, env).
     :param threads: 线程数.
     """
-    _run = partial(run, shell=True, check=True, executable="/bin/bash")
     with Pool(processes=threads) as pool:
-        pool.map(_run, cmds)
+        pool.map(run_command, cmds)
+
+
+def run_command(cmd: Command, **kwargs) -> CompletedProcess:
+    """
+    执行单个命令, shell 命令用 bash 执行, (argv, env) 直接执行
+    :raises CalledProcessError: 命令执行失败
+    """
+    if isinstance(cmd, str):
+        return run(cmd, shell=True, check=True, executable="/bin/bash", **kwargs)
+    argv, env = cmd
+    return run(argv, env=env, check=True, **kwargs)
+
+
+@cache
+def conda_env(env_name: str) -> dict[str, str]:
+    """
+    conda 环境激活后的环境变量. 每个环境只 source 一次 activate, 结果缓存在进程内和 CONDA_ENV_CACHE_DIR,
+    activate 脚本或环境的 conda-meta/history 变化 (安装/更新软件) 后重新解析
+    :param env_name: conda 环境名
+    :return: 环境变量
+    :raises RuntimeError: 环境激活失败
+    """
+    env_dir = Path(ACTIVATE).parent.parent / "envs" / env_name
+    history = env_dir / "conda-meta/history"
+    fingerprint = {
+        "activate": file_fingerprint(ACTIVATE),
+        "history": file_fingerprint(history) if history.exists() else None,
+    }
+    cache_file = Path(CONDA_ENV_CACHE_DIR) / f"{env_name}.json"
+    if cache_file.exists():
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["fingerprint"] == fingerprint:
+            return cached["env"]
+    logging.info(f"解析 conda 环境: {env_name}")
+    try:
+        res = run(["bash", "-c", f"source {ACTIVATE} {env_name} && env -0"], capture_output=True, check=True)
+    except CalledProcessError as e:
+        raise RuntimeError(f"conda 环境激活失败: {env_name}\n错误信息: {e.stderr.decode(errors='replace')}")
+    env = {}
+    for item in res.stdout.decode().split("\0"):
+        key, sep, value = item.partition("=")
+        if sep and key not in _SHELL_ENV_VARS:
+            env[key] = value
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump({"fingerprint": fingerprint, "env": env}, f, indent=2)
+    tmp_file.replace(cache_file)
+    return env
+
+
+def tool_command(tool: str, args: list) -> tuple[list[str], dict[str, str]]:
+    """
+    生成在 conda 环境中直接执行软件的命令, 不经过 shell 和 conda activate
+    :param tool: 软件名, 环境见 TOOL_ENVS
+    :param args: 软件参数
+    :return: (argv, env)
+    :raises RuntimeError: 环境中找不到该软件
+    """
+    env = conda_env(TOOL_ENVS[tool])
+    exe = shutil.which(tool, path=env.get("PATH"))
+    if exe is None:
+        raise RuntimeError(f"conda 环境 {TOOL_ENVS[tool]} 中找不到软件: {tool}")
+    return [exe, *map(str, args)], env
+
+
+def run_tool(tool: str, args: list, **kwargs) -> CompletedProcess:
+    """
+    在 conda 环境中直接执行软件
+    :param tool: 软件名, 环境见 TOOL_ENVS
+    :param args: 软件参数
+    :param kwargs: 传给 subprocess.run 的其他参数, 如 capture_output
+    :raises CalledProcessError: 软件执行失败
+    """
+    cmd = tool_command(tool, args)
+    logging.debug(f"运行: {' '.join(cmd[0])}")
+    return run_command(cmd, **kwargs)
+
+
+def schedule_run_commands(jobs: list[tuple[str, int, Callable[[int], Command]]], threads: int,
+                          max_cpu: int | None = None, report_file: Path | None = None) -> None:
+    """
+    按任务大小调度执行一组命令. 任务按大小降序排列, 每个任务分配的核心数只按一条规则计算:
+    按任务大小占未完成总工作量 (排队和运行中任务的大小之和, 含自身) 的比例分配, ceil(threads * size / 未完成总大小),
+    至少 1 个, 不超过 max_cpu. 队列中最大的任务排在最前, 空闲核心不足其份额时等待运行中的任务结束,
+    空出的核心为它保留, 不派发给后面较小的任务. 随着任务完成未完成总工作量减少, 剩下的大任务分到更多核心.
+
+    :param jobs: 任务列表, 每个任务为 (名称, 大小, 生成命令的函数), 函数参数为分配的核心数.
+    :param threads: 总核心数.
+    :param max_cpu: 单个任务最多分配的核心数, 默认不限制.
+    :param report_file: 每个任务耗时报告 tsv, 列为 name, size, cpu, start, end, wall_seconds, returncode.
+    :raises RuntimeError: 有任务执行失败, 其他任务仍会执行完.
+    """
+    max_cpu = min(max_cpu or threads, threads)
+    pending = sorted(jobs, key=lambda job: job[1], reverse=True)
+    running, records = [], []
+    free = threads
+    # 排队和运行中任务的大小之和
+    outstanding = sum(job[1] for job in pending)
+    t0 = time.monotonic()
+    while pending or running:
+        # 派发: 队首任务按比例分配核心, 空闲核心不足时等待, 为它保留核心
+        while pending:
+            name, size, make_cmd = pending[0]
+            cpu = min(max_cpu, max(1, math.ceil(threads * size / outstanding))) if outstanding > 0 else 1
+            if cpu > free:
+                break
+            pending.pop(0)
+            cmd = make_cmd(cpu)
+            if isinstance(cmd, str):
+                proc = Popen(cmd, shell=True, executable="/bin/bash")
+            else:
+                proc = Popen(cmd[0], env=cmd[1])
+            running.append((proc, name, size, cpu, time.monotonic()))
+            free -= cpu
+        time.sleep(0.2)
+        for job in [job for job in running if job[0].poll() is not None]:
+            proc, name, size, cpu, start = job
+            running.remove(job)
+            free += cpu
+            outstanding -= size
+            end = time.monotonic()
+            records.append([name, size, cpu, round(start - t0, 2), round(end - t0, 2), round(end - start, 2),
+                            proc.returncode])
+    makespan = time.monotonic() - t0
+    logging.info(f"共 {len(records)} 个任务, 总耗时 {makespan:.1f}s, 任务耗时之和 {sum(r[5] for r in records):.1f}s")
+    if report_file is not None:
+        with open(report_file, "w") as f:
+            f.write("name\tsize\tcpu\tstart\tend\twall_seconds\treturncode\n")
+            for record in records:
+                f.write("\t".join(map(str, record)) + "\n")
+    failed = [r[0] for r in records if r[6] != 0]
+    if failed:
+        raise RuntimeError(f"{len(failed)} 个任务执行失败: {', '.join(failed)}")
+
+
+def run_commands_with_rusage(jobs: list[tuple[str, Command]]) -> list[dict]:
+    """
+    同时执行一组命令, 用 os.wait4 记录每个命令 (含其子进程) 的峰值内存
+    :param jobs: 任务列表, 每个任务为 (名称, 命令)
+    :return: 每个任务的 name, returncode, wall_seconds, max_rss_mb, 顺序与 jobs 相同. 失败的任务不会抛出异常
+    """
+    def _run(job: tuple[str, Command]) -> dict:
+        name, cmd = job
+        start = time.monotonic()
+        if isinstance(cmd, str):
+            proc = Popen(cmd, shell=True, executable="/bin/bash")
+        else:
+            proc = Popen(cmd[0], env=cmd[1])
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # Linux 下 ru_maxrss 单位为 KB
+        return {"name": name, "returncode": proc.returncode, "wall_seconds": round(time.monotonic() - start, 2),
+                "max_rss_mb": round(rusage.ru_maxrss / 1024, 1)}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as pool:
+        return list(pool.map(_run, jobs))
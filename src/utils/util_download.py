@@ -0,0 +1,249 @@
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+import hashlib
+import http.client
+import logging
+import threading
+import time
+import zlib
+
+
+class RetryableDownloadError(Exception):
+    """可重试的下载错误, 如 5xx, 连接中断, 内容不完整"""
+
+
+class DownloadManifest():
+    def __init__(self, manifest_file: Path):
+        """
+        下载清单, 追加写入的 TSV, 同一文件以最后一条记录为准. 多线程共享.
+        :param manifest_file: 清单文件路径
+        """
+        self.manifest_file = Path(manifest_file)
+        self.columns = ["time", "file", "url", "bytes", "status", "attempts", "md5", "message"]
+        self._lock = threading.Lock()
+        if not self.manifest_file.exists():
+            self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.manifest_file, "w") as f:
+                f.write("\t".join(self.columns) + "\n")
+
+    def record(self, **fields) -> None:
+        """追加一条文件进度记录"""
+        fields.setdefault("time", time.strftime("%Y-%m-%d %H:%M:%S"))
+        line = "\t".join(str(fields.get(col, "")).replace("\t", " ").replace("\n", " ") for col in self.columns)
+        with self._lock, open(self.manifest_file, "a") as f:
+            f.write(line + "\n")
+
+    def load(self) -> dict[str, dict]:
+        """读取清单, 返回 文件路径 -> 最后一条记录"""
+        records = {}
+        with open(self.manifest_file) as f:
+            columns = next(f).rstrip("\n").split("\t")
+            for line in f:
+                rec = dict(zip(columns, line.rstrip("\n").split("\t")))
+                records[rec["file"]] = rec
+        return records
+
+
+class Md5GunzipSink():
+    def __init__(self, out_file: Path, expected_md5: str | None):
+        """
+        下载流处理: 边下载边计算压缩文件 md5 并解压写入 out_file, 避免下载后再读盘校验和解压.
+        解压结果先写入 out_file.part, md5 校验通过后才重命名为 out_file.
+        :param out_file: 解压后的文件, 如 xxx_genomic.fna
+        :param expected_md5: md5checksums.txt 中的期望值, 为 None 时不校验
+        """
+        self.out_file = Path(out_file)
+        self.part = self.out_file.with_name(self.out_file.name + ".part")
+        self.expected_md5 = expected_md5
+        self._out = None
+
+    def reset(self) -> None:
+        """从头开始处理, 每次下载尝试前调用"""
+        self.abort()
+        self.md5 = hashlib.md5()
+        self.inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        self._out = open(self.part, "wb")
+
+    def update(self, chunk: bytes) -> None:
+        """处理一块压缩数据, 支持多个 gzip member 拼接的文件"""
+        self.md5.update(chunk)
+        data = self.inflater.decompress(chunk)
+        while self.inflater.eof and self.inflater.unused_data:
+            rest = self.inflater.unused_data
+            self.inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            data += self.inflater.decompress(rest)
+        self._out.write(data)
+
+    def finish(self) -> bool:
+        """
+        结束写入并校验 md5
+        :return: 校验是否通过, 不通过时删除解压结果
+        """
+        self._out.write(self.inflater.flush())
+        self._out.close()
+        self._out = None
+        if self.inflater.eof and (self.expected_md5 is None or self.md5.hexdigest() == self.expected_md5):
+            self.part.rename(self.out_file)
+            return True
+        self.part.unlink()
+        return False
+
+    def abort(self) -> None:
+        """下载失败时关闭并删除未完成的解压结果"""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+            self.part.unlink(missing_ok=True)
+
+
+class Downloader():
+    def __init__(self, retries: int = 5, backoff: float = 2.0, timeout: int = 60, chunk_size: int = 1 << 20):
+        """
+        支持断点续传和失败重试的下载器. 每个线程为每个主机保持一个持久 HTTP 连接, 可在线程池中共享.
+        支持 http, https 和 file 协议, file 协议用于本地镜像.
+        :param retries: 单个文件最大重试次数
+        :param backoff: 重试等待基数(秒), 指数退避
+        :param timeout: 连接超时(秒)
+        :param chunk_size: 流式写入块大小
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+
+    def fetch(self, url: str, dest: Path, manifest: DownloadManifest | None = None,
+              sink: Md5GunzipSink | None = None) -> int:
+        """
+        下载 url 到 dest. 先写入 dest.part, 完成后重命名; 存在 .part 时从断点继续.
+        :param url: 下载地址
+        :param dest: 目标文件
+        :param manifest: 下载清单, 记录每个文件的进度
+        :param sink: 流处理器, 下载的数据同时交给它处理. 续传时先用已下载部分重建其状态
+        :return: 文件字节数
+        :raises RuntimeError: 重试次数用完或不可重试的错误
+        """
+        dest = Path(dest)
+        part = dest.with_name(dest.name + ".part")
+        for attempt in range(1, self.retries + 1):
+            try:
+                if sink:
+                    self._prime_sink(sink, part)
+                if urlparse(url).scheme == "file":
+                    self._fetch_file(url, part, sink)
+                else:
+                    self._fetch_http(url, part, sink)
+                part.rename(dest)
+                size = dest.stat().st_size
+                if manifest:
+                    manifest.record(file=dest, url=url, bytes=size, status="done", attempts=attempt)
+                return size
+            except RuntimeError as e:
+                if sink:
+                    sink.abort()
+                if manifest:
+                    manifest.record(file=dest, url=url, status="failed", attempts=attempt, message=e)
+                raise
+            except (RetryableDownloadError, OSError, http.client.HTTPException) as e:
+                self._close_conn(url)
+                if manifest:
+                    manifest.record(file=dest, url=url, bytes=part.stat().st_size if part.exists() else 0,
+                                    status="retry", attempts=attempt, message=e)
+                if attempt == self.retries:
+                    break
+                wait = min(self.backoff * 2 ** (attempt - 1), 60)
+                logging.warning(f"下载失败, {wait:.0f}s 后重试 ({attempt}/{self.retries}): {url} {e}")
+                time.sleep(wait)
+        if sink:
+            sink.abort()
+        if manifest:
+            manifest.record(file=dest, url=url, status="failed", attempts=self.retries)
+        raise RuntimeError(f"下载失败, 已重试 {self.retries} 次: {url}")
+
+    def _prime_sink(self, sink: Md5GunzipSink, part: Path) -> None:
+        """重置流处理器, 并读入已下载的部分. 只在续传时读盘"""
+        sink.reset()
+        if part.exists():
+            with open(part, "rb") as f:
+                while chunk := f.read(self.chunk_size):
+                    sink.update(chunk)
+
+    def _fetch_file(self, url: str, part: Path, sink: Md5GunzipSink | None = None) -> None:
+        """本地镜像, 从 .part 当前大小处续写"""
+        src = Path(unquote(urlparse(url).path))
+        if not src.exists():
+            raise RuntimeError(f"镜像文件不存在: {src}")
+        offset = part.stat().st_size if part.exists() else 0
+        with open(src, "rb") as fin, open(part, "ab") as fout:
+            fin.seek(offset)
+            while chunk := fin.read(self.chunk_size):
+                fout.write(chunk)
+                if sink:
+                    sink.update(chunk)
+
+    def _fetch_http(self, url: str, part: Path, sink: Md5GunzipSink | None = None, redirects: int = 5) -> None:
+        """HTTP Range 续传, 服务器不支持 Range 时从头下载"""
+        parsed = urlparse(url)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        conn = self._get_conn(parsed.scheme, parsed.netloc)
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        if resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+            resp.read()
+            return self._fetch_http(resp.getheader("Location"), part, sink, redirects - 1)
+        # 已经下载完整
+        if resp.status == 416:
+            resp.read()
+            return
+        if resp.status >= 500 or resp.status == 429:
+            resp.read()
+            raise RetryableDownloadError(f"HTTP {resp.status}")
+        if resp.status not in (200, 206):
+            resp.read()
+            raise RuntimeError(f"HTTP {resp.status}: {url}")
+        mode = "ab" if resp.status == 206 else "wb"
+        # 服务器不支持 Range, 从头下载
+        if sink and mode == "wb" and offset:
+            sink.reset()
+        expected = resp.getheader("Content-Length")
+        received = 0
+        with open(part, mode) as f:
+            while chunk := resp.read(self.chunk_size):
+                f.write(chunk)
+                if sink:
+                    sink.update(chunk)
+                received += len(chunk)
+        if expected is not None and received < int(expected):
+            raise RetryableDownloadError(f"内容不完整 {received}/{expected}")
+
+    def _get_conn(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        """获取当前线程到该主机的持久连接"""
+        conns = self._local.__dict__.setdefault("conns", {})
+        if (scheme, netloc) not in conns:
+            conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conns[(scheme, netloc)] = conn_class(netloc, timeout=self.timeout)
+        return conns[(scheme, netloc)]
+
+    def _close_conn(self, url: str) -> None:
+        """出错后关闭当前线程的连接, 下次重新建立"""
+        parsed = urlparse(url)
+        conn = self._local.__dict__.get("conns", {}).pop((parsed.scheme, parsed.netloc), None)
+        if conn:
+            conn.close()
+
+
+def mirror_url(url: str, mirror: str | None) -> str:
+    """
+    将 NCBI 地址替换为镜像地址, 保留路径部分. ftp:// 地址改用 https 下载
+    :param url: 原始地址, 如 https://ftp.ncbi.nlm.nih.gov/genomes/all/GCA/000/...
+    :param mirror: 镜像根地址, 如 file:///data/ncbi_mirror 或 http://127.0.0.1:8000
+    :return: 下载地址
+    """
+    parsed = urlparse(url)
+    if mirror:
+        return mirror.rstrip("/") + parsed.path
+    if parsed.scheme == "ftp":
+        return parsed._replace(scheme="https").geturl()
+    return url
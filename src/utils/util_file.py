@@ -1,3 +1,8 @@
+import os
+import shutil
+from pathlib import Path
+
+
 def list2txt(list, filename) -> None:
     """
     将列表写入文本文件，每行一个条目
@@ -5,3 +10,27 @@ def list2txt(list, filename) -> None:
     with open(filename, "w") as f:
         for item in list:
             f.write(f"{item}\n")
+
+
+def file_fingerprint(filename) -> dict:
+    """
+    获取文件指纹 (大小和修改时间), 用于判断缓存是否失效
+    :param filename: 文件路径
+    :return: {"size": 文件大小, "mtime_ns": 修改时间(纳秒)}
+    """
+    st = os.stat(filename)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def replace_dir(src_dir: Path, dst_dir: Path) -> None:
+    """
+    用 src_dir 替换 dst_dir. 先写临时目录再替换, 避免中断后留下半成品
+    :param src_dir: 已写好的临时目录
+    :param dst_dir: 目标目录
+    """
+    old_dir = dst_dir.with_name(dst_dir.name + ".old")
+    if dst_dir.exists():
+        dst_dir.rename(old_dir)
+    src_dir.rename(dst_dir)
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
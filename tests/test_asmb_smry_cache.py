@@ -0,0 +1,9 @@
+from src.kml_qpcr.asmb_smry_cache import AssemblySummaryCache
+from src.config.cnfg_database import ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_CACHE_DIR
+
+
+cache = AssemblySummaryCache(ASSEMBLY_SUMMARY_GENBANK, ASSEMBLY_SUMMARY_CACHE_DIR)
+# Coxiella burnetii
+df = cache.query_taxids(["777"])
+print(df.shape)
+print(df.head())
@@ -0,0 +1,31 @@
+import gzip
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from src.kml_qpcr.cstm_gnms_load import load_customer_genomes
+
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    cstm_dir, gnm_set_dir = Path(tmp_dir) / "customer", Path(tmp_dir) / "genomes"
+    cstm_dir.mkdir()
+    # 同名但内容不同的 A.fna 和 A.fna.gz
+    (cstm_dir / "A.fna").write_text(">contig_1\nACGTACGT\n")
+    with gzip.open(cstm_dir / "A.fna.gz", "wt") as f:
+        f.write(">contig_1\nTTTTGGGG\n")
+    load_customer_genomes(str(cstm_dir), "Test species", str(gnm_set_dir), 2, "hardlink")
+    # 重新提交修改过的 A.fna
+    (cstm_dir / "A.fna.gz").unlink()
+    (cstm_dir / "A.fna").unlink()
+    (cstm_dir / "A.fna").write_text(">contig_1\nCCCCAAAA\n")
+    load_customer_genomes(str(cstm_dir), "Test species", str(gnm_set_dir), 2, "reflink")
+
+    gnm_dir = gnm_set_dir / "Test_species"
+    alias_df = pd.read_csv(gnm_dir / "info/customer_genome_aliases.tsv", sep="\t", dtype=str)
+    print(alias_df[["genome_id", "submitted_name"]])
+    # 三个不同内容的基因组各有自己的 genome_id, 原 A 没有被覆盖
+    assert alias_df["genome_id"].nunique() == 3
+    assert (gnm_dir / "all/A/A.fna").read_text() == ">contig_1\nACGTACGT\n"
+    for gnm_id in alias_df["genome_id"]:
+        assert (gnm_dir / f"all/{gnm_id}/{gnm_id}.fna").exists()
@@ -9,6 +9,6 @@ cgp = ConservedGenePredictor(
     "/data/mengxf/Project/KML250416-chinacdc-pcr/genomes",
     32, 100, 100, False)
 # core_sglcp_genes = cgp.filter_core_single_copy_gene()
-# cgp.seqkit_split_isolates_ffn()
+# cgp.index_isolates_ffn()
 # cgp.output_conserved_gene_set(core_sglcp_genes)
 cgp.run()
@@ -0,0 +1,53 @@
+import math
+import random
+import tempfile
+from pathlib import Path
+
+from src.kml_qpcr.gnm_dedup import GenomeDeduplicator, pairwise_ani, sketch_genome
+
+
+def mash_distance(sketch_a, sketch_b, kmer, sketch_size):
+    """Mash compareSketches 的合并过程: 只统计并集中最小的 sketch_size 个哈希"""
+    i = j = common = denom = 0
+    while denom < sketch_size and i < len(sketch_a) and j < len(sketch_b):
+        if sketch_a[i] == sketch_b[j]:
+            common, i, j = common + 1, i + 1, j + 1
+        elif sketch_a[i] < sketch_b[j]:
+            i += 1
+        else:
+            j += 1
+        denom += 1
+    if denom < sketch_size:
+        denom = min(sketch_size, denom + len(sketch_a) - i + len(sketch_b) - j)
+    jaccard = common / denom
+    return 1.0 if common == 0 else -math.log(2 * jaccard / (1 + jaccard)) / kmer
+
+
+# 长度不同的两条合成序列: B 为 A 的前 60% 加 1% 突变
+random.seed(1)
+seq_a = "".join(random.choice("ACGT") for _ in range(50000))
+seq_b = list(seq_a[:30000])
+for pos in random.sample(range(len(seq_b)), 300):
+    seq_b[pos] = random.choice("ACGT".replace(seq_b[pos], ""))
+seq_b = "".join(seq_b)
+with tempfile.TemporaryDirectory() as tmp_dir:
+    sketches = []
+    for name, seq in [("A", seq_a), ("B", seq_b)]:
+        fna = Path(tmp_dir) / f"{name}.fna"
+        fna.write_text(f">{name}\n{seq}\n")
+        sketches.append(sketch_genome(fna, 21, 1000)[0])
+expected = 100 * (1 - mash_distance(list(sketches[0]), list(sketches[1]), 21, 1000))
+ani_mat = pairwise_ani(sketches, 21, 1000)
+print(f"Mash ANI: {expected:.4f}, pairwise_ani: {ani_mat[0, 1]:.4f}")
+assert abs(ani_mat[0, 1] - expected) < 1e-9 and abs(ani_mat[1, 0] - expected) < 1e-9
+
+
+gd = GenomeDeduplicator(
+    sci_name="Coxiella burnetii",
+    genome_set_dir="/data/mengxf/Project/KML250416_chinacdc_pcr/genomes",
+    threads=8,
+    force=False,
+    ani=99.9
+)
+gd.run()
+print(gd.load_representatives())
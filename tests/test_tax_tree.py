@@ -0,0 +1,9 @@
+from src.kml_qpcr.tax_tree import load_taxonomy_tree
+
+
+tree = load_taxonomy_tree()
+taxid = tree.name2taxid("Ehrlichia chaffeensis")
+print(taxid, tree.rank(taxid))
+print(tree.descendants(taxid))
+print(tree.lineage(taxid))
+print(tree.lca([taxid, tree.name2taxid("Coxiella burnetii")]))